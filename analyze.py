@@ -3,7 +3,7 @@
 import sys
 import json
 import traceback
-from reqparse import ReqParser, Conn, Or, And
+from bc_scraper.scraper.reqparse import ReqParser, Conn, Or, And
 
 with open("courses.json", "r") as file:
     data = json.load(file)
@@ -3,7 +3,15 @@
 import sys
 import json
 import traceback
-from reqparse import Expr, Req, ReqParser, Conn, Or, And
+from bc_scraper.scraper.reqparse import (
+    Expr,
+    Req,
+    ReqParser,
+    Conn,
+    Or,
+    And,
+    expr_from_json,
+)
 
 with open("universal-noprogram.json", "r") as file:
     courses = json.load(file)
@@ -30,8 +38,12 @@ for sigla, c in courses.items():
     #            traceback.print_exc()
 
     try:
-        deps = ReqParser.parse_deps(c['req'], c['conn'], c['restr'])
-        deps = deps.simplify()
+        if c.get('deps') is not None:
+            # Ya viene parseado y simplificado desde el scrapeo
+            deps = expr_from_json(c['deps'])
+        else:
+            deps = ReqParser.parse_deps(c['req'], c['conn'], c['restr'])
+            deps = deps.simplify()
 
         def check_deps(expr: Expr):
             if isinstance(expr, Req):
@@ -53,18 +65,22 @@ for sigla, c in courses.items():
 for sigla, c in courses.items():
     try:
         eqlist = []
-        if c['equiv'] != "No tiene":
+        if c.get('equivs') is not None:
+            equivs = expr_from_json(c['equivs'])
+        elif c['equiv'] != "No tiene":
             equivs = ReqParser.parse_requirement(c['equiv'])
-            if isinstance(equivs, Req):
-                assert not equivs.co
-                eqlist.append(equivs.code)
-            elif isinstance(equivs, Or):
-                for req in equivs.params:
-                    assert isinstance(req, Req) and not req.co
-                    eqlist.append(req.code)
-            else:
-                raise Exception(
-                    "top-level equivalence is not a course or OR expression")
+        else:
+            equivs = Or([])
+        if isinstance(equivs, Req):
+            assert not equivs.co
+            eqlist.append(equivs.code)
+        elif isinstance(equivs, Or):
+            for req in equivs.params:
+                assert isinstance(req, Req) and not req.co
+                eqlist.append(req.code)
+        else:
+            raise Exception(
+                "top-level equivalence is not a course or OR expression")
         c['eqlist'] = eqlist
         c['inveqlist'] = []
         c['eqclass'] = {sigla}
@@ -1,136 +1,399 @@
-from itertools import product
+from itertools import count, product
+import asyncio
 import logging
-import json
 import string
-import multiprocessing
 import time
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import Dict, List, Tuple
-
-from ..scraper.search import bc_search
-from ..scraper.programs import get_program
-from ..scraper.requirements import get_requirements
-from ..scraper.banner import banner_quota
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from ..scraper.search import bc_search_result
+from ..scraper.coursemeta import course_meta_async
+from ..scraper.programs import program_sections
+from ..scraper.requirements import compile_requirements
+from ..scraper.banner import banner_quota_async
+from ..scraper.request import track_changes, worker_state
+from ..scraper.strings import dump_json, intern_fields, load_json
+from .pipeline import Stage
+from .planner import MAX_PREFIX_LENGTH, known_siglas, plan_prefixes, prefix_alphabet
 from .schedule import process_schedule
+import json
 import os
 
 log = logging.getLogger("scraper")
 
+# Cada cuantos segundos como maximo se hace fsync del journal
+JOURNAL_FSYNC_INTERVAL = 5.0
 
-def _process_and_count_optimized(args):
-    comb, period, cfg, processed_nrcs, processed_initials = args
+# Workers de cada etapa del pipeline, se cambian con --workers-<etapa>=N
+STAGE_WORKERS = {"search": 10, "courses": 3, "quota": 2}
+# Elementos por tarea de cada etapa: prefijos, siglas y nrcs
+STAGE_CHUNK = {"search": 8, "courses": 8, "quota": 16}
+# Siglas y nrcs esperando en las colas sobre los que se dejan de buscar
+# prefijos nuevos
+MAX_QUEUED = 2000
 
-    pid = os.getpid()
-    log.info(f"[PID {pid}] Procesando combinación: {comb} para el período: {period}")
 
-    found = bc_search(cfg, comb, period)
-    if cfg.get("testmode", False) and len(found) > 10:
-        found = found[:10]
+async def _fetch_quota(cfg, nrc, period):
+    if not cfg.get("fetch-quota"):
+        return {}
+    return await banner_quota_async(cfg, nrc, period)
 
-    local_courses = {}
-    local_nrcs = set()
-    local_initials = set()
 
-    for c in found:
-        if c["nrc"] in local_nrcs or c["nrc"] in processed_nrcs:
-            continue
-        local_nrcs.add(c["nrc"])
-
-        if (
-            c["initials"] not in local_initials
-            and c["initials"] not in processed_initials
-        ):
-            program = (
-                get_program(cfg, c["initials"]) if cfg.get("fetch-program") else ""
-            )
-            req, con, restr, equiv = ("", "", "", "")
-            if cfg.get("fetch-requirements"):
-                req, con, restr, equiv = get_requirements(cfg, c["initials"])
-
-            local_courses[c["initials"]] = {
-                "sigle": c["initials"],
-                "name": c["name"],
-                "credits": c["credits"],
-                "req": req,
-                "conn": con,
-                "restr": restr,
-                "equiv": equiv,
-                "program": program,
-                "school": c["school"],
-                "area": c["area"],
-                "category": c["category"],
-                "sections": {},
-            }
-            local_initials.add(c["initials"])
-
-        quota = banner_quota(cfg, c["nrc"], period) if cfg.get("fetch-quota") else {}
-        sec = {
-            "nrc": c["nrc"],
-            "section": c["section"],
-            "schedule": c["schedule"],
-            "format": c["format"],
-            "campus": c["campus"],
-            "is_english": c["is_english"],
-            "is_removable": c["is_removable"],
-            "is_special": c["is_special"],
-            "category": c["category"],
-            "total_quota": c["total_quota"],
-            "quota": quota,
-        }
+async def _tracked(coro):
+    with track_changes() as tracker:
+        value = await coro
+    return value, tracker.changed
 
-        if c["initials"] not in local_courses:
-            local_courses[c["initials"]]["sections"] = {}
-        local_courses[c["initials"]]["sections"][str(c["section"])] = sec
 
-    return comb, len(found), local_courses, local_nrcs, local_initials
+async def _gather_tracked(coros):
+    # Todas las requests de la tarea quedan en vuelo a la vez, cada una con
+    # su propio registro de cambios
+    return await asyncio.gather(*[_tracked(c) for c in coros], return_exceptions=True)
 
 
-def _merge_results(shared, results_batch, json_path):
-    proc_inits = shared["processed_initials"]
-    proc_nrcs = shared["processed_nrcs"]
+def _search_task(combs, period, cfg):
+    pid = os.getpid()
+    results = []
+    failed = []
+    for comb in combs:
+        log.info(
+            f"[PID {pid}] Buscando combinación: {comb} para el período: {period}"
+        )
+        try:
+            with track_changes() as tracker:
+                found, truncated = bc_search_result(cfg, comb, period)
+        except Exception as e:
+            log.error(f"Error buscando {comb}: {e}")
+            failed.append(comb)
+            continue
+        if cfg.get("testmode", False) and len(found) > 10:
+            found = found[:10]
+        results.append((comb, (found, truncated), tracker.changed))
+    return results, failed
+
+
+def _courses_task(initials, period, cfg):
+    fetched = asyncio.run(
+        _gather_tracked([course_meta_async(cfg, i) for i in initials])
+    )
+    results = []
+    failed = []
+    for sigle, outcome in zip(initials, fetched):
+        if isinstance(outcome, Exception):
+            log.error(
+                f"Error obteniendo el programa o requisitos de {sigle}: {outcome}"
+            )
+            failed.append(sigle)
+            continue
+        (program, (req, con, restr, equiv)), changed = outcome
+        deps, equivs = compile_requirements(cfg, req, con, restr, equiv)
+        data = {
+            "req": req,
+            "conn": con,
+            "restr": restr,
+            "equiv": equiv,
+            "deps": deps,
+            "equivs": equivs,
+            "program": program,
+            "program_sections": program_sections(cfg, program),
+        }
+        results.append((sigle, data, changed))
+    return results, failed
+
+
+def _quota_task(nrcs, period, cfg):
+    fetched = asyncio.run(
+        _gather_tracked([_fetch_quota(cfg, nrc, period) for nrc in nrcs])
+    )
+    results = []
+    failed = []
+    for nrc, outcome in zip(nrcs, fetched):
+        if isinstance(outcome, Exception):
+            log.error(f"Error obteniendo los cupos de {nrc}: {outcome}")
+            failed.append(nrc)
+            continue
+        quota, changed = outcome
+        results.append((nrc, quota, changed))
+    return results, failed
+
+
+STAGE_TASKS = {"search": _search_task, "courses": _courses_task, "quota": _quota_task}
+
+
+def _course_entry(row, data):
+    return {
+        "sigle": row["initials"],
+        "name": row["name"],
+        "credits": row["credits"],
+        **data,
+        "school": row["school"],
+        "area": row["area"],
+        "category": row["category"],
+        "sections": {},
+    }
+
+
+def _section_entry(row, quota):
+    return {
+        "nrc": row["nrc"],
+        "section": row["section"],
+        "schedule": row["schedule"],
+        "format": row["format"],
+        "campus": row["campus"],
+        "is_english": row["is_english"],
+        "is_removable": row["is_removable"],
+        "is_special": row["is_special"],
+        "category": row["category"],
+        "total_quota": row["total_quota"],
+        "quota": quota,
+    }
+
+
+def _merge_course(courses, initial, course_data):
+    if initial in courses:
+        existing_course = courses[initial]
+        existing_course["sections"].update(course_data["sections"])
+        # Un curso completo reemplaza lo que venia del snapshot, un resto con
+        # solo secciones no pisa los datos del curso
+        full = "sigle" in course_data
+        for field, value in course_data.items():
+            if field == "sections":
+                continue
+            if full:
+                existing_course[field] = value
+            else:
+                existing_course.setdefault(field, value)
+    else:
+        courses[initial] = course_data
+
+
+def _orphan(courses, initial, course_data):
+    # Secciones de una sigla de la que no hay datos del curso (nombre,
+    # creditos, programa), no se pueden guardar solas en el snapshot
+    return "sigle" not in course_data and "sigle" not in courses.get(initial, {})
+
+
+def _same_course(shared, initials, data):
+    # Lo que viene del store de siglas no pasa por el cache de requests, asi
+    # que se compara con el snapshot en vez de ver si las paginas cambiaron
+    if initials not in shared["snapshot_initials"]:
+        return False
+    previous = shared["courses"].get(initials, {})
+    return all(previous.get(field) == value for field, value in data.items())
+
+
+def _claim(shared, comb, found, truncated, changed):
+    """Opens the prefix `comb` with the sections and courses of its search
+    that no prefix found before, which are the ones it waits for. Returns
+    them, to be queued for the enrichment stages.
+    """
+    processed_nrcs = shared["processed_nrcs"]
+    processed_initials = shared["processed_initials"]
+    nrcs = []
+    initials = []
+    for row in found:
+        if row["nrc"] in processed_nrcs:
+            continue
+        processed_nrcs.add(row["nrc"])
+        nrcs.append(row["nrc"])
+        shared["section_rows"][row["nrc"]] = (comb, row, changed)
+        if row["initials"] not in processed_initials:
+            processed_initials.add(row["initials"])
+            initials.append(row["initials"])
+            shared["course_rows"][row["initials"]] = (comb, row, changed)
+
+    shared["open"][comb] = {
+        "count": len(found),
+        "truncated": truncated,
+        "nrcs": nrcs,
+        "initials": initials,
+        "left": len(nrcs) + len(initials),
+        "failed": False,
+    }
+    return initials, nrcs
+
+
+def _settle(shared, rows, key, ok=True):
+    # Un elemento de una etapa de enriquecimiento termino, su prefijo espera uno menos
+    comb, row, changed = shared[rows].pop(key)
+    _release(shared, comb, ok)
+    return comb, row, changed
+
+
+def _release(shared, comb, ok=True):
+    state = shared["open"][comb]
+    state["left"] -= 1
+    state["failed"] |= not ok
+
+
+def _merge_results(shared, local_courses, done=(), failed=()):
+    """Merges courses into the shared ones and appends them to the journal,
+    so the cost of each merge is proportional to the batch and not to
+    everything collected so far. After them go the prefixes they completed
+    (see `_replay_journal`).
+    """
     courses = shared["courses"]
-    lock = shared["lock"]
-
-    with lock:
-        for _, _, local_courses, local_nrcs, local_initials in results_batch:
-            for nrc in local_nrcs:
-                proc_nrcs[nrc] = True
-            for initial in local_initials:
-                proc_inits[initial] = True
-
-            for initial, course_data in local_courses.items():
-                if initial in courses:
-                    existing_course = courses[initial]
-                    existing_course["sections"].update(course_data["sections"])
-                    courses[initial] = existing_course
-                else:
-                    courses[initial] = course_data
-
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(dict(courses), f, ensure_ascii=False, indent=2)
+    lines = []
+    for initial, course_data in local_courses.items():
+        if _orphan(courses, initial, course_data):
+            log.error(f"Secciones de {initial} sin los datos del curso, se descartan")
+            continue
+        lines.append(
+            json.dumps({"initials": initial, "course": course_data}, ensure_ascii=False)
+        )
+        # Lo que llega de los workers viene deserializado, sin los textos
+        # internados de su proceso
+        _merge_course(courses, initial, intern_fields(course_data))
+
+    lines.extend(json.dumps(entry, ensure_ascii=False) for entry in done)
+    lines.extend(json.dumps({"failed": comb}) for comb in failed)
+    _append_journal(shared, lines)
+
+
+def _journal_path(json_path):
+    return f"{json_path}.journal"
+
+
+def _append_journal(shared, lines):
+    if not lines:
+        return
+    journal = shared["journal"]
+    journal.write("".join(f"{line}\n" for line in lines))
+    journal.flush()
+    now = time.time()
+    if now - shared["journal_synced"] >= JOURNAL_FSYNC_INTERVAL:
+        os.fsync(journal.fileno())
+        shared["journal_synced"] = now
+
+
+def _replay_journal(shared, journal_path, resume=False):
+    """Applies the journal left by an interrupted crawl over the snapshot
+    (a last line cut in half by the interruption is dropped).
+
+    Besides courses, the journal has a `level` entry with the prefixes of
+    each depth when it starts, then a `done` entry for each prefix completed
+    (with its result count, whether it was truncated and what it processed)
+    and a `failed` entry for each prefix that raised. With `resume` the
+    courses count as processed by this crawl and the frontier of the last
+    level is returned as `(depth, prefixes, done, failed)`: `done` maps the
+    completed prefixes of the level to `(comb, count, truncated)` and
+    `failed` has the prefixes of any level that raised and were not
+    completed later.
+    """
+    replayed = 0
+    frontier = None
+    failed = set()
+    offset = 0
+    with open(journal_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                log.warning(f"Linea incompleta al final de {journal_path}, se ignora")
+                break
+            offset += len(line)
+            entry = json.loads(line)
+            if "course" in entry:
+                course = intern_fields(entry["course"])
+                if _orphan(shared["courses"], entry["initials"], course):
+                    continue
+                _merge_course(shared["courses"], entry["initials"], course)
+                if not resume:
+                    shared["snapshot_initials"].add(entry["initials"])
+                    shared["snapshot_nrcs"].update(
+                        sec["nrc"] for sec in course.get("sections", {}).values()
+                    )
+                replayed += 1
+            elif "level" in entry:
+                frontier = (entry["level"], entry["prefixes"], {}, failed)
+            elif "done" in entry and frontier is not None:
+                frontier[2][entry["done"]] = (
+                    entry["done"],
+                    entry["count"],
+                    entry.get("truncated", False),
+                )
+                failed.discard(entry["done"])
+                if resume:
+                    shared["processed_nrcs"].update(entry["nrcs"])
+                    shared["processed_initials"].update(entry["initials"])
+            elif "failed" in entry:
+                failed.add(entry["failed"])
+    log.info(f"Journal de un crawl interrumpido aplicado: {replayed} cambios")
+    if not resume:
+        return None
+
+    # Se sigue escribiendo al final del mismo journal
+    os.truncate(journal_path, offset)
+    if frontier is not None:
+        depth, prefixes, done, failed = frontier
+        log.info(
+            f"Retomando nivel {depth}: {len(done)}/{len(prefixes)} prefijos listos, "
+            f"{len(failed)} con error se vuelven a procesar"
+        )
+    return frontier
+
+
+def _write_snapshot(courses, json_path, encode=False):
+    # La version codificada es para ahorrar espacio, va sin indentar. Se
+    # escribe aparte y se reemplaza, para no perder el snapshot si se corta
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        dump_json(
+            courses,
+            f,
+            encode=encode,
+            ensure_ascii=False,
+            indent=None if encode else 2,
+        )
+    os.replace(tmp_path, json_path)
+
+
+def _load_snapshot(shared, json_path):
+    """Seeds the shared courses with the previous snapshot of the period, so
+    results made only of unchanged pages do not need to be merged again.
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        previous = load_json(f)
+    for initial, course in previous.items():
+        if _orphan(shared["courses"], initial, course):
+            # Los snapshots anteriores podian tener solo las secciones
+            log.warning(f"Snapshot anterior con secciones de {initial} sin curso")
+            continue
+        shared["courses"][initial] = course
+        shared["snapshot_initials"].add(initial)
+        shared["snapshot_nrcs"].update(
+            sec["nrc"] for sec in course.get("sections", {}).values()
+        )
+    log.info(f"Snapshot anterior cargado: {len(previous)} cursos")
+
+
+def _prune_snapshot(shared):
+    """Drops courses and sections of the previous snapshot that this crawl
+    did not find anymore.
+    """
+    courses = shared["courses"]
+    proc_nrcs = shared["processed_nrcs"]
+    proc_inits = shared["processed_initials"]
+    for initial in shared["snapshot_initials"]:
+        course = courses[initial]
+        sections = {
+            sec_id: sec
+            for sec_id, sec in course["sections"].items()
+            if sec["nrc"] in proc_nrcs
+        }
+        if not sections and initial not in proc_inits:
+            del courses[initial]
+        elif len(sections) != len(course["sections"]):
+            course["sections"] = sections
 
 
 class CollectCoursesOptimized:
     def __init__(self):
         self.start_time = None
-
-    def _calculate_dynamic_threshold(self, results, depth):
-        if not results:
-            return 50
-
-        counts = [cnt for _, cnt, *_ in results if cnt > 0]
-        if not counts:
-            return 50
-
-        avg_count = sum(counts) / len(counts)
-        if depth <= 2:
-            threshold = max(25, int(avg_count * 0.8))
-        elif depth <= 4:
-            threshold = max(30, int(avg_count * 1.2))
-        else:
-            threshold = max(50, int(avg_count * 1.5))
-
-        return min(threshold, 100)
+        # Segundos gastados mezclando resultados y escribiendo el snapshot
+        self.merge_time = 0.0
+        # Prefijos que fallaron, se vuelven a procesar con --resume
+        self.failed = 0
+        # Etapas del pipeline: busqueda de prefijos, programa y requisitos de
+        # cada sigla nueva, y cupos de cada nrc nuevo
+        self.stages = {}
 
     def _log_progress(self, depth, completed, total, results):
         elapsed = time.time() - self.start_time
@@ -139,25 +402,188 @@ class CollectCoursesOptimized:
             avg_time = elapsed / completed if completed > 0 else 0
             eta = (total - completed) * avg_time
             total_found = sum(cnt for _, cnt, *_ in results)
+            queued = " ".join(
+                f"{name}={len(stage.queue)}" for name, stage in self.stages.items()
+            )
             log.info(
                 f"Nivel {depth}: {completed}/{total} ({progress:.1f}%) - "
-                f"Encontrados: {total_found} - ETA: {eta:.1f}s"
+                f"Encontrados: {total_found} - En cola: {queued} - ETA: {eta:.1f}s"
+            )
+
+    def _merge(self, shared, local_courses, done=(), failed=()):
+        start = time.time()
+        _merge_results(shared, local_courses, done, failed)
+        self.merge_time += time.time() - start
+
+    def _handle(self, shared, name, results, failed):
+        """Applies what a task of stage `name` returned: a search opens its
+        prefixes and queues what they found for the other stages, and the
+        courses and sections of the others are merged. Returns the journal
+        entries of the prefixes that completed and the ones that failed.
+        """
+        local_courses = {}
+        touched = set()
+        if name == "search":
+            for comb, (found, truncated), changed in results:
+                initials, nrcs = _claim(shared, comb, found, truncated, changed)
+                self.stages["courses"].put(initials)
+                self.stages["quota"].put(nrcs)
+                touched.add(comb)
+            for comb in failed:
+                _claim(shared, comb, [], False, False)
+                shared["open"][comb]["failed"] = True
+                touched.add(comb)
+        elif name == "courses":
+            for initials, data, changed in results:
+                comb, row, search_changed = _settle(shared, "course_rows", initials)
+                # Lo que no cambio ya esta en el snapshot anterior
+                if (
+                    changed
+                    or search_changed
+                    or not _same_course(shared, initials, data)
+                ):
+                    _merge_course(local_courses, initials, _course_entry(row, data))
+                touched.add(comb)
+                for held_comb, sections in shared["held"].pop(initials, ()):
+                    if sections:
+                        _merge_course(local_courses, initials, {"sections": sections})
+                    _release(shared, held_comb)
+                    touched.add(held_comb)
+            for initials in failed:
+                touched.add(_settle(shared, "course_rows", initials, ok=False)[0])
+                # Sin los datos del curso sus secciones se vuelven a buscar
+                for held_comb, _ in shared["held"].pop(initials, ()):
+                    _release(shared, held_comb, ok=False)
+                    touched.add(held_comb)
+        else:
+            for nrc, quota, changed in results:
+                comb, row, search_changed = shared["section_rows"].pop(nrc)
+                initials = row["initials"]
+                sections = None
+                if changed or search_changed or nrc not in shared["snapshot_nrcs"]:
+                    sections = {str(row["section"]): _section_entry(row, quota)}
+                if initials in shared["course_rows"]:
+                    # La seccion espera a que llegue su curso
+                    shared["held"].setdefault(initials, []).append((comb, sections))
+                    continue
+                # Si el curso fallo la seccion se vuelve a buscar con su prefijo
+                ok = "sigle" in local_courses.get(initials, {}) or (
+                    "sigle" in shared["courses"].get(initials, {})
+                )
+                if ok and sections:
+                    _merge_course(local_courses, initials, {"sections": sections})
+                _release(shared, comb, ok)
+                touched.add(comb)
+            for nrc in failed:
+                touched.add(_settle(shared, "section_rows", nrc, ok=False)[0])
+
+        done = []
+        failed_combs = []
+        for comb in sorted(touched):
+            state = shared["open"][comb]
+            if state["left"]:
+                continue
+            del shared["open"][comb]
+            if state["failed"]:
+                failed_combs.append(comb)
+                continue
+            done.append(
+                {
+                    "done": comb,
+                    "count": state["count"],
+                    "truncated": state["truncated"],
+                    "nrcs": sorted(state["nrcs"]),
+                    "initials": sorted(state["initials"]),
+                }
             )
+        self._merge(shared, local_courses, done, failed_combs)
+        return done, failed_combs
+
+    def _run_level(self, shared, depth, pending, period, cfg, results, completed):
+        """Runs the `pending` prefixes of a level through the pipeline,
+        adding `(comb, count, truncated)` to `results` (which has the
+        `completed` ones of a resumed level) for each prefix whose search
+        succeeded. Whether it is split depends only on its search, a prefix
+        whose courses or sections failed is retried with `--resume` but its
+        children are still searched.
+        """
+        total = completed + len(pending)
+        stages = self.stages
+        search = stages["search"]
+        search.put(pending)
+
+        # Lo ultimo que encuentra una busqueda queda en las colas de las otras
+        # etapas sin nada en vuelo, asi que tambien se esperan las colas
+        while any(stage.queue or stage.inflight for stage in stages.values()):
+            # Si el enriquecimiento se atrasa no se buscan prefijos nuevos
+            queued = len(stages["courses"].queue) + len(stages["quota"].queue)
+            if queued < MAX_QUEUED:
+                search.submit(period, cfg)
+            stages["courses"].submit(period, cfg)
+            stages["quota"].submit(period, cfg)
+
+            futures = {
+                future: stage for stage in stages.values() for future in stage.inflight
+            }
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = futures[future]
+                _, stage_results, failed = stage.finished(future)
+                done, failed_combs = self._handle(
+                    shared, stage.name, stage_results, failed
+                )
+                self.failed += len(failed_combs)
+                if stage.name == "search":
+                    results.extend(
+                        (comb, len(found), truncated)
+                        for comb, (found, truncated), _ in stage_results
+                    )
+                previous = completed
+                completed += len(done) + len(failed_combs)
+
+                if completed // 300 > previous // 300 or (
+                    completed == total and previous != total
+                ):
+                    self._log_progress(depth, completed, total, results)
+
+        for stage in stages.values():
+            stage.log_stats()
 
     def collect(self, period: str, cfg: dict):
         json_path: str = f"{period}.json"
         self.start_time = time.time()
 
-        mgr = multiprocessing.Manager()
+        # Todo el estado vive en el padre, que decide que siglas y nrcs pasan
+        # a las etapas de enriquecimiento
         shared = {
-            "processed_initials": mgr.dict(),
-            "processed_nrcs": mgr.dict(),
-            "courses": mgr.dict(),
-            "lock": mgr.Lock(),
+            "processed_initials": set(),
+            "processed_nrcs": set(),
+            "courses": {},
+            # Prefijos buscados que esperan sus cursos y secciones, y la fila
+            # de busqueda de cada sigla y nrc que falta
+            "open": {},
+            "course_rows": {},
+            "section_rows": {},
+            # Secciones cuyo curso sigue en la etapa courses, por sigla
+            "held": {},
+            "snapshot_initials": set(),
+            "snapshot_nrcs": set(),
+            "encode": cfg.get("encode-strings", False),
         }
-
-        NUMBERS = string.digits
-        MAX_WORKERS = 15  # 1000 segundos sin tener cache
+        journal_path = _journal_path(json_path)
+        frontier = None
+        if not cfg.get("testmode", False):
+            if os.path.exists(json_path):
+                _load_snapshot(shared, json_path)
+            if os.path.exists(journal_path):
+                frontier = _replay_journal(shared, journal_path, cfg.get("resume"))
+                if frontier is None:
+                    # Lo recuperado queda en el snapshot antes de empezar otro journal
+                    _write_snapshot(shared["courses"], json_path, shared["encode"])
+        shared["journal"] = open(
+            journal_path, "a" if frontier is not None else "w", encoding="utf-8"
+        )
+        shared["journal_synced"] = time.time()
 
         LETTERS = string.ascii_uppercase
         # Según mis pruebas, hacer [AAA, AAB, AAC,..., ZZX, ZZY, ZZZ] es mejor
@@ -170,78 +596,92 @@ class CollectCoursesOptimized:
         # NO USAR MAS DE 3 o menos de 1
 
         prefixes = ["".join(p) for p in product(LETTERS, repeat=N)]
-
-        for depth in range(N, 6):
-            if not prefixes:
-                break
-
-            log.info(f"Iniciando nivel {depth} con {len(prefixes)} prefijos")
-            tasks = [
-                (
-                    pref,
-                    period,
-                    cfg,
-                    shared["processed_nrcs"],
-                    shared["processed_initials"],
+        if cfg.get("plan") and frontier is None:
+            # En vez de todas las combinaciones, solo los prefijos de las
+            # siglas conocidas y unos pocos para descubrir nuevas
+            prefixes = plan_prefixes(known_siglas(cfg["plan"]), period)
+        start_depth = N
+        # Prefijos del nivel actual ya procesados, con sus resultados
+        done = {}
+        failed = set()
+        if frontier is not None:
+            start_depth, prefixes, done, failed = frontier
+
+        workers = {**STAGE_WORKERS, **cfg.get("stage-workers", {})}
+        state = worker_state()
+        self.stages = {
+            name: Stage(name, task, workers[name], STAGE_CHUNK[name], state)
+            for name, task in STAGE_TASKS.items()
+        }
+        try:
+            # Se baja un nivel solo por los prefijos que busca cursos trunco
+            for depth in count(start_depth):
+                if not prefixes:
+                    break
+
+                if not done:
+                    log.info(f"Iniciando nivel {depth} con {len(prefixes)} prefijos")
+                    entry = {"level": depth, "prefixes": prefixes}
+                    _append_journal(shared, [json.dumps(entry)])
+                pending = [pref for pref in prefixes if pref not in done]
+                # Los que fallaron en niveles anteriores se reintentan en este
+                pending += sorted(failed - set(prefixes))
+                results = list(done.values())
+                completed = len(results)
+                done = {}
+                failed = set()
+
+                if pending:
+                    self._run_level(
+                        shared, depth, pending, period, cfg, results, completed
+                    )
+
+                next_prefixes = []
+                split_count = 0
+                level = set(prefixes)
+
+                for comb, cnt, truncated, *_ in results:
+                    if not truncated:
+                        continue
+                    # Por el largo y no por el nivel, ya que un prefijo reintentado
+                    # con --resume puede ser de un nivel anterior
+                    if len(comb) >= MAX_PREFIX_LENGTH:
+                        log.warning(
+                            f"Busqueda de {comb} truncada en {cnt} filas, "
+                            "se pueden haber perdido secciones"
+                        )
+                        continue
+                    split_count += 1
+                    # Un prefijo reintentado de un nivel anterior ya se dividio
+                    next_prefixes.extend(
+                        comb + c for c in prefix_alphabet(comb) if comb + c not in level
+                    )
+
+                log.info(
+                    f"Nivel {depth} completado. "
+                    f"Truncados: {split_count}/{len(results)}. "
+                    f"Siguientes: {len(next_prefixes)}"
                 )
-                for pref in prefixes
-            ]
-            results = []
-            completed = 0
-
-            with ProcessPoolExecutor(
-                max_workers=min(MAX_WORKERS, len(tasks))
-            ) as executor:
-                future_to_task = {
-                    executor.submit(_process_and_count_optimized, task): task
-                    for task in tasks
-                }
-                batch_results = []
-                batch_size = 1_000
-
-                for future in as_completed(future_to_task):
-                    try:
-                        result = future.result()
-                        results.append(result)
-                        batch_results.append(result)
-                        completed += 1
-
-                        if completed % 300 == 0 or completed == len(tasks):
-                            self._log_progress(depth, completed, len(tasks), results)
-
-                        if len(batch_results) >= batch_size:
-                            _merge_results(shared, batch_results, json_path)
-                            batch_results = []
-
-                    except Exception as e:
-                        task = future_to_task[future]
-                        log.error(f"Error procesando {task[0]}: {e}")
-                        completed += 1
-
-                if batch_results:
-                    _merge_results(shared, batch_results, json_path)
-
-            threshold = self._calculate_dynamic_threshold(results, depth)
-            log.info(f"Aplicando umbral dinámico: {threshold}")
-
-            next_prefixes = []
-            pruned_count = 0
-
-            for comb, cnt, *_ in results:
-                if cnt < threshold:
-                    pruned_count += 1
-                    continue
-
-                if depth < 3:
-                    next_prefixes.extend([comb + L for L in LETTERS])
-                elif depth in (3, 4):
-                    next_prefixes.extend([comb + N for N in NUMBERS])
-
-            log.info(
-                f"Nivel {depth} completado. Podados: {pruned_count}/{len(results)}. "
-                f"Siguientes: {len(next_prefixes)}"
+                prefixes = next_prefixes
+        finally:
+            for stage in self.stages.values():
+                stage.close()
+
+        # Compactacion final: el snapshot completo se escribe una sola vez
+        start = time.time()
+        # Si algun prefijo fallo no sabemos que cursos desaparecieron
+        if shared["snapshot_initials"] and not self.failed:
+            _prune_snapshot(shared)
+        _write_snapshot(shared["courses"], json_path, shared["encode"])
+        shared["journal"].close()
+        if self.failed:
+            # El journal queda para reintentarlos
+            log.warning(
+                f"{self.failed} prefijos fallaron, se pueden reintentar con --resume"
             )
-            prefixes = next_prefixes
+        else:
+            os.remove(journal_path)
+        self.merge_time += time.time() - start
 
         total_courses = len(shared["processed_initials"])
         total_sections = len(shared["processed_nrcs"])
@@ -252,6 +692,8 @@ class CollectCoursesOptimized:
         log.info(f"Total courses: {total_courses}")
         log.info(f"Total sections: {total_sections}")
         log.info(f"Tiempo total: {elapsed:.2f}s")
+        log.info(f"Tiempo de merge: {self.merge_time:.2f}s")
+        log.info(f"Prefijos con error: {self.failed}")
         log.info(f"Snapshot final en {json_path}")
         log.info("=" * 50)
 
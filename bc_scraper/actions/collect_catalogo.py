@@ -1,18 +1,19 @@
 import json
-from ..scraper.search_catalogo import catalogo_search
-from ..scraper.programs import get_program
-from ..scraper.requirements import get_requirements
+from ..scraper.search_catalogo import catalogo_search_result
+from ..scraper.coursemeta import course_meta
+from ..scraper.programs import program_sections
+from ..scraper.requirements import compile_requirements
+from .planner import MAX_PREFIX_LENGTH, prefix_alphabet
 from .schedule import process_schedule
 from .errors import handle
+from collections import deque
 import logging
+import string
 from typing import Set, Dict, List, Union
 
 log = logging.getLogger("scraper")
 
 
-CATALOGO_LIMIT = 1000
-
-
 class CollectCatalogo:
     processed: Set[str]
     courses: Dict[str, dict]
@@ -28,13 +29,9 @@ class CollectCatalogo:
             self.processed.add(c['initials'])
 
             try:
-                # Fetch auxiliary data
-                program = ""
-                if cfg.get("fetch-program"):
-                    program = get_program(cfg, c["initials"])
-                req, con, restr, equiv = "", "", "", ""
-                if cfg.get("fetch-requirements"):
-                    req, con, restr, equiv = get_requirements(cfg, c["initials"])
+                # Fetch auxiliary data, shared with the buscacursos scraper
+                program, (req, con, restr, equiv) = course_meta(cfg, c["initials"])
+                deps, equivs = compile_requirements(cfg, req, con, restr, equiv)
 
                 # Save course
                 self.courses[c['initials']] = {
@@ -44,7 +41,10 @@ class CollectCatalogo:
                     'conn': con,
                     'restr': restr,
                     'equiv': equiv,
+                    'deps': deps,
+                    'equivs': equivs,
                     'program': program,
+                    'program_sections': program_sections(cfg, program),
                     'school': c['school'],
                     'relevance': c['relevance'],
                 }
@@ -63,49 +63,22 @@ class CollectCatalogo:
     def collect(self, cfg: dict):
         testmode: bool = cfg.get('testmode', False)
 
-        LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        NUMBERS = "0123456789"
-        for l1 in LETTERS:
-            comb = l1
+        # Un prefijo se divide solo si el catalogo corto sus resultados
+        pending = deque(string.ascii_uppercase)
+        while pending:
+            comb = pending.popleft()
             log.info("Searching %s", comb)
-            courses = catalogo_search(cfg, comb)
+            courses, truncated = catalogo_search_result(cfg, comb)
             if testmode and len(courses) > 10:
                 courses = courses[:10]
-                pass
             self.process_courses(cfg, courses)
             if testmode:
                 break
-            if len(courses) < CATALOGO_LIMIT:
+            if not truncated:
                 continue
-
-            for l2 in LETTERS:
-                comb = l1 + l2
-                log.info("Searching %s", comb)
-                courses = catalogo_search(cfg, comb)
-                self.process_courses(cfg, courses)
-                if len(courses) < CATALOGO_LIMIT:
-                    continue
-
-                for l3 in LETTERS:
-                    comb = l1 + l2 + l3
-                    log.info("Searching %s", comb)
-                    courses = catalogo_search(cfg, comb)
-                    self.process_courses(cfg, courses)
-                    if len(courses) < CATALOGO_LIMIT:
-                        continue
-
-                    for n1 in NUMBERS:
-                        comb = l1 + l2 + l3 + n1
-                        log.info("Searching %s", comb)
-                        courses = catalogo_search(cfg, comb)
-                        self.process_courses(cfg, courses)
-                        if len(courses) < CATALOGO_LIMIT:
-                            continue
-
-                        for n2 in NUMBERS:
-                            comb = l1 + l2 + l3 + n1 + n2
-                            log.info("Searching %s", comb)
-                            courses = catalogo_search(cfg, comb)
-                            self.process_courses(cfg, courses)
+            if len(comb) >= MAX_PREFIX_LENGTH:
+                log.warning("Resultados de %s cortados, no se puede dividir mas", comb)
+                continue
+            pending.extend(comb + c for c in prefix_alphabet(comb))
 
         log.info("Found %s courses", len(self.courses))
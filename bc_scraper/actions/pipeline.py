@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+from ..scraper.request import init_worker
+
+log = logging.getLogger("scraper")
+
+# Tareas en vuelo por worker de una etapa, el resto espera en su cola
+TASKS_PER_WORKER = 2
+
+
+def _run_task(args):
+    # Corre en el worker, el tiempo es el de la tarea sin lo que espero en la cola
+    task, items, period, cfg = args
+    start = time.time()
+    results, failed = task(items, period, cfg)
+    return results, failed, time.time() - start
+
+
+class Stage:
+    """One step of the courses pipeline: `workers` processes that run
+    `task(items, period, cfg)` over chunks of up to `chunk` queued items.
+    A task returns `(results, failed)`, with a `(item, value, changed)`
+    triple for each item that succeeded.
+
+    At most `TASKS_PER_WORKER` tasks per worker are in flight, the rest of
+    the items wait in `queue`, so a slow stage backs up its own queue
+    instead of the stages before it. Keeps the throughput of the step.
+    """
+
+    def __init__(self, name: str, task: Callable, workers: int, chunk: int, state):
+        self.name = name
+        self.task = task
+        self.workers = workers
+        self.chunk = chunk
+        self.queue: deque = deque()
+        self.inflight: Dict[Future, List[Any]] = {}
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(state,)
+        )
+        self.items = 0
+        self.failed = 0
+        # Segundos con tareas en vuelo y segundos de trabajo sumando los workers
+        self.active = 0.0
+        self.busy = 0.0
+        self._since = None
+
+    def put(self, items):
+        self.queue.extend(items)
+
+    def submit(self, period: str, cfg: dict):
+        while self.queue and len(self.inflight) < self.workers * TASKS_PER_WORKER:
+            # Con pocos elementos en la cola se reparten entre todos los workers
+            size = max(1, min(self.chunk, len(self.queue) // self.workers))
+            items = [self.queue.popleft() for _ in range(min(size, len(self.queue)))]
+            future = self._executor.submit(_run_task, (self.task, items, period, cfg))
+            if not self.inflight:
+                self._since = time.time()
+            self.inflight[future] = items
+
+    def finished(self, future: Future) -> Tuple[List[Any], list, list]:
+        """The items of a completed task, its results and the items that
+        failed (all of them if the task itself raised).
+        """
+        items = self.inflight.pop(future)
+        if not self.inflight:
+            self.active += time.time() - self._since
+        try:
+            results, failed, seconds = future.result()
+        except Exception as e:
+            log.error(f"Error en la etapa {self.name} con {len(items)} elementos: {e}")
+            results, failed, seconds = [], items, 0.0
+        self.items += len(items)
+        self.failed += len(failed)
+        self.busy += seconds
+        return items, results, failed
+
+    def stats(self) -> dict:
+        active = self.active
+        if self.inflight:
+            active += time.time() - self._since
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "failed": self.failed,
+            "queued": len(self.queue),
+            "seconds": active,
+            "per_second": self.items / active if active else 0.0,
+            "utilization": self.busy / (active * self.workers) if active else 0.0,
+        }
+
+    def log_stats(self):
+        s = self.stats()
+        log.info(
+            f"Etapa {self.name}: {s['items']} en {s['seconds']:.1f}s "
+            f"({s['per_second']:.1f}/s) con {s['workers']} workers, "
+            f"uso {s['utilization']:.0%}, en cola {s['queued']}, "
+            f"con error {s['failed']}"
+        )
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
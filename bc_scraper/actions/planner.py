@@ -0,0 +1,105 @@
+import logging
+import string
+import zlib
+from collections import defaultdict
+from typing import Dict, Iterable, List
+
+from ..scraper.search import BC_ROW_LIMIT
+from ..scraper.strings import load_json
+
+log = logging.getLogger("scraper")
+
+# Filas esperadas como maximo por busqueda planificada, con margen bajo
+# `BC_ROW_LIMIT` para las secciones nuevas
+PLAN_ROWS = BC_ROW_LIMIT * 4 // 5
+# Largo maximo de un prefijo, el de las siglas mas largas
+MAX_PREFIX_LENGTH = 8
+# Busquedas extra, como fraccion del plan, en prefijos sin siglas conocidas
+EXPLORE_FRACTION = 0.1
+
+
+def _course_rows(course: dict) -> int:
+    # Secciones que se esperan para la sigla: las del snapshot, las del
+    # periodo con mas secciones de un archivo universal, o 1 si solo viene
+    # del catalogo
+    if "sections" in course:
+        return len(course["sections"])
+    instances = course.get("instances")
+    if instances:
+        return max(len(inst.get("sections", {})) for inst in instances.values())
+    return 1
+
+
+def known_siglas(paths: Iterable[str]) -> Dict[str, int]:
+    """Siglas (with the rows each one is expected to return) of previous
+    period snapshots, catalogo scrapes or universal files.
+    """
+    rows: Dict[str, int] = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            data = load_json(f)
+        # Igual que make-universal: las llaves con '-' son periodos
+        groups = data.values() if any("-" in key for key in data) else [data]
+        for courses in groups:
+            for initials, course in courses.items():
+                rows[initials] = max(rows.get(initials, 0), _course_rows(course))
+        log.info(f"Plan: {len(rows)} siglas conocidas tras leer {path}")
+    return rows
+
+
+def prefix_alphabet(prefix: str) -> str:
+    """Characters that can follow `prefix` in a sigla: three letters, then
+    digits, then digits or a letter.
+    """
+    if len(prefix) < 3:
+        return string.ascii_uppercase
+    if len(prefix) < 5:
+        return string.digits
+    return string.digits + string.ascii_uppercase
+
+
+def plan_prefixes(
+    siglas: Dict[str, int],
+    period: str,
+    max_rows: int = PLAN_ROWS,
+    explore: float = EXPLORE_FRACTION,
+) -> List[str]:
+    """Smallest set of prefixes that covers every known sigla with at most
+    `max_rows` expected rows per search, walking down a trie of the siglas
+    and searching a prefix as soon as its subtree fits. A sigla that fits
+    alone is searched as is, even if longer siglas start with it.
+
+    Plus up to `explore` times as many exploratory prefixes, the shortest
+    ones under which no sigla is known, to find new ones. Which of them are
+    explored rotates with `period`.
+    """
+    weight: Dict[str, int] = defaultdict(int)
+    children: Dict[str, set] = defaultdict(set)
+    for initials, rows in siglas.items():
+        for i in range(len(initials)):
+            weight[initials[:i]] += rows
+            children[initials[:i]].add(initials[i])
+        weight[initials] += rows
+
+    planned: List[str] = []
+    gaps: List[str] = []
+    stack = [""]
+    while stack:
+        prefix = stack.pop()
+        fits = bool(prefix) and weight[prefix] <= max_rows
+        if fits or prefix in siglas or not children[prefix]:
+            planned.append(prefix)
+            continue
+        stack.extend(prefix + c for c in children[prefix])
+        gaps.extend(
+            prefix + c for c in prefix_alphabet(prefix) if c not in children[prefix]
+        )
+
+    budget = int(len(planned) * explore)
+    gaps.sort(key=lambda p: (len(p), zlib.crc32(f"{period}{p}".encode())))
+    explored = gaps[:budget]
+    log.info(
+        f"Plan: {len(planned)} prefijos cubren {len(siglas)} siglas, "
+        f"{len(explored)}/{len(gaps)} prefijos sin siglas conocidas se exploran"
+    )
+    return sorted(planned) + sorted(explored)
@@ -0,0 +1,74 @@
+import os
+import json
+import string
+import logging
+from itertools import product
+from typing import Iterable, Iterator
+
+from ..scraper.search import _search_url
+from ..scraper.banner import _quota_url
+from ..scraper.programs import _program_url
+from ..scraper.requirements import _requirements_url
+from ..scraper.search_catalogo import CATALOGO_URL, _catalogo_params
+from ..scraper.strings import load_json
+
+log = logging.getLogger("scraper")
+
+
+def _get(url: str) -> dict:
+    return {"m": "get", "url": url}
+
+
+def candidate_requests(paths: Iterable[str]) -> Iterator[dict]:
+    """Requests that a previous scrape could have made, rebuilt from its
+    output. `paths` are `{period}.json` files from buscacursos or a catalogo
+    dump. Used to recognize legacy cache entries, which only store a hash of
+    their request.
+    """
+    seen = set()
+
+    def new(req):
+        key = json.dumps(req, sort_keys=True)
+        if key in seen:
+            return False
+        seen.add(key)
+        return True
+
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                courses = load_json(f)
+        except Exception as err:
+            log.warning("skipping %s: %s", path, err)
+            continue
+        period = os.path.splitext(os.path.basename(path))[0]
+        is_period = period != "catalogo"
+        log.info("generating candidate requests from %s", path)
+
+        if is_period:
+            for comb in product(string.ascii_uppercase, repeat=2):
+                req = _get(_search_url("".join(comb), period, False))
+                if new(req):
+                    yield req
+
+        for initials, course in courses.items():
+            candidates = [
+                _get(_program_url(initials)),
+                _get(_requirements_url(initials)),
+            ]
+            for n in range(1, len(initials) + 1):
+                prefix = initials[:n]
+                candidates.append(
+                    {"m": "post", "url": CATALOGO_URL, "prm": _catalogo_params(prefix)}
+                )
+                if is_period and n >= 2:
+                    candidates.append(_get(_search_url(prefix, period, False)))
+            if is_period:
+                for section in course.get("sections", {}).values():
+                    nrc = section.get("nrc")
+                    if nrc:
+                        candidates.append(_get(_search_url(nrc, period, True)))
+                        candidates.append(_get(_quota_url(nrc, period)))
+            for req in candidates:
+                if new(req):
+                    yield req
@@ -1,4 +1,11 @@
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ..scraper.strings import StringTable
 
 
 def process_schedule(text_sc: str) -> Dict[str, List[str]]:
@@ -21,3 +28,167 @@ def process_schedule(text_sc: str) -> Dict[str, List[str]]:
                 if len(day) and len(mod):
                     schedule[day.lower() + mod] = row[1:]
     return schedule
+
+
+# Forma compacta
+#
+# Cada tipo de actividad (CLAS, AYU, LAB, ...) de una seccion se guarda como una
+# mascara de bits sobre la grilla de dias x modulos, con el bit
+# `dia * MODULES_PER_DAY + (modulo - 1)`, y las salas como ids de una `RoomTable`.
+
+DAYS = "lmwjvs"
+MODULES_PER_DAY = 10
+
+# Una seccion compacta: {tipo: [mascara, sala]} si todos los modulos del tipo
+# son en la misma sala, o {tipo: [mascara, sala, sala, ...]} con una sala por
+# bit encendido, de menor a mayor
+CompactSchedule = Dict[str, List[int]]
+
+
+class RoomTable(StringTable):
+    """Interns room names, so compact schedules store small ids instead."""
+
+    @property
+    def rooms(self) -> List[str]:
+        return self.strings
+
+
+def module_bit(key: str) -> int:
+    """Bit of a dict-form schedule key like `"m2"` (tuesday, 2nd module)."""
+    day = DAYS.find(key[:1])
+    module = int(key[1:]) if key[1:].isdigit() else 0
+    if day < 0 or not 1 <= module <= MODULES_PER_DAY:
+        raise ValueError(f"schedule key '{key}' is outside the grid")
+    return day * MODULES_PER_DAY + module - 1
+
+
+def module_key(bit: int) -> str:
+    return f"{DAYS[bit // MODULES_PER_DAY]}{bit % MODULES_PER_DAY + 1}"
+
+
+def modules_mask(keys: Iterable[str]) -> int:
+    """Mask of a set of modules, given as dict-form keys (`["l1", "w1"]`)."""
+    mask = 0
+    for key in keys:
+        mask |= 1 << module_bit(key)
+    return mask
+
+
+def _bits(mask: int) -> Iterator[int]:
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def compact_schedule(
+    schedule: Dict[str, List[str]], rooms: RoomTable
+) -> CompactSchedule:
+    """Compact form of a `process_schedule` dict. Entries are `[type, room]`."""
+    by_type: Dict[str, Dict[int, int]] = {}
+    for key, value in schedule.items():
+        kind = value[0] if value else ""
+        room = value[1] if len(value) > 1 else ""
+        by_type.setdefault(kind, {})[module_bit(key)] = rooms.intern(room)
+    compact = {}
+    for kind, slots in by_type.items():
+        bits = sorted(slots)
+        mask = sum(1 << bit for bit in bits)
+        ids = [slots[bit] for bit in bits]
+        compact[kind] = [mask] + (ids[:1] if len(set(ids)) == 1 else ids)
+    return compact
+
+
+def expand_schedule(compact: CompactSchedule, rooms: RoomTable) -> Dict[str, List[str]]:
+    """Dict form of a compact schedule, the inverse of `compact_schedule`."""
+    slots = []
+    for kind, (mask, *ids) in compact.items():
+        for i, bit in enumerate(_bits(mask)):
+            room = rooms[ids[i] if len(ids) > 1 else ids[0]]
+            slots.append((bit, kind, room))
+    slots.sort()
+    return {module_key(bit): [kind, room] for bit, kind, room in slots}
+
+
+def schedule_mask(
+    compact: CompactSchedule, types: Optional[Iterable[str]] = None
+) -> int:
+    """Modules used by a section, counting only activities in `types` (all by
+    default).
+    """
+    types = None if types is None else set(types)
+    mask = 0
+    for kind, (kind_mask, *_) in compact.items():
+        if types is None or kind in types:
+            mask |= kind_mask
+    return mask
+
+
+def section_masks(
+    courses: Dict[str, dict],
+    rooms: Optional[RoomTable] = None,
+    types: Optional[Iterable[str]] = None,
+) -> Tuple[List[Tuple[str, str]], Sequence[int]]:
+    """Schedule masks of every section of a period (a `{period}.json`), as
+    `(initials, section)` ids and a parallel array of masks (a uint64 NumPy
+    array when NumPy is installed). Modules outside the grid are left out.
+    """
+    rooms = rooms if rooms is not None else RoomTable()
+    ids = []
+    masks = []
+    for initials, course in courses.items():
+        for section_id, section in course.get("sections", {}).items():
+            schedule = {
+                key: value
+                for key, value in section.get("schedule", {}).items()
+                if _in_grid(key)
+            }
+            ids.append((initials, section_id))
+            masks.append(schedule_mask(compact_schedule(schedule, rooms), types))
+    if numpy is not None:
+        return ids, numpy.array(masks, dtype=numpy.uint64)
+    return ids, masks
+
+
+def _in_grid(key: str) -> bool:
+    try:
+        module_bit(key)
+        return True
+    except ValueError:
+        return False
+
+
+# Filas por bloque al comparar todas contra todas, para acotar la memoria
+_CONFLICT_BLOCK = 1024
+
+
+def find_conflicts(masks: Sequence[int]):
+    """Pairs `(i, j)`, `i < j`, of masks sharing at least one module. With
+    NumPy it is an integer array of shape `(pairs, 2)`, otherwise a list.
+    """
+    if numpy is None:
+        return [
+            (i, j)
+            for i in range(len(masks))
+            for j in range(i + 1, len(masks))
+            if masks[i] & masks[j]
+        ]
+    masks = numpy.asarray(masks, dtype=numpy.uint64)
+    pairs = [numpy.empty((0, 2), dtype=numpy.int64)]
+    for start in range(0, len(masks), _CONFLICT_BLOCK):
+        block = masks[start : start + _CONFLICT_BLOCK]
+        # Solo las columnas desde `start`, las anteriores ya se compararon
+        rows, cols = numpy.nonzero(block[:, None] & masks[None, start:])
+        upper = rows < cols
+        pairs.append(numpy.stack([rows[upper] + start, cols[upper] + start], axis=1))
+    return numpy.concatenate(pairs)
+
+
+def free_sections(masks: Sequence[int], modules: int):
+    """Indexes of the masks that use none of the modules in the mask `modules`,
+    as an array with NumPy or a list otherwise.
+    """
+    if numpy is None:
+        return [i for i, mask in enumerate(masks) if not mask & modules]
+    masks = numpy.asarray(masks, dtype=numpy.uint64)
+    return numpy.nonzero((masks & numpy.uint64(modules)) == 0)[0]
@@ -1,7 +1,7 @@
 from html.parser import HTMLParser
-from .request import get_text
+from .request import get_page, get_page_async
+from .memo import memo_kind, memoized_parse
 import logging
-from time import sleep
 
 
 log = logging.getLogger("scraper")
@@ -46,15 +46,28 @@ class BannerParser(HTMLParser):
                 self.quota[key] = int(data)
 
 
+def _quota_url(nrc: str, period: str) -> str:
+    return (
+        "https://buscacursos.uc.cl/informacionVacReserva.ajax.php"
+        f"?nrc={nrc}&termcode={period}"
+    )
+
+
+# Version del parser de cupos en `.parsememo`
+QUOTA_MEMO = memo_kind("quota", 1)
+
+
+def _parse_quota(text: str):
+    return BannerParser().process(text)
+
+
 def banner_quota(cfg, nrc: str, period: str):
-    parser = BannerParser()
-    url = f"https://buscacursos.uc.cl/informacionVacReserva.ajax.php?nrc={nrc}&termcode={period}"
-    resp = get_text(cfg, url)
+    url = _quota_url(nrc, period)
+    page = get_page(cfg, url)
+    return memoized_parse(cfg, QUOTA_MEMO, page, _parse_quota)
 
-    # Check valid response
-    if len(resp) < 1000:
-        log.warn("Too many request prevention")
-        sleep(5)
-        resp = get_text(cfg, url)
 
-    return parser.process(resp)
+async def banner_quota_async(cfg, nrc: str, period: str):
+    url = _quota_url(nrc, period)
+    page = await get_page_async(cfg, url)
+    return memoized_parse(cfg, QUOTA_MEMO, page, _parse_quota)
@@ -0,0 +1,850 @@
+import os
+import json
+import base64
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+import zlib
+import hashlib
+import multiprocessing
+from collections import Counter
+from queue import Empty
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger("scraper")
+
+# Tamaño maximo de los diccionarios entrenados (zlib no soporta mas de 32KB)
+ZSTD_DICT_SIZE = 112_640
+ZLIB_DICT_SIZE = 32_768
+# Cantidad de respuestas que se juntan antes de entrenar el primer diccionario
+TRAIN_SAMPLES = 256
+
+# Contadores de escrituras pendientes, ver `CacheWriter.pending`
+PENDING_STRIPES = 1024
+
+# Version del esquema del indice, si cambia el indice se reconstruye desde el log
+INDEX_SCHEMA = 2
+
+
+def enable_wal(db: sqlite3.Connection):
+    # Con WAL los workers leen el indice mientras el escritor hace commit. Si
+    # otro proceso esta cambiando el modo al mismo tiempo falla, pero el modo
+    # queda igual guardado en el archivo.
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.OperationalError:
+        pass
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CachedResponse(NamedTuple):
+    resp: str
+    fetched: float
+    # Hash del contenido y validadores HTTP (`etag`, `last-modified`) de la respuesta
+    hash: str
+    validators: dict
+
+
+def url_class(url: Optional[str]) -> str:
+    """Kind of page behind a request URL, used for cache policies."""
+    if not url:
+        return "other"
+    if "informacionVacReserva.ajax.php" in url:
+        return "quota"
+    if "buscacursos.uc.cl" in url:
+        return "search"
+    if "view=programa" in url:
+        return "program"
+    if "view=requisitos" in url:
+        return "requirements"
+    if "catalogo.uc.cl" in url:
+        return "catalogo"
+    return "other"
+
+
+def pending_stripe(key: str) -> int:
+    return int(key[:8], 16) % PENDING_STRIPES
+
+
+def default_codec() -> str:
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def train_dictionary(codec: str, samples: List[bytes]) -> bytes:
+    """Builds a compression dictionary out of sample responses.
+    Buscacursos and catalogo pages are mostly identical boilerplate, so a
+    dictionary lets every entry be compressed against that shared content.
+    """
+    if codec == "zstd":
+        return zstandard.train_dictionary(ZSTD_DICT_SIZE, samples).as_bytes()
+
+    # zlib no entrena diccionarios, armamos uno con las lineas que se repiten
+    # en la mayoria de las muestras. Las mas comunes van al final, que es donde
+    # zlib las encuentra con distancias mas cortas.
+    counts: Counter = Counter()
+    for sample in samples:
+        counts.update(set(sample.splitlines(keepends=True)))
+    common = [
+        line
+        for line, cnt in counts.most_common()
+        if cnt * 2 >= len(samples) and len(line.strip()) > 3
+    ]
+    zdict = b""
+    for line in common:
+        if len(zdict) + len(line) > ZLIB_DICT_SIZE:
+            break
+        zdict = line + zdict
+    return zdict
+
+
+def compress(codec: str, zdict: Optional[bytes], data: bytes) -> bytes:
+    if codec == "zstd":
+        if zdict is not None:
+            dict_data = zstandard.ZstdCompressionDict(zdict)
+            return zstandard.ZstdCompressor(level=19, dict_data=dict_data).compress(
+                data
+            )
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    if zdict is not None:
+        comp = zlib.compressobj(level=9, zdict=zdict)
+    else:
+        comp = zlib.compressobj(level=9)
+    return comp.compress(data) + comp.flush()
+
+
+def decompress(codec: str, zdict: Optional[bytes], data: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("cache entry is zstd-compressed but zstandard is missing")
+        if zdict is not None:
+            dict_data = zstandard.ZstdCompressionDict(zdict)
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+        return zstandard.ZstdDecompressor().decompress(data)
+    if zdict is not None:
+        decomp = zlib.decompressobj(zdict=zdict)
+    else:
+        decomp = zlib.decompressobj()
+    return decomp.decompress(data) + decomp.flush()
+
+
+class RequestCache:
+    """Append-only NDJSON log of responses (`.requestcache`) plus an SQLite
+    index (`.requestcache.idx`) that maps each key to the byte range of its
+    newest line, so lookups read a single line instead of loading the log.
+
+    Responses are stored compressed (`codec`, zstd or zlib) against the newest
+    dictionary line in the log. Entries written before compression existed
+    keep their plain `resp` field and are still readable.
+    """
+
+    path: str
+    index_path: str
+    codec: Optional[str]
+
+    def __init__(self, path: str = ".requestcache", codec: Optional[str] = "auto"):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.codec = default_codec() if codec == "auto" else codec
+        self._local = threading.local()
+        self._log = None
+        self._log_pid = None
+        self._dicts: Dict[int, bytes] = {}
+
+    def __getstate__(self):
+        return {"path": self.path, "codec": self.codec}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["codec"])
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # Una conexion por thread y por proceso, no sobreviven un fork
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.index_path, timeout=60)
+            enable_wal(db)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            row = db.execute("SELECT value FROM meta WHERE name = 'schema'").fetchone()
+            if row is None or row[0] != INDEX_SCHEMA:
+                db.execute("DROP TABLE IF EXISTS entries")
+                db.execute("DROP TABLE IF EXISTS dicts")
+                db.execute("DELETE FROM meta")
+                db.execute(
+                    "INSERT INTO meta (name, value) VALUES ('schema', ?)",
+                    (INDEX_SCHEMA,),
+                )
+            # `fetched` es cuando se descargo la respuesta, `atime` su ultimo uso
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                "offset INTEGER NOT NULL, length INTEGER NOT NULL, "
+                "cls TEXT NOT NULL, fetched REAL NOT NULL, atime REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+            # Contadores de uso del cache por tipo de pagina
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS stats (cls TEXT PRIMARY KEY, hits INTEGER, "
+                "revalidated INTEGER, misses INTEGER)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS dicts (id INTEGER PRIMARY KEY, "
+                "codec TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+            )
+            db.commit()
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    def close(self):
+        """Checkpoints the index into a single file and closes this thread's
+        handles, so the files can be moved.
+        """
+        local = self._local
+        if getattr(local, "pid", None) == os.getpid():
+            local.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            local.db.execute("PRAGMA journal_mode=DELETE")
+            local.db.close()
+            local.pid = None
+        if self._log_pid == os.getpid():
+            self._log.close()
+            self._log_pid = None
+
+    def _open(self):
+        if self._log_pid != os.getpid():
+            self._log = open(self.path, "a+b")
+            self._log_pid = os.getpid()
+
+    def _indexed_end(self) -> int:
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE name = 'indexed_end'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    def sync(self):
+        """Indexes lines appended to the log since the last indexed offset.
+        Only the first open of a legacy `.requestcache` has to scan the whole file.
+        """
+        self._open()
+        size = os.path.getsize(self.path)
+        start = self._indexed_end()
+        if size == start:
+            return
+        if size < start:
+            log.warning("%s shrank, rebuilding its index", self.path)
+            self._db.execute("DELETE FROM entries")
+            self._db.execute("DELETE FROM dicts")
+            start = 0
+
+        log.info("indexing %s bytes of %s", size - start, self.path)
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            offset = start
+            batch = []
+            dicts = []
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Linea a medio escribir, se indexa en el proximo sync
+                    break
+                try:
+                    obj = json.loads(line)
+                    if "dict" in obj:
+                        dicts.append((obj["dict"], obj["z"], offset, len(line)))
+                    else:
+                        batch.append(self._row(obj, offset, len(line)))
+                except (json.JSONDecodeError, KeyError, UnicodeDecodeError):
+                    pass
+                offset += len(line)
+                if len(batch) >= 10_000:
+                    self._insert(batch, offset, dicts)
+                    batch = []
+                    dicts = []
+            self._insert(batch, offset, dicts)
+
+    @staticmethod
+    def _row(entry: dict, offset: int, length: int) -> tuple:
+        # Las entradas antiguas no tienen fecha, se consideran descargadas en 0
+        req = entry.get("req") or {}
+        fetched = entry.get("t", 0)
+        cls = url_class(req.get("url"))
+        return (entry["key"], offset, length, cls, fetched, fetched)
+
+    def _insert(self, batch, end: int, dicts=()):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO dicts (id, codec, offset, length) "
+            "VALUES (?, ?, ?, ?)",
+            dicts,
+        )
+        self._db.executemany(
+            "INSERT OR REPLACE INTO entries (key, offset, length, cls, fetched, atime) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            batch,
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES ('indexed_end', ?)",
+            (end,),
+        )
+        self._db.commit()
+
+    def _read_line(self, offset: int, length: int) -> dict:
+        self._open()
+        return json.loads(os.pread(self._log.fileno(), length, offset))
+
+    def dictionary(self, dict_id: int) -> bytes:
+        zdict = self._dicts.get(dict_id)
+        if zdict is None:
+            row = self._db.execute(
+                "SELECT offset, length FROM dicts WHERE id = ?", (dict_id,)
+            ).fetchone()
+            if row is None:
+                raise Exception(f"cache dictionary {dict_id} is missing")
+            zdict = base64.b64decode(self._read_line(*row)["data"])
+            self._dicts[dict_id] = zdict
+        return zdict
+
+    def current_dictionary(self) -> Optional[int]:
+        """Id of the newest dictionary for this cache's codec, if any."""
+        row = self._db.execute(
+            "SELECT max(id) FROM dicts WHERE codec = ?", (self.codec,)
+        ).fetchone()
+        return row[0]
+
+    def decode(self, entry: dict) -> str:
+        if "resp" in entry:
+            return entry["resp"]
+        zdict = None
+        if entry.get("d") is not None:
+            zdict = self.dictionary(entry["d"])
+        data = base64.b64decode(entry["data"])
+        return decompress(entry["z"], zdict, data).decode("utf-8")
+
+    def encode(self, key: str, resp: str, req, fetched, validators, dict_id) -> dict:
+        entry = {"key": key, "req": req, "t": fetched, "h": content_hash(resp)}
+        if validators:
+            entry["v"] = validators
+        if self.codec is None:
+            entry["resp"] = resp
+            return entry
+        zdict = self.dictionary(dict_id) if dict_id is not None else None
+        data = compress(self.codec, zdict, resp.encode("utf-8"))
+        entry["z"] = self.codec
+        entry["d"] = dict_id
+        entry["data"] = base64.b64encode(data).decode("ascii")
+        return entry
+
+    def get_entry(self, key: str) -> Optional[CachedResponse]:
+        """Returns the cached response with its metadata, however old it is."""
+        row = self._db.execute(
+            "SELECT offset, length, fetched FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        offset, length, fetched = row
+        entry = self._read_line(offset, length)
+        resp = self.decode(entry)
+        return CachedResponse(
+            resp, fetched, entry.get("h") or content_hash(resp), entry.get("v") or {}
+        )
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[str]:
+        """Returns the cached response, or None if it is missing or was
+        fetched more than `max_age` seconds ago.
+        """
+        row = self._db.execute(
+            "SELECT offset, length, fetched FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        offset, length, fetched = row
+        if max_age is not None and time.time() - fetched > max_age:
+            return None
+        return self.decode(self._read_line(offset, length))
+
+    def refresh_many(self, keys: List[Tuple[float, str]]):
+        """Marks `(fetched, key)` entries as fetched again, for responses that
+        were revalidated without changes.
+        """
+        self._db.executemany(
+            "UPDATE entries SET fetched = ?1, atime = max(atime, ?1) WHERE key = ?2",
+            keys,
+        )
+        self._db.commit()
+
+    def count(self, counts: Dict[Tuple[str, str], int]):
+        """Adds `{(cls, "hits" | "revalidated" | "misses"): n}` to the usage stats."""
+        for (cls, counter), n in counts.items():
+            self._db.execute(
+                "INSERT OR IGNORE INTO stats (cls, hits, revalidated, misses) "
+                "VALUES (?, 0, 0, 0)",
+                (cls,),
+            )
+            self._db.execute(
+                f"UPDATE stats SET {counter} = {counter} + ? WHERE cls = ?", (n, cls)
+            )
+        self._db.commit()
+
+    def stats(self) -> Dict[str, dict]:
+        """Entry count, live bytes and hit counters per page kind."""
+        out: Dict[str, dict] = {}
+        for cls, entries, size in self._db.execute(
+            "SELECT cls, count(*), sum(length) FROM entries GROUP BY cls"
+        ):
+            out[cls] = {"entries": entries, "bytes": size}
+        for cls, hits, revalidated, misses in self._db.execute(
+            "SELECT cls, hits, revalidated, misses FROM stats"
+        ):
+            row = out.setdefault(cls, {"entries": 0, "bytes": 0})
+            row.update(hits=hits, revalidated=revalidated, misses=misses)
+        return out
+
+    def touch_many(self, keys: List[Tuple[float, str]]):
+        """Records `(atime, key)` accesses, used for LRU eviction."""
+        self._db.executemany(
+            "UPDATE entries SET atime = max(atime, ?) WHERE key = ?", keys
+        )
+        self._db.commit()
+
+    def live_bytes(self) -> int:
+        row = self._db.execute("SELECT coalesce(sum(length), 0) FROM entries")
+        return row.fetchone()[0]
+
+    def evict(self, max_bytes: int) -> int:
+        """Drops the least recently used entries from the index until the live
+        entries fit in `max_bytes`. Their bytes stay in the log until it is
+        rewritten. Returns the number of evicted entries.
+        """
+        excess = self.live_bytes() - max_bytes
+        if excess <= 0:
+            return 0
+        evicted = []
+        for key, length in self._db.execute(
+            "SELECT key, length FROM entries ORDER BY atime"
+        ):
+            evicted.append((key,))
+            excess -= length
+            if excess <= 0:
+                break
+        self._db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self._db.commit()
+        log.info("evicted %s cache entries", len(evicted))
+        return len(evicted)
+
+    def put(self, key: str, resp: str, req: Optional[dict] = None):
+        self.put_many([(key, resp, req, time.time(), None)])
+
+    def _append(self, lines: List[bytes]) -> int:
+        """Appends raw lines with a single write, returns their starting offset."""
+        self._open()
+        self._log.seek(0, os.SEEK_END)
+        offset = self._log.tell()
+        if offset > 0 and os.pread(self._log.fileno(), 1, offset - 1) != b"\n":
+            # Cerramos una linea cortada de una ejecucion anterior
+            self._log.write(b"\n")
+            self._log.flush()
+            offset += 1
+        if self._indexed_end() < offset:
+            self.sync()
+        self._log.write(b"".join(lines))
+        self._log.flush()
+        return offset
+
+    def put_many(self, entries: List[tuple]):
+        """Appends `(key, resp, req, fetched, validators)` entries with a single
+        write and a single index transaction. `req` describes the request
+        (method, url and form params, never cookies) and `validators` holds its
+        `etag`/`last-modified` headers. Only one writer may append at a time.
+        """
+        dict_id = self.current_dictionary() if self.codec else None
+        lines = []
+        rows = []
+        for key, resp, req, fetched, validators in entries:
+            entry = self.encode(key, resp, req, fetched, validators, dict_id)
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+            lines.append(line)
+            rows.append(entry)
+        offset = self._append(lines)
+        for i, (entry, line) in enumerate(zip(rows, lines)):
+            rows[i] = self._row(entry, offset, len(line))
+            offset += len(line)
+        self._insert(rows, offset)
+
+    def add_dictionary(self, zdict: bytes) -> int:
+        """Appends a new dictionary for this cache's codec and makes it current."""
+        row = self._db.execute("SELECT max(id) FROM dicts").fetchone()
+        dict_id = (row[0] or 0) + 1
+        data = base64.b64encode(zdict).decode("ascii")
+        line = json.dumps({"dict": dict_id, "z": self.codec, "data": data})
+        line = (line + "\n").encode("utf-8")
+        offset = self._append([line])
+        self._insert([], offset + len(line), [(dict_id, self.codec, offset, len(line))])
+        self._dicts[dict_id] = zdict
+        return dict_id
+
+
+class CacheWriter:
+    """Single writer for a RequestCache. Every process sends its new entries
+    through `queue`, and a thread in the owning process appends them in
+    batches (group commit), so the log is written in large sequential chunks
+    and an entry fetched by any worker becomes visible to all of them.
+
+    Messages are `("put", key, resp, req, fetched, validators)`,
+    `("touch", key, atime, cls)` for cache hits and `("refresh", key, fetched,
+    cls)` for revalidated entries.
+    If `max_bytes` is set, the least recently used entries are evicted from
+    the index every `evict_interval` seconds.
+
+    `pending[pending_stripe(key)]` counts the puts and refreshes sent for keys
+    of that stripe that are not committed yet. Senders increment it and the
+    writer decrements it after committing, so a process can wait until an
+    entry another one just fetched is readable from the index.
+    """
+
+    store: RequestCache
+    queue: "multiprocessing.Queue"
+
+    def __init__(
+        self,
+        store: RequestCache,
+        batch_size: int = 512,
+        max_delay: float = 0.05,
+        max_bytes: Optional[int] = None,
+        evict_interval: float = 30,
+    ):
+        self.store = store
+        self.queue = multiprocessing.Queue()
+        self.pending = multiprocessing.Array("i", PENDING_STRIPES)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self._thread = None
+        self._samples: List[bytes] = []
+        self._last_evict = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="cache-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Commits every queued message and stops the writer thread."""
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self.max_bytes is not None:
+            self.store.evict(self.max_bytes)
+
+    def _train(self, puts):
+        # Las primeras respuestas de un cache sin diccionario se usan para entrenarlo
+        store = self.store
+        if store.codec is None or self._samples is None:
+            return
+        if store.current_dictionary() is not None:
+            self._samples = None
+            return
+        self._samples.extend(put[1].encode("utf-8") for put in puts)
+        if len(self._samples) >= TRAIN_SAMPLES:
+            log.info("training %s cache dictionary", store.codec)
+            store.add_dictionary(train_dictionary(store.codec, self._samples))
+            self._samples = None
+
+    def _commit(self, batch):
+        puts = [msg[1:] for msg in batch if msg[0] == "put"]
+        touches = [(msg[2], msg[1]) for msg in batch if msg[0] == "touch"]
+        refreshes = [(msg[2], msg[1]) for msg in batch if msg[0] == "refresh"]
+        if puts:
+            self._train(puts)
+            self.store.put_many(puts)
+        if touches:
+            self.store.touch_many(touches)
+        if refreshes:
+            self.store.refresh_many(refreshes)
+
+        counts: Counter = Counter()
+        for msg in batch:
+            if msg[0] == "put":
+                counts[url_class((msg[3] or {}).get("url")), "misses"] += 1
+            elif msg[0] == "touch":
+                counts[msg[3], "hits"] += 1
+            elif msg[0] == "refresh":
+                counts[msg[3], "revalidated"] += 1
+        self.store.count(counts)
+        now = time.monotonic()
+        if self.max_bytes is not None and now - self._last_evict > self.evict_interval:
+            self._last_evict = now
+            self.store.evict(self.max_bytes)
+
+    def _run(self):
+        running = True
+        while running:
+            msg = self.queue.get()
+            if msg is None:
+                break
+            batch = [msg]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    msg = self.queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if msg is None:
+                    running = False
+                    break
+                batch.append(msg)
+            try:
+                self._commit(batch)
+            except Exception:
+                log.error("writing %s cache messages failed:", len(batch))
+                log.error(traceback.format_exc())
+            with self.pending.get_lock():
+                for msg in batch:
+                    if msg[0] in ("put", "refresh"):
+                        self.pending[pending_stripe(msg[1])] -= 1
+
+
+def _remove_index(index_path: str):
+    for p in (index_path, index_path + "-wal", index_path + "-shm"):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def _replace_cache(tmp: RequestCache, path: str):
+    # Sin indice el log se reindexa en la proxima ejecucion, asi que nunca
+    # queda un indice apuntando a un log distinto si esto se interrumpe
+    tmp.close()
+    _remove_index(path + ".idx")
+    os.replace(tmp.path, path)
+    os.replace(tmp.index_path, path + ".idx")
+
+
+def _new_cache(path: str, codec: Optional[str]) -> RequestCache:
+    if os.path.exists(path):
+        os.remove(path)
+    _remove_index(path + ".idx")
+    return RequestCache(path, codec)
+
+
+def iter_entries(cache: RequestCache):
+    """Streams the entries of a cache log in order, skipping dictionary and
+    corrupt lines. Yields `(entry, resp)` with the response already decoded.
+    """
+    cache.sync()
+    with open(cache.path, "rb") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+                if "dict" in entry:
+                    continue
+                yield entry, cache.decode(entry)
+            except Exception:
+                continue
+
+
+def _live_entries(src: RequestCache):
+    """The entries the index points to (the newest, non-evicted one of each
+    key) in log order, as `(row, line, entry)` with the index row. `entry` is
+    None for a corrupt line.
+    """
+    src.sync()
+    src._open()
+    for row in src._db.execute(
+        "SELECT key, offset, length, cls, fetched, atime FROM entries "
+        "ORDER BY offset"
+    ).fetchall():
+        key, offset, length = row[:3]
+        line = os.pread(src._log.fileno(), length, offset)
+        try:
+            entry = json.loads(line)
+            if entry["key"] != key:
+                raise ValueError(key)
+        except (ValueError, KeyError, UnicodeDecodeError):
+            entry = None
+        yield row, line, entry
+
+
+def compress_cache(path: str = ".requestcache", codec: Optional[str] = "auto"):
+    """Rewrites a cache log so every live entry is compressed with `codec`
+    against a dictionary trained on them. Like `compact_cache`, superseded
+    and evicted entries are dropped and the index rows and stats are carried
+    over. Returns the old and new sizes.
+    """
+    src = RequestCache(path)
+    codec = default_codec() if codec == "auto" else codec
+
+    samples = []
+    live = 0
+    for _, _, entry in _live_entries(src):
+        if entry is None:
+            continue
+        resp = src.decode(entry).encode("utf-8")
+        # Muestreo uniforme por reservorio
+        if len(samples) < TRAIN_SAMPLES * 4:
+            samples.append(resp)
+        else:
+            j = int.from_bytes(os.urandom(4), "little") % (live + 1)
+            if j < len(samples):
+                samples[j] = resp
+        live += 1
+
+    tmp = _new_cache(path + ".tmp", codec)
+    dict_id = None
+    if samples:
+        log.info("training %s dictionary on %s samples", codec, len(samples))
+        dict_id = tmp.add_dictionary(train_dictionary(codec, samples))
+    lines = []
+    rows = []
+    for (key, _, _, cls, fetched, atime), _, entry in _live_entries(src):
+        if entry is None:
+            continue
+        resp = src.decode(entry)
+        new = tmp.encode(
+            key, resp, entry.get("req"), entry.get("t", 0), entry.get("v"), dict_id
+        )
+        lines.append((json.dumps(new, ensure_ascii=False) + "\n").encode("utf-8"))
+        rows.append((key, cls, fetched, atime))
+        if len(lines) >= 1000:
+            _append_rows(tmp, lines, rows)
+            lines = []
+            rows = []
+    _append_rows(tmp, lines, rows)
+    _copy_stats(src, tmp)
+
+    old_size = os.path.getsize(path)
+    new_size = os.path.getsize(tmp.path)
+    _replace_cache(tmp, path)
+    return old_size, new_size
+
+
+def _append_rows(tmp: RequestCache, lines: List[bytes], rows: List[tuple]):
+    # Como `put_many`, pero con la fila del indice original de cada entrada
+    offset = tmp._append(lines)
+    index = []
+    for line, (key, cls, fetched, atime) in zip(lines, rows):
+        index.append((key, offset, len(line), cls, fetched, atime))
+        offset += len(line)
+    tmp._insert(index, offset)
+
+
+def _copy_dictionaries(src: RequestCache, tmp: RequestCache, out):
+    src._open()
+    dicts = []
+    for dict_id, codec, offset, length in src._db.execute(
+        "SELECT id, codec, offset, length FROM dicts ORDER BY id"
+    ).fetchall():
+        dicts.append((dict_id, codec, out.tell(), length))
+        out.write(os.pread(src._log.fileno(), length, offset))
+    tmp._insert([], out.tell(), dicts)
+
+
+def _copy_stats(src: RequestCache, tmp: RequestCache):
+    stats = src._db.execute(
+        "SELECT cls, hits, revalidated, misses FROM stats"
+    ).fetchall()
+    tmp._db.executemany("INSERT INTO stats VALUES (?, ?, ?, ?)", stats)
+    tmp._db.commit()
+
+
+def compact_cache(path: str = ".requestcache"):
+    """Rewrites a cache log keeping only the newest, non-evicted entry of
+    each key and the dictionaries, dropping corrupt lines. The index is
+    carried over, so fetch times, access times and stats are preserved.
+    Must not run while a scrape is using the cache. Returns the old and new sizes.
+    """
+    src = RequestCache(path)
+    src.sync()
+    tmp = _new_cache(path + ".tmp", src.codec)
+    dropped = 0
+
+    with open(tmp.path, "wb") as out:
+        _copy_dictionaries(src, tmp, out)
+
+        rows = []
+        for (key, _, length, cls, fetched, atime), line, entry in _live_entries(src):
+            if entry is None:
+                dropped += 1
+                continue
+            rows.append((key, out.tell(), length, cls, fetched, atime))
+            out.write(line)
+            if len(rows) >= 10_000:
+                tmp._insert(rows, out.tell())
+                rows = []
+        tmp._insert(rows, out.tell())
+
+    _copy_stats(src, tmp)
+
+    if dropped:
+        log.warning("dropped %s corrupt cache entries", dropped)
+    old_size = os.path.getsize(path)
+    new_size = os.path.getsize(tmp.path)
+    _replace_cache(tmp, path)
+    return old_size, new_size
+
+
+def rekey_cache(
+    path: str,
+    rekey: Callable[[str, Optional[dict]], Optional[Tuple[str, dict]]],
+):
+    """Rewrites the keys of every live entry of a cache log, for when the way
+    keys are computed changes. `rekey(key, req)` returns the new key and
+    request of an entry, or None to keep it as is. Legacy entries without a
+    stored request get `req` filled in if `rekey` recognizes them. If several
+    entries end up with the same key, only the most recently fetched one is
+    kept. Returns how many entries were rekeyed and how many were left as is.
+    """
+    src = RequestCache(path)
+
+    best: Dict[str, tuple] = {}
+    rekeyed = kept = 0
+    for (key, offset, length, cls, fetched, atime), _, entry in _live_entries(src):
+        if entry is None:
+            continue
+        new = rekey(key, entry.get("req"))
+        if new is None:
+            new_key, req = key, entry.get("req")
+            kept += 1
+        else:
+            new_key, req = new
+            rekeyed += 1
+        if req:
+            cls = url_class(req.get("url"))
+        other = best.get(new_key)
+        if other is None or other[0] <= fetched:
+            best[new_key] = (fetched, offset, length, req, cls, atime)
+
+    tmp = _new_cache(path + ".tmp", src.codec)
+    with open(tmp.path, "wb") as out:
+        _copy_dictionaries(src, tmp, out)
+        rows = []
+        winners = sorted(best.items(), key=lambda item: item[1][1])
+        for new_key, (fetched, offset, length, req, cls, atime) in winners:
+            entry = json.loads(os.pread(src._log.fileno(), length, offset))
+            entry["key"] = new_key
+            if req:
+                entry["req"] = req
+            line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+            rows.append((new_key, out.tell(), len(line), cls, fetched, atime))
+            out.write(line)
+            if len(rows) >= 10_000:
+                tmp._insert(rows, out.tell())
+                rows = []
+        tmp._insert(rows, out.tell())
+    _copy_stats(src, tmp)
+
+    _replace_cache(tmp, path)
+    return rekeyed, kept
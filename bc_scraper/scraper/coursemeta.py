@@ -0,0 +1,153 @@
+import os
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional, Tuple
+
+from .cache import enable_wal
+from .programs import get_program, get_program_async
+from .request import cache_ttl
+from .requirements import get_requirements, get_requirements_async
+
+# Programa y requisitos de cada sigla. No dependen del periodo, asi que se
+# comparten entre periodos y entre los scrapers de buscacursos y catalogo.
+
+
+class CourseMeta(NamedTuple):
+    program: str
+    req: str
+    conn: str
+    restr: str
+    equiv: str
+    fetched: float
+
+
+class CourseStore:
+    """Persistent map from a sigla to its `CourseMeta`. Safe to share
+    between threads and worker processes.
+    """
+
+    path: str
+
+    def __init__(self, path: str = ".coursemeta"):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # Una conexion por thread y por proceso, no sobreviven un fork
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            enable_wal(db)
+            columns = [row[1] for row in db.execute("PRAGMA table_info(courses)")]
+            if "hash" in columns:
+                # Version anterior del store, se vuelve a llenar
+                db.execute("DROP TABLE courses")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS courses (initials TEXT PRIMARY KEY, "
+                "program TEXT NOT NULL, req TEXT NOT NULL, conn TEXT NOT NULL, "
+                "restr TEXT NOT NULL, equiv TEXT NOT NULL, fetched REAL NOT NULL)"
+            )
+            db.commit()
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    def get(self, initials: str) -> Optional[CourseMeta]:
+        row = self._db.execute(
+            "SELECT program, req, conn, restr, equiv, fetched FROM courses "
+            "WHERE initials = ?",
+            (initials,),
+        ).fetchone()
+        return CourseMeta(*row) if row else None
+
+    def put(self, initials: str, program: str, reqs: Tuple[str, str, str, str]):
+        self._db.execute(
+            "INSERT OR REPLACE INTO courses "
+            "(initials, program, req, conn, restr, equiv, fetched) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (initials, program, *reqs, time.time()),
+        )
+        self._db.commit()
+
+
+_store: Optional[CourseStore] = None
+
+
+def get_course_store(cfg) -> Optional[CourseStore]:
+    """Like the parse memo, the store shares the fate of the request cache:
+    it is disabled by `--disable-cache`.
+    """
+    global _store
+    if cfg.get("disable-cache"):
+        return None
+    if _store is None:
+        _store = CourseStore()
+    return _store
+
+
+def _fresh(cfg, meta: CourseMeta) -> bool:
+    # Vale lo que la pagina que vence antes, requisitos por defecto
+    ttls = [cache_ttl(cfg, cls) for cls in ("program", "requirements")]
+    ttls = [ttl for ttl in ttls if ttl is not None]
+    return not ttls or time.time() - meta.fetched < min(ttls)
+
+
+def _lookup(cfg, initials):
+    # Solo se guardan y usan entradas completas, con programa y requisitos
+    store = get_course_store(cfg)
+    complete = cfg.get("fetch-program") and cfg.get("fetch-requirements")
+    if store is None or not complete:
+        return None, None
+    meta = store.get(initials)
+    if meta is not None and _fresh(cfg, meta):
+        return store, (meta.program, (meta.req, meta.conn, meta.restr, meta.equiv))
+    return store, None
+
+
+def course_meta(cfg, initials: str) -> Tuple[str, Tuple[str, str, str, str]]:
+    """`(program, (req, conn, restr, equiv))` of a sigla, from the store if
+    it was fetched recently (by any period or scraper), or fetched and
+    stored. Skipped parts (`--skip-program`, `--skip-requirements`) are
+    empty.
+    """
+    store, meta = _lookup(cfg, initials)
+    if meta is not None:
+        return meta
+    program = get_program(cfg, initials) if cfg.get("fetch-program") else ""
+    reqs = ("", "", "", "")
+    if cfg.get("fetch-requirements"):
+        reqs = get_requirements(cfg, initials)
+    if store is not None:
+        store.put(initials, program, reqs)
+    return program, reqs
+
+
+async def _empty(value):
+    return value
+
+
+async def course_meta_async(
+    cfg, initials: str
+) -> Tuple[str, Tuple[str, str, str, str]]:
+    store, meta = _lookup(cfg, initials)
+    if meta is not None:
+        return meta
+    # El programa y los requisitos se piden a la vez
+    program, reqs = await asyncio.gather(
+        get_program_async(cfg, initials) if cfg.get("fetch-program") else _empty(""),
+        get_requirements_async(cfg, initials)
+        if cfg.get("fetch-requirements")
+        else _empty(("", "", "", "")),
+    )
+    if store is not None:
+        store.put(initials, program, reqs)
+    return program, reqs
@@ -0,0 +1,163 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from .cache import content_hash, enable_wal
+
+# Resultados de parsear una pagina, indexados por el hash de su contenido.
+# Una pagina identica a una ya vista no se vuelve a parsear.
+
+# Entradas como maximo, sobre eso se borran las guardadas hace mas tiempo
+MEMO_MAX_ENTRIES = 200_000
+# Cada cuantas entradas nuevas se revisa el maximo
+MEMO_TRIM_EVERY = 1000
+
+
+def memo_kind(name: str, version: int) -> str:
+    """Memo kind of the parser `name`. Bump `version` whenever what the
+    parser returns changes: pages memoized by an older version are parsed
+    again, and their entries are dropped.
+    """
+    return f"{name}@{version}"
+
+
+class Memo:
+    """Persistent map from `(kind, content hash)` to a JSON-serializable value.
+    Safe to share between threads and worker processes. Holds at most
+    `max_entries`, the oldest ones are dropped first.
+    """
+
+    path: str
+
+    def __init__(self, path: str = ".parsememo", max_entries: int = MEMO_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        # Tipos cuyas versiones anteriores ya se borraron en este proceso
+        self._current = set()
+        self._puts = 0
+
+    def __getstate__(self):
+        return {"path": self.path, "max_entries": self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_entries"])
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        # Una conexion por thread y por proceso, no sobreviven un fork
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60)
+            enable_wal(db)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS memo (kind TEXT NOT NULL, "
+                "hash TEXT NOT NULL, value TEXT NOT NULL, "
+                "created REAL NOT NULL DEFAULT 0, PRIMARY KEY (kind, hash))"
+            )
+            columns = [row[1] for row in db.execute("PRAGMA table_info(memo)")]
+            if "created" not in columns:
+                # Memo de antes de tener tope, sus entradas son las mas antiguas
+                db.execute(
+                    "ALTER TABLE memo ADD COLUMN created REAL NOT NULL DEFAULT 0"
+                )
+            db.execute("CREATE INDEX IF NOT EXISTS memo_created ON memo (created)")
+            db.commit()
+            local.db = db
+            local.pid = os.getpid()
+            self._trim()
+        return local.db
+
+    def _trim(self):
+        db = self._local.db
+        entries = db.execute("SELECT count(*) FROM memo").fetchone()[0]
+        excess = entries - self.max_entries
+        if excess > 0:
+            db.execute(
+                "DELETE FROM memo WHERE rowid IN "
+                "(SELECT rowid FROM memo ORDER BY created LIMIT ?)",
+                (excess,),
+            )
+            db.commit()
+
+    def _drop_old_versions(self, kind: str):
+        # Tambien las de antes de versionar, sin `@`
+        name = kind.partition("@")[0]
+        self._db.execute(
+            "DELETE FROM memo WHERE kind != ? AND (kind = ? OR substr(kind, 1, ?) = ?)",
+            (kind, name, len(name) + 1, f"{name}@"),
+        )
+        self._current.add(kind)
+
+    def get(self, kind: str, hash: str) -> Optional[Any]:
+        row = self._db.execute(
+            "SELECT value FROM memo WHERE kind = ? AND hash = ?", (kind, hash)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, kind: str, hash: str, value: Any):
+        if kind not in self._current:
+            self._drop_old_versions(kind)
+        self._db.execute(
+            "INSERT OR REPLACE INTO memo (kind, hash, value, created) "
+            "VALUES (?, ?, ?, ?)",
+            (kind, hash, json.dumps(value, ensure_ascii=False), time.time()),
+        )
+        self._db.commit()
+        self._puts += 1
+        if self._puts % MEMO_TRIM_EVERY == 0:
+            self._trim()
+
+
+_memo: Optional[Memo] = None
+
+
+def get_memo(cfg) -> Optional[Memo]:
+    """The parse memo shares the fate of the request cache: it is disabled
+    by `--disable-cache`.
+    """
+    global _memo
+    if cfg.get("disable-cache"):
+        return None
+    if _memo is None:
+        _memo = Memo()
+    return _memo
+
+
+def memoized_parse(cfg, kind: str, page, parse):
+    """Returns `parse(page.text)`, reusing the result stored for an identical
+    page if there is one, or the one of a page parsed while it downloaded.
+    """
+    memo = get_memo(cfg)
+    if page.parsed is not None:
+        value = page.parsed
+        if memo is not None:
+            memo.put(kind, page.hash, value)
+        return value
+    if memo is not None:
+        value = memo.get(kind, page.hash)
+        if value is not None:
+            return value
+    value = parse(page.text)
+    if memo is not None:
+        memo.put(kind, page.hash, value)
+    return value
+
+
+def memoized_text(cfg, kind: str, text: str, parse):
+    """Like `memoized_parse`, for text that is not a whole page (eg. part of
+    one), keyed by the hash of `text` itself.
+    """
+    memo = get_memo(cfg)
+    hash = content_hash(text)
+    if memo is not None:
+        value = memo.get(kind, hash)
+        if value is not None:
+            return value
+    value = parse(text)
+    if memo is not None:
+        memo.put(kind, hash, value)
+    return value
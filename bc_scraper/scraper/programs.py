@@ -1,5 +1,33 @@
+import re
+import unicodedata
+from html import unescape
 from html.parser import HTMLParser
-from .request import get_text
+from typing import Dict
+
+from .memo import memo_kind, memoized_text
+from .request import get_text, get_text_async
+
+# Secciones de un programa, reconocidas por palabras en el titulo (sin tildes).
+# El orden importa: "METODOLOGIA PARA EL APRENDIZAJE" es metodologia y
+# "EVALUACION DE APRENDIZAJES" es evaluacion.
+PROGRAM_SECTIONS = [
+    ("description", ("DESCRIPCION", "DESCRIPTION")),
+    (
+        "objectives",
+        ("OBJETIVO", "OBJECTIVE", "RESULTADOS DE APRENDIZAJE", "LEARNING OUTCOMES",
+         "COMPETENCIAS"),
+    ),
+    ("contents", ("CONTENIDO", "CONTENT")),
+    ("methodology", ("METODOLOG", "METHODOLOG")),
+    ("evaluation", ("EVALUA", "ASSESSMENT")),
+    ("bibliography", ("IBLIOGRA",)),
+]
+
+# Version de `parse_program` en `.parsememo`
+PROGRAM_MEMO = memo_kind("program-sections", 1)
+
+# Titulos de seccion como "I. DESCRIPCIÓN", "II.RESULTADOS DE APRENDIZAJE"
+_HEADER = re.compile(r"(?m)^([IVXLCDM]+)[\.\s]+(.{3,100})$")
 
 
 class _ProgramParser(HTMLParser):
@@ -32,10 +60,67 @@ class _ProgramParser(HTMLParser):
             self.text += data
 
 
-def get_program(cfg, initials):
-    parser = _ProgramParser()
-    query = (
+def _section_name(title: str):
+    title = unicodedata.normalize("NFKD", title.upper())
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    for name, words in PROGRAM_SECTIONS:
+        if any(word in title for word in words):
+            return name
+    return None
+
+
+def parse_program(program: str) -> Dict[str, str]:
+    """Splits a program (as returned by `get_program`) into its sections, named
+    as in `PROGRAM_SECTIONS`. The text before the first section (course name,
+    credits, etc.) goes to `header`. Headers of unknown sections stay in the
+    text of the previous section.
+    """
+    text = unescape(re.sub(r"<[^>]+>", "", program))
+    text = re.sub(r"\r\n?", "\n", text)
+    text = re.sub(r"\t+", " ", text)
+
+    headers = []
+    for match in _HEADER.finditer(text):
+        name = _section_name(match.group(2))
+        if name is not None:
+            headers.append((match, name))
+
+    sections: Dict[str, str] = {}
+    end = headers[0][0].start() if headers else len(text)
+    if text[:end].strip():
+        sections["header"] = text[:end].strip()
+    for i, (match, name) in enumerate(headers):
+        end = headers[i + 1][0].start() if i + 1 < len(headers) else len(text)
+        body = text[match.end() : end].strip()
+        if name in sections:
+            # Secciones repetidas (o con el titulo partido) se juntan
+            body = f"{sections[name]}\n\n{body}".strip()
+        sections[name] = body
+    return sections
+
+
+def program_sections(cfg, program: str) -> Dict[str, str]:
+    """`parse_program`, memoized by the hash of the program text, so programs
+    seen before (in any period) are not parsed again.
+    """
+    if not program:
+        return {}
+    return memoized_text(cfg, PROGRAM_MEMO, program, parse_program)
+
+
+def _program_url(initials):
+    return (
         f"http://catalogo.uc.cl/index.php?tmpl=component&view=programa&sigla={initials}"
     )
-    text = get_text(cfg, query)
+
+
+def get_program(cfg, initials):
+    parser = _ProgramParser()
+    text = get_text(cfg, _program_url(initials))
+    return parser.process(text)
+
+
+async def get_program_async(cfg, initials):
+    parser = _ProgramParser()
+    text = await get_text_async(cfg, _program_url(initials))
     return parser.process(text)
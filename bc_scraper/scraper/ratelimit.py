@@ -0,0 +1,146 @@
+import time
+import logging
+import multiprocessing
+
+log = logging.getLogger("scraper")
+
+
+class RateLimiter:
+    """Token bucket with an AIMD concurrency window, shared by every process
+    that receives it (pass it through the pool initializer).
+
+    `acquire` blocks until there is a token and a free slot in the window.
+    `release` reports how the request went: successes grow the rate and the
+    window, doubling them every second until the first throttle (slow start)
+    and additively after that (about +1 per second / per round trip), throttle
+    responses halve both and pause every process for a backoff, requests that
+    got no response only halve them, and when recent latency climbs well above
+    its long-term average the window shrinks a little, since requests are
+    queueing on the server.
+    Decreases happen at most once per `epoch` seconds, so a burst of throttled
+    responses to requests sent together only counts once.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        min_rate: float = 0.2,
+        max_rate: float = 200.0,
+        window: float = 16.0,
+        max_window: float = 256.0,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        epoch: float = 1.0,
+        latency_factor: float = 2.0,
+    ):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.max_window = max_window
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.epoch = epoch
+        self.latency_factor = latency_factor
+
+        # Todo el estado vive en memoria compartida, protegido por `_lock`
+        self._lock = multiprocessing.Lock()
+        self._rate = multiprocessing.Value("d", rate, lock=False)
+        self._tokens = multiprocessing.Value("d", 1.0, lock=False)
+        self._stamp = multiprocessing.Value("d", time.time(), lock=False)
+        self._window = multiprocessing.Value("d", window, lock=False)
+        self._inflight = multiprocessing.Value("i", 0, lock=False)
+        self._latency = multiprocessing.Value("d", 0.0, lock=False)
+        self._baseline = multiprocessing.Value("d", 0.0, lock=False)
+        self._backoff = multiprocessing.Value("d", backoff, lock=False)
+        self._paused_until = multiprocessing.Value("d", 0.0, lock=False)
+        self._last_decrease = multiprocessing.Value("d", 0.0, lock=False)
+        self._slow_start = multiprocessing.Value("b", 1, lock=False)
+
+    @property
+    def rate(self) -> float:
+        return self._rate.value
+
+    @property
+    def window(self) -> float:
+        return self._window.value
+
+    def _refill(self, now: float):
+        burst = max(1.0, self._rate.value)
+        elapsed = max(0.0, now - self._stamp.value)
+        tokens = self._tokens.value + elapsed * self._rate.value
+        self._tokens.value = min(burst, tokens)
+        self._stamp.value = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now < self._paused_until.value:
+                    wait = self._paused_until.value - now
+                elif self._inflight.value >= int(self._window.value):
+                    wait = 0.05
+                elif self._tokens.value < 1.0:
+                    wait = (1.0 - self._tokens.value) / self._rate.value
+                else:
+                    self._tokens.value -= 1.0
+                    self._inflight.value += 1
+                    return
+            time.sleep(min(max(wait, 0.005), 1.0))
+
+    def _decrease(self, now: float, factor: float, rate: bool = True) -> bool:
+        if now - self._last_decrease.value < self.epoch:
+            return False
+        self._last_decrease.value = now
+        self._slow_start.value = 0
+        if rate:
+            self._rate.value = max(self.min_rate, self._rate.value * factor)
+        self._window.value = max(1.0, self._window.value * factor)
+        return True
+
+    def release(self, latency: float, throttled: bool = False, failed: bool = False):
+        """Reports the end of a request that took `latency` seconds.
+        `throttled` is set for throttle responses and `failed` for requests
+        that got no response.
+        """
+        with self._lock:
+            now = time.time()
+            self._inflight.value = max(0, self._inflight.value - 1)
+
+            if failed:
+                self._decrease(now, 0.5)
+                return
+
+            if throttled:
+                if self._decrease(now, 0.5):
+                    self._paused_until.value = now + self._backoff.value
+                    self._backoff.value = min(
+                        self.max_backoff, self._backoff.value * 2
+                    )
+                    log.warning(
+                        "servidor limitando requests, pausa de %.1fs, "
+                        "bajando a %.1f req/s y %d en vuelo",
+                        self._paused_until.value - now,
+                        self._rate.value,
+                        int(self._window.value),
+                    )
+                return
+
+            self._backoff.value = self.base_backoff
+            # Promedio reciente y promedio de largo plazo de la latencia
+            if self._latency.value == 0.0:
+                self._latency.value = self._baseline.value = latency
+            else:
+                self._latency.value = 0.8 * self._latency.value + 0.2 * latency
+                self._baseline.value = 0.99 * self._baseline.value + 0.01 * latency
+
+            if self._latency.value > self.latency_factor * self._baseline.value:
+                self._decrease(now, 0.9, rate=False)
+                return
+
+            if self._slow_start.value:
+                rate_step = window_step = 1.0
+            else:
+                rate_step = 1.0 / self._rate.value
+                window_step = 1.0 / self._window.value
+            self._rate.value = min(self.max_rate, self._rate.value + rate_step)
+            self._window.value = min(self.max_window, self._window.value + window_step)
@@ -0,0 +1,334 @@
+import math
+import random
+from html import escape
+import socket
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, parse_qsl, urlsplit
+
+from .cache import RequestCache, url_class
+from .request import THROTTLE_MIN_LENGTH, request_key
+
+log = logging.getLogger("scraper")
+
+# Lo que responde el servidor cuando lo saturamos, el scraper lo reconoce por
+# ser mas corto que `THROTTLE_MIN_LENGTH`
+THROTTLE_PAGE = (
+    "<html><body><p>Ha realizado demasiadas consultas, "
+    "intente nuevamente en unos minutos.</p></body></html>"
+)
+
+# `source(method, url, params, cookies)` devuelve la pagina de una request,
+# o None si no la conoce. Para GET `params` es None.
+Source = Callable[[str, str, Optional[Dict[str, str]], str], Optional[str]]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Parses a latency distribution in seconds:
+    `const:S`, `uniform:MIN,MAX`, `exp:MEAN` or `lognormal:MEDIAN,SIGMA`.
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "const":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown latency distribution '{spec}'")
+
+
+def cache_source(store: RequestCache) -> Source:
+    """Serves the responses recorded in a request cache, however old."""
+
+    def source(method, url, params, cookies):
+        req = {"m": method, "url": url}
+        if params is not None:
+            req["prm"] = params
+        cached = store.get_entry(request_key(req, cookies))
+        return cached.resp if cached is not None else None
+
+    return source
+
+
+# Relleno para que las paginas sinteticas no parezcan la de "demasiadas consultas"
+_PADDING = "<!-- " + "-" * 1000 + " -->"
+
+
+def _yes_no(value: bool) -> str:
+    return "SI" if value else "NO"
+
+
+def _search_row(i: int, initials: str, course: dict, section: dict) -> str:
+    row = "resultadosRowPar" if i % 2 == 0 else "resultadosRowImpar"
+    cols = [
+        section["nrc"],
+        f'<div><img src="i.png"/>{initials}</div>',
+        _yes_no(section["is_removable"]),
+        _yes_no(section["is_english"]),
+        section["section"],
+        _yes_no(section["is_special"]),
+        escape(course.get("area", "")),
+        escape(section["format"]),
+        escape(section.get("category") or course.get("category", "")),
+        escape(course["name"]),
+        "<a>(Sin Profesores)</a>",
+        escape(section["campus"]),
+        course["credits"],
+        section["total_quota"],
+        0,
+        "",
+    ]
+    schedule = "".join(
+        f"<tr><td>{key[0].upper()}:{key[1:]}</td>"
+        + "".join(f"<td>{escape(v)}</td>" for v in values)
+        + "</tr>"
+        for key, values in section["schedule"].items()
+    )
+    tds = "".join(f"<td>{col}</td>" for col in cols)
+    return f'<tr class="{row}">{tds}<td><table>{schedule}</table></td></tr>'
+
+
+def synthetic_source(
+    courses: Dict[str, dict], period: str, row_limit: Optional[int] = None
+) -> Source:
+    """Renders buscacursos and catalogo pages out of scraped data (a
+    `{period}.json`), for benchmarks with more data than any recorded cache.
+    Searches return at most `row_limit` sections, like buscacursos does.
+    """
+    rows = []
+    for initials, course in sorted(courses.items()):
+        for section in course.get("sections", {}).values():
+            rows.append((initials, course, section))
+    by_nrc = {row[2]["nrc"]: row for row in rows}
+
+    def search(rows: List[tuple]) -> str:
+        out = ["<html><body>", _PADDING, "<table>"]
+        school = None
+        for i, (initials, course, section) in enumerate(rows[:row_limit]):
+            if course["school"] != school:
+                school = course["school"]
+                out.append(f'<tr><td colspan="18">{escape(school)}</td></tr>')
+            out.append(_search_row(i, initials, course, section))
+        out.append("</table>")
+        out.append("</body></html>")
+        return "\n".join(out)
+
+    def quota(nrc: str) -> str:
+        out = ["<html>", _PADDING, "<table>"]
+        for key, value in by_nrc[nrc][2].get("quota", {}).items():
+            parts = key.split("/")
+            tds = "".join(f"<td>{escape(p)}</td>" for p in parts)
+            tds += "<td></td>" * (6 - len(parts))
+            out.append(f'<tr class="resultadosRowImpar">{tds}<td>{value}</td></tr>')
+        out.append("</table></html>")
+        return "\n".join(out)
+
+    def catalogo(query: str) -> str:
+        out = ["<html>", _PADDING, "<table><tr><td>Unidad</td></tr>"]
+        for initials, course in sorted(courses.items()):
+            if initials.startswith(query):
+                cols = [
+                    course["school"],
+                    initials,
+                    course["name"],
+                    "Pregrado",
+                    course["credits"],
+                    "",
+                ]
+                tds = "".join(f"<td>{escape(str(col))}</td>" for col in cols)
+                out.append(f"<tr>{tds}</tr>")
+        out.append("</table></html>")
+        return "\n".join(out)
+
+    def source(method, url, params, cookies):
+        query = {k: v[0] for k, v in parse_qs(urlsplit(url).query).items()}
+        if params is not None:
+            return catalogo(params.get("sigla", "").upper())
+        if query.get("termcode", query.get("cxml_semestre", period)) != period:
+            return None
+        if "cxml_sigla" in query:
+            prefix = query["cxml_sigla"].upper()
+            return search([row for row in rows if row[0].startswith(prefix)])
+        if "cxml_nrc" in query:
+            return search([row for row in rows if row[2]["nrc"] == query["cxml_nrc"]])
+        if "termcode" in query:
+            return quota(query["nrc"]) if query.get("nrc") in by_nrc else None
+        course = courses.get(query.get("sigla", ""))
+        if course is None:
+            return None
+        if query.get("view") == "programa":
+            program = escape(course.get("program", ""))
+            return f"<html>{_PADDING}<pre>{program}</pre></html>"
+        if query.get("view") == "requisitos":
+            spans = "".join(
+                f"<span>{escape(course.get(name, ''))}</span>"
+                for name in ("req", "conn", "restr", "equiv")
+            )
+            return f"<html>{_PADDING}{spans}</html>"
+        return None
+
+    return source
+
+
+# Tamaño de los pedazos en que se envia una pagina con `Faults.bandwidth`
+_SEND_CHUNK = 4096
+
+
+class Faults:
+    """Faults injected by the replay server. Each request first waits a
+    sample of `latency`, then with probability `error_rate` the connection is
+    dropped without an answer. For the kinds of pages the real servers
+    throttle, with probability `throttle_rate` (or if more than `max_rps`
+    requests arrived in the last second) the short "too many requests" page
+    is returned instead of the real one. With `bandwidth` (bytes per second)
+    bodies are sent in chunks at that speed, like a slow link would.
+    """
+
+    def __init__(
+        self,
+        latency: Optional[Callable[[], float]] = None,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        max_rps: Optional[float] = None,
+        bandwidth: Optional[float] = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._recent = deque()
+
+    def over_rate(self) -> bool:
+        if self.max_rps is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and self._recent[0] < now - 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_rps:
+                return True
+            self._recent.append(now)
+            return False
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """HTTP stand-in for buscacursos and catalogo. Requests come in as
+    `/{scheme}/{host}{path}` (see `request.target_url`), are mapped back to
+    the original URL and answered from `source`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, source: Source, faults: Optional[Faults] = None):
+        super().__init__(address, _ReplayHandler)
+        self.source = source
+        self.faults = faults or Faults()
+        self.counts: Dict[str, int] = {
+            "requests": 0,
+            "served": 0,
+            "missing": 0,
+            "errors": 0,
+            "throttled": 0,
+        }
+        self._counts_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name: str):
+        with self._counts_lock:
+            self.counts[name] += 1
+
+    def start(self) -> threading.Thread:
+        """Serves from a background thread, for use from the same process."""
+        thread = threading.Thread(
+            target=self.serve_forever, name="replay-server", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    server: ReplayServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        log.debug("replay: " + format, *args)
+
+    def do_GET(self):
+        self._handle("get", None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8")
+        self._handle("post", dict(parse_qsl(body, keep_blank_values=True)))
+
+    def _original_url(self) -> Optional[str]:
+        parts = urlsplit(self.path)
+        scheme, _, rest = parts.path.lstrip("/").partition("/")
+        host, _, path = rest.partition("/")
+        if scheme not in ("http", "https") or not host:
+            return None
+        url = f"{scheme}://{host}/{path}"
+        return f"{url}?{parts.query}" if parts.query else url
+
+    def _send(self, status: int, text: str):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        bandwidth = self.server.faults.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        for start in range(0, len(body), _SEND_CHUNK):
+            chunk = body[start : start + _SEND_CHUNK]
+            sleep(len(chunk) / bandwidth)
+            self.wfile.write(chunk)
+            self.wfile.flush()
+
+    def _handle(self, method: str, params: Optional[Dict[str, str]]):
+        server = self.server
+        faults = server.faults
+        server.count("requests")
+        if faults.latency is not None:
+            sleep(max(0.0, faults.latency()))
+
+        if faults.error_rate and random.random() < faults.error_rate:
+            server.count("errors")
+            # Cortamos la conexion sin responder
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+
+        url = self._original_url()
+        if url_class(url) in THROTTLE_MIN_LENGTH and (
+            faults.over_rate()
+            or (faults.throttle_rate and random.random() < faults.throttle_rate)
+        ):
+            server.count("throttled")
+            self._send(200, THROTTLE_PAGE)
+            return
+
+        text = None
+        if url is not None:
+            text = server.source(method, url, params, self.headers.get("Cookie", ""))
+        if text is None:
+            server.count("missing")
+            self._send(404, "not found")
+            return
+        server.count("served")
+        self._send(200, text)
@@ -12,6 +12,11 @@ class Expr:
     def find_unique_leaves(self, unique: dict[str, set[str]]):
         pass
 
+    @abstractmethod
+    def to_json(self):
+        """Compact JSON form of the expression, see `expr_from_json`."""
+        pass
+
     def count_nodes(self):
         return 1
 
@@ -34,6 +39,9 @@ class Const(Expr):
     def find_unique_leaves(self, unique: dict[str, set[str]]):
         pass
 
+    def to_json(self):
+        return self.val
+
 
 class Conn(Expr):
     op: ClassVar[str]
@@ -55,6 +63,9 @@ class Conn(Expr):
         for x in self.params:
             x.find_unique_leaves(unique)
 
+    def to_json(self):
+        return [self.op] + [x.to_json() for x in self.params]
+
     def count_nodes(self):
         cnt = 1
         for x in self.params:
@@ -262,6 +273,9 @@ class Restr(Expr):
     def find_unique_leaves(self, unique: Dict[str, Set[str]]):
         unique.setdefault(self.lhs, set()).add(f"{self.op} \"{self.rhs}\"")
 
+    def to_json(self):
+        return ["r", self.lhs, self.op, self.rhs]
+
 
 class Req(Expr):
     code: str
@@ -281,6 +295,9 @@ class Req(Expr):
     def find_unique_leaves(self, unique: dict[str, set[str]]):
         unique.setdefault(self.code, set()).add(self.co)
 
+    def to_json(self):
+        return str(self)
+
 
 class ReqParser:
     s: str
@@ -427,3 +444,24 @@ class ReqParser:
         if deps is None:
             deps = And([])
         return deps
+
+
+def expr_from_json(data) -> Expr:
+    """Inverse of `Expr.to_json`. Constants are booleans, requirements are
+    course codes (with a `(c)` suffix for corequisites), restrictions are
+    `["r", lhs, op, rhs]` and connectors are `["y", ...]` or `["o", ...]`.
+    """
+    if isinstance(data, bool):
+        return Const(data)
+    if isinstance(data, str):
+        if data.endswith("(c)"):
+            return Req(code=data[:-3], co=True)
+        return Req(code=data, co=False)
+    op, *params = data
+    if op == "r":
+        return Restr(*params)
+    if op == And.op:
+        return And([expr_from_json(x) for x in params])
+    if op == Or.op:
+        return Or([expr_from_json(x) for x in params])
+    raise Exception(f"invalid serialized expression {data}")
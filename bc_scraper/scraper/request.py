@@ -1,69 +1,427 @@
 import os
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
 import traceback
-from typing import Callable, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, Iterable, NamedTuple, Optional
+from urllib.parse import urlsplit
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+import time
 import logging
 import hashlib
 import json
 import binascii
-import multiprocessing
+import atexit
+from collections import OrderedDict
+
+from .cache import CacheWriter, RequestCache, content_hash, pending_stripe, url_class
+from .ratelimit import RateLimiter
+from .singleflight import FlightTable
 
 log = logging.getLogger("scraper")
 
-# Lock global para cache y archivo
-_file_lock = multiprocessing.Lock()
+store: Optional[RequestCache] = None
 
-cache: Dict[str, str] = {}
-cachefile = None
+# Escritor unico del cache. Solo corre en el proceso que llamo `load_cache`,
+# los workers le envian sus respuestas por `_writer_queue`.
+_writer: Optional[CacheWriter] = None
+_writer_queue = None
+_writer_pending = None
 
+# Respuestas recien enviadas al escritor que pueden no estar commiteadas aun
+_recent: "OrderedDict[str, str]" = OrderedDict()
+_RECENT_MAX = 256
 
-def load_cache():
-    global cachefile
-    if os.path.exists(".requestcache"):
-        with open(".requestcache", "r") as file:
-            for line in file:
-                try:
-                    c = json.loads(line)
-                    cache[c["key"]] = c["resp"]
-                except json.JSONDecodeError:
-                    continue
+# Segundos que una respuesta cacheada sigue vigente, por tipo de pagina
+# (None = siempre).
+# Los cupos cambian minuto a minuto en toma de ramos, los programas nunca.
+CACHE_TTL: Dict[str, Optional[float]] = {
+    "search": 12 * 3600,
+    "quota": 10 * 60,
+    "program": None,
+    "requirements": 7 * 86400,
+    "catalogo": 7 * 86400,
+    "other": None,
+}
+
+# Cookies que forman parte de la llave del cache, por tipo de pagina
+# (None = el header completo, como antes). Buscacursos y catalogo son publicos,
+# las cookies de `.cred` solo sirven para que no nos bloqueen y rotan seguido,
+# asi que no deben invalidar el cache.
+CACHE_KEY_COOKIES: Dict[str, Optional[FrozenSet[str]]] = {
+    "search": frozenset(),
+    "quota": frozenset(),
+    "program": frozenset(),
+    "requirements": frozenset(),
+    "catalogo": frozenset(),
+    "other": None,
+}
+
+# Las respuestas mas cortas que esto no son contenido, son la pagina con la que
+# el servidor nos pide que bajemos la velocidad
+THROTTLE_MIN_LENGTH: Dict[str, int] = {
+    "search": 1000,
+    "quota": 1000,
+    "catalogo": 1000,
+}
+
+# Limitador compartido por todos los procesos, se crea al pedir `worker_state`
+# o en la primera request que sale a la red
+_limiter: Optional[RateLimiter] = None
+
+# Paginas que se estan descargando en este proceso (por llave), y en cualquier
+# proceso que comparta el cache. Una request por una pagina que ya se esta
+# descargando espera ese resultado en vez de repetirla.
+_flights: Dict[str, "_Flight"] = {}
+_flights_lock = threading.Lock()
+_flight_table: Optional[FlightTable] = None
+# Segundos que se espera a otro proceso antes de descargar la pagina igual
+FLIGHT_TIMEOUT = 120
+
+# Maximo de requests en vuelo por proceso para las variantes async
+DEFAULT_MAX_INFLIGHT = 64
+
+# Las paginas descargadas con `stream` se le pasan al parser en pedazos de este
+# tamaño (en bytes) a medida que llegan. `stream` crea un parser con
+# `feed(text)` y `close()`, que devuelve el resultado.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Sesiones HTTP por host (keep-alive), y el pool de threads que las usa desde asyncio.
+# Ambos se recrean si el proceso fue forkeado, para no compartir sockets con el padre.
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+_pool_pid: Optional[int] = None
+
+
+def load_cache(max_bytes: Optional[int] = None):
+    global store, _writer, _writer_queue, _writer_pending, _flight_table
+    # Solo se abre el indice, las respuestas se leen del disco a demanda
+    store = RequestCache(".requestcache")
+    store.sync()
+    _writer = CacheWriter(store, max_bytes=max_bytes)
+    _writer_queue = _writer.queue
+    _writer_pending = _writer.pending
+    _flight_table = FlightTable()
+    _writer.start()
+    atexit.register(close_cache)
+
+
+def close_cache():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def get_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
+
+
+def worker_state():
+    """State that worker processes need to share the cache, the in-flight
+    requests and the rate limiter. Pass it to `init_worker` as a pool
+    initializer.
+    """
+    return store, _writer_queue, _writer_pending, _flight_table, get_limiter()
+
+
+def init_worker(state):
+    global store, _writer_queue, _writer_pending, _flight_table, _limiter
+    store, _writer_queue, _writer_pending, _flight_table, _limiter = state
+
+
+def add_to_cache(
+    key: str, resp: str, req: Optional[dict] = None, validators: Optional[dict] = None
+):
+    if _writer_queue is None:
+        return
+    _recent[key] = resp
+    if len(_recent) > _RECENT_MAX:
+        _recent.popitem(last=False)
+    _send(("put", key, resp, req, time.time(), validators))
+
+
+def cache_ttl(cfg, cls: str) -> Optional[float]:
+    ttls = cfg.get("cache-ttl", {})
+    return ttls[cls] if cls in ttls else CACHE_TTL[cls]
+
+
+class Page(NamedTuple):
+    text: str
+    hash: str
+    # False si el contenido es identico al que ya estaba en el cache
+    changed: bool
+    # Resultado del parser que se alimento mientras la pagina se descargaba
+    parsed: Any = None
+
+
+class ChangeTracker:
+    changed: bool = False
+
+
+_tracker: "contextvars.ContextVar[Optional[ChangeTracker]]" = (
+    contextvars.ContextVar("bc_change_tracker", default=None)
+)
+
+
+@contextmanager
+def track_changes():
+    """Records whether any page fetched inside the block changed. Used to skip
+    work for results built only from pages identical to the cached ones.
+    """
+    tracker = ChangeTracker()
+    token = _tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _tracker.reset(token)
+
+
+def _done(page: Page) -> Page:
+    tracker = _tracker.get()
+    if tracker is not None and page.changed:
+        tracker.changed = True
+    return page
+
+
+def _send(msg):
+    if _writer_queue is None:
+        return
+    if msg[0] in ("put", "refresh") and _writer_pending is not None:
+        with _writer_pending.get_lock():
+            _writer_pending[pending_stripe(msg[1])] += 1
+    _writer_queue.put(msg)
+
+
+def _wait_committed(key: str, timeout: float = 5):
+    # Espera a que el escritor commitee lo enviado para llaves de esta franja
+    if _writer_pending is None:
+        return
+    deadline = time.time() + timeout
+    stripe = pending_stripe(key)
+    while _writer_pending[stripe] > 0 and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def _reset_pools_after_fork():
+    global _executor, _pool_pid
+    if _pool_pid != os.getpid():
+        _sessions.clear()
+        _executor = None
+        _pool_pid = os.getpid()
+
+
+def get_session(cfg, url: str) -> requests.Session:
+    """Returns the keep-alive session for the host of `url`.
+    Each host gets its own connection pool, sized to the in-flight limit.
+    """
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        _reset_pools_after_fork()
+        session = _sessions.get(host)
+        if session is None:
+            size = cfg.get("max-inflight", DEFAULT_MAX_INFLIGHT)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def _get_executor(cfg) -> ThreadPoolExecutor:
+    global _executor
+    with _sessions_lock:
+        _reset_pools_after_fork()
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=cfg.get("max-inflight", DEFAULT_MAX_INFLIGHT),
+                thread_name_prefix="bc-fetch",
+            )
+        return _executor
+
+
+def _lookup(cfg, url: str, key: str, cls: str):
+    """Returns the cached page for `key` if it is still fresh, and the stale
+    cache entry (or None) to revalidate otherwise.
+    """
+    if cfg.get("disable-cache"):
+        return None, None
+    resp = _recent.get(key)
+    if resp is not None:
+        return Page(resp, content_hash(resp), False), None
+    cached = store.get_entry(key) if store is not None else None
+    if cached is not None:
+        ttl = cache_ttl(cfg, cls)
+        if ttl is None or time.time() - cached.fetched <= ttl:
+            log.info("request to %s hit cache", url)
+            _send(("touch", key, time.time(), cls))
+            return Page(cached.resp, cached.hash, False), None
+    return None, cached
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.page: Optional[Page] = None
 
-    # Abrimos el archivo en modo append
-    cachefile = open(".requestcache", "a", encoding="utf-8")
 
+def get_page_raw(
+    cfg,
+    url: str,
+    key: str,
+    fetch: Callable[[dict, bool], requests.Response],
+    req: Optional[dict] = None,
+    stream: Optional[Callable[[], Any]] = None,
+) -> Page:
+    cls = url_class(req["url"] if req else url)
+    page, cached = _lookup(cfg, url, key, cls)
+    if page is not None:
+        return _done(page)
 
-def add_to_cache(key: str, resp: str):
-    # Protegemos tanto el dict como el archivo
-    with _file_lock:
-        cache[key] = resp
-        if cachefile:
-            json.dump({"key": key, "resp": resp}, cachefile, ensure_ascii=False)
-            cachefile.write("\n")
-            cachefile.flush()
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        # Otro thread ya la esta descargando, usamos su resultado
+        flight.event.wait()
+        if flight.page is None:
+            return get_page_raw(cfg, url, key, fetch, req, stream)
+        log.info("request to %s coalesced", url)
+        # El resultado del parser es del thread que la descargo
+        return _done(flight.page._replace(parsed=None))
 
+    try:
+        flight.page = _fetch_shared(cfg, url, key, fetch, req, cls, cached, stream)
+        return _done(flight.page)
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.event.set()
 
-def get_text_raw(cfg, url: str, key: str, fetchtext: Callable[[], str]):
-    if not cfg.get("disable-cache"):
-        with _file_lock:
-            if key in cache:
-                log.info("request to %s hit cache", url)
-                return cache[key]
 
+def _fetch_shared(cfg, url, key, fetch, req, cls, cached, stream) -> Page:
+    table = _flight_table
+    if table is None or cfg.get("disable-cache"):
+        return _fetch(cfg, url, key, fetch, req, cls, cached, stream)
+    if not table.claim(key):
+        # Otro proceso la esta descargando, esperamos a que llegue al cache
+        if table.wait(key, FLIGHT_TIMEOUT):
+            _wait_committed(key)
+            page, cached = _lookup(cfg, url, key, cls)
+            if page is not None:
+                log.info("request to %s coalesced", url)
+                return page
+        return _fetch(cfg, url, key, fetch, req, cls, cached, stream)
+    try:
+        return _fetch(cfg, url, key, fetch, req, cls, cached, stream)
+    finally:
+        table.release(key)
+
+
+def _read_body(r: requests.Response, stream):
+    """Reads the body of a response requested with `stream=True`, feeding
+    each chunk to a new parser from `stream` as it arrives. Returns the text
+    and the parser result, or None if the page couldn't be parsed this way.
+    """
+    if stream is None or r.encoding is None:
+        # Sin charset en los headers hay que adivinarlo con el cuerpo completo
+        return r.text, None
+    parser = stream()
+    parts = []
+    try:
+        for chunk in r.iter_content(STREAM_CHUNK_SIZE, decode_unicode=True):
+            parts.append(chunk)
+            if parser is not None:
+                try:
+                    parser.feed(chunk)
+                except Exception:
+                    # Se vuelve a parsear completa despues, donde el error
+                    # se reporta como siempre
+                    parser = None
+    finally:
+        r.close()
+    parsed = None
+    if parser is not None:
+        try:
+            parsed = parser.close()
+        except Exception:
+            pass
+    return "".join(parts), parsed
+
+
+def _fetch(cfg, url, key, fetch, req, cls, cached, stream) -> Page:
+    # Revalidamos la entrada vencida si el servidor nos dio validadores
+    headers = {}
+    if cached is not None:
+        if "etag" in cached.validators:
+            headers["If-None-Match"] = cached.validators["etag"]
+        if "last-modified" in cached.validators:
+            headers["If-Modified-Since"] = cached.validators["last-modified"]
+
+    limiter = get_limiter()
+    min_length = THROTTLE_MIN_LENGTH.get(cls, 0)
     tries = 10
+    short_tries = 3
     while tries > 0:
+        limiter.acquire()
+        start = time.time()
         try:
-            resp = fetchtext()
-            if not cfg.get("disable-cache"):
-                add_to_cache(key, resp)
-            return resp
+            r = fetch(headers, stream is not None)
+            resp, parsed = _read_body(r, stream)
         except Exception:
+            limiter.release(time.time() - start, failed=True)
             log.error(f"request to {url} failed:")
             log.error(traceback.format_exc())
             tries -= 1
-            sleep(1)
             if tries > 0:
                 log.info("retrying...")
+            continue
+
+        if r.status_code in (429, 503) or (
+            r.status_code == 200 and len(resp) < min_length
+        ):
+            # No se cachea, el limitador pausa a todos antes de reintentar
+            limiter.release(time.time() - start, throttled=True)
+            log.warning(f"request to {url} throttled")
+            tries -= 1
+            if r.status_code == 200:
+                short_tries -= 1
+                if short_tries == 0:
+                    # Se registra como fallida en vez de tomar el aviso por resultados
+                    raise Exception(f'request to "{url}" still throttled after retries')
+            continue
+        limiter.release(time.time() - start)
+
+        if cached is not None and r.status_code == 304:
+            log.info("request to %s revalidated", url)
+            _send(("refresh", key, time.time(), cls))
+            return Page(cached.resp, cached.hash, False)
+
+        page = Page(resp, content_hash(resp), True, parsed)
+        validators = {
+            name: r.headers[name]
+            for name in ("etag", "last-modified")
+            if name in r.headers
+        }
+        if cached is not None and page.hash == cached.hash:
+            log.info("request to %s unchanged", url)
+            page = Page(cached.resp, cached.hash, False, parsed)
+            if validators == cached.validators:
+                _send(("refresh", key, time.time(), cls))
+                return page
+        if not cfg.get("disable-cache"):
+            add_to_cache(key, resp, req, validators)
+        return page
     raise Exception(f'too many tries to URL "{url}"')
 
 
@@ -73,34 +431,160 @@ def make_key(obj) -> str:
     ).decode("ascii")
 
 
-def get_text(cfg, query: str) -> str:
+def key_cookies(cls: str, cookies: str) -> str:
+    """The part of a Cookie header that identifies a page of kind `cls`,
+    according to `CACHE_KEY_COOKIES`.
+    """
+    names = CACHE_KEY_COOKIES[cls]
+    if names is None:
+        return cookies
+    pairs = []
+    for pair in cookies.split(";"):
+        name, _, value = pair.strip().partition("=")
+        if name in names:
+            pairs.append(f"{name}={value.strip()}")
+    return "; ".join(sorted(pairs))
+
+
+def request_key(req: dict, cookies: str) -> str:
+    """Cache key of a request (`{"m", "url", "prm"}`) sent with `cookies`."""
+    cls = url_class(req["url"])
+    obj = dict(req)
+    cks = key_cookies(cls, cookies)
+    if cks or CACHE_KEY_COOKIES[cls] is None:
+        obj["cks"] = cks
+    return make_key(obj)
+
+
+def legacy_key(req: dict, cookies: str) -> str:
+    """Cache key that `req` had before keys ignored cookies."""
+    return make_key({**req, "cks": cookies})
+
+
+def rekey_function(cookies: Iterable[str], candidates: Iterable[dict] = ()):
+    """Builds the `rekey` callback of `cache.rekey_cache` for the current key
+    policy. Entries whose kind still keys on the whole Cookie header are left
+    alone, the rest are rekeyed with the current `.cred` (`cookies[0]`). Legacy
+    entries don't store their request, so they are recognized by computing the
+    old key of every candidate request with every cookie string they may have
+    been fetched with.
+    """
+    cookies = list(cookies)
+    legacy = {}
+    for req in candidates:
+        for cks in cookies:
+            legacy[legacy_key(req, cks)] = req
+
+    def rekey(key: str, req: Optional[dict]):
+        legacy_req = None
+        if not req:
+            req = legacy_req = legacy.get(key)
+            if req is None:
+                return None
+        if CACHE_KEY_COOKIES[url_class(req["url"])] is None:
+            # Sigue dependiendo de las cookies con las que se descargo
+            return (key, req) if legacy_req else None
+        new_key = request_key(req, cookies[0])
+        return (new_key, req) if new_key != key or legacy_req else None
+
+    return rekey
+
+
+def target_url(cfg, url: str) -> str:
+    """URL that is actually requested for `url`. With `base-url` set, every
+    request goes to that server as `{base-url}/{scheme}/{host}{path}`, which is
+    what the replay server (`replay.py`) expects. Cache keys always use `url`.
+    """
+    base = cfg.get("base-url")
+    if not base:
+        return url
+    parts = urlsplit(url)
+    target = f"{base.rstrip('/')}/{parts.scheme}/{parts.netloc}{parts.path or '/'}"
+    return f"{target}?{parts.query}" if parts.query else target
+
+
+def get_page(cfg, query: str, stream: Optional[Callable[[], Any]] = None) -> Page:
+    """Fetches `query` through the cache. With `stream`, a page that comes
+    from the network is parsed while it downloads and the result is left in
+    `Page.parsed`.
+    """
     cookies = cfg.get("cookies", "")
-    key = make_key(
-        {
-            "m": "get",
-            "url": query,
-            "cks": cookies,
-        }
-    )
+    req = {"m": "get", "url": query}
+    key = request_key(req, cookies)
 
-    def fetch():
-        return requests.get(query, headers={"Cookie": cookies}).text
+    def fetch(headers, streamed):
+        target = target_url(cfg, query)
+        session = get_session(cfg, target)
+        return session.get(
+            target, headers={"Cookie": cookies, **headers}, stream=streamed
+        )
 
-    return get_text_raw(cfg, query, key, fetch)
+    return get_page_raw(cfg, query, key, fetch, req, stream)
 
 
-def post_text(cfg, url: str, form_params: Dict[str, str]) -> str:
+def post_page(
+    cfg,
+    url: str,
+    form_params: Dict[str, str],
+    stream: Optional[Callable[[], Any]] = None,
+) -> Page:
     cookies = cfg.get("cookies", "")
-    key = make_key(
-        {
-            "m": "post",
-            "url": url,
-            "cks": cookies,
-            "prm": form_params,
-        }
-    )
+    req = {"m": "post", "url": url, "prm": form_params}
+    key = request_key(req, cookies)
+
+    def fetch(headers, streamed):
+        target = target_url(cfg, url)
+        session = get_session(cfg, target)
+        return session.post(
+            target,
+            data=form_params,
+            headers={"Cookie": cookies, **headers},
+            stream=streamed,
+        )
+
+    return get_page_raw(cfg, f"{url} & {form_params}", key, fetch, req, stream)
+
+
+def get_text(cfg, query: str) -> str:
+    return get_page(cfg, query).text
+
+
+def post_text(cfg, url: str, form_params: Dict[str, str]) -> str:
+    return post_page(cfg, url, form_params).text
+
+
+# Async variants
+#
+# Las requests bloqueantes corren en un pool de `max-inflight` threads que
+# comparten las sesiones keep-alive, asi un solo proceso puede tener cientos de
+# requests en vuelo. El cache se comparte con las variantes sincronas.
+
+
+async def _run_in_pool(cfg, fn, *args):
+    # Copiamos el contexto para que `track_changes` vea las requests del pool
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_get_executor(cfg), ctx.run, fn, *args)
+
+
+async def get_page_async(
+    cfg, query: str, stream: Optional[Callable[[], Any]] = None
+) -> Page:
+    return await _run_in_pool(cfg, get_page, cfg, query, stream)
+
+
+async def post_page_async(
+    cfg,
+    url: str,
+    form_params: Dict[str, str],
+    stream: Optional[Callable[[], Any]] = None,
+) -> Page:
+    return await _run_in_pool(cfg, post_page, cfg, url, form_params, stream)
+
+
+async def get_text_async(cfg, query: str) -> str:
+    return (await get_page_async(cfg, query)).text
 
-    def fetch():
-        return requests.post(url, data=form_params, headers={"Cookie": cookies}).text
 
-    return get_text_raw(cfg, f"{url} & {form_params}", key, fetch)
+async def post_text_async(cfg, url: str, form_params: Dict[str, str]) -> str:
+    return (await post_page_async(cfg, url, form_params)).text
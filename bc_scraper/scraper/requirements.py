@@ -1,6 +1,17 @@
-from .request import get_text
+import json
+import logging
 from html.parser import HTMLParser
 
+from .memo import memo_kind, memoized_text
+from .reqparse import ReqParser
+from .request import get_text, get_text_async
+
+log = logging.getLogger("scraper")
+
+# Versiones de los parsers de requisitos y equivalencias en `.parsememo`
+DEPS_MEMO = memo_kind("requirements-deps", 1)
+EQUIV_MEMO = memo_kind("requirements-equiv", 1)
+
 
 class _RequirementsParser(HTMLParser):
     def __init__(self):
@@ -28,8 +39,52 @@ class _RequirementsParser(HTMLParser):
             self.values[-1] += data
 
 
+def _compile_deps(key: str):
+    req, conn, restr = json.loads(key)
+    return ReqParser.parse_deps(req, conn, restr).simplify().to_json()
+
+
+def _compile_equiv(equiv: str):
+    if equiv == "No tiene":
+        return ["o"]
+    return ReqParser.parse_requirement(equiv).to_json()
+
+
+def compile_requirements(cfg, req, conn, restr, equiv):
+    """Parses the strings returned by `get_requirements` into `(deps, equivs)`:
+    the simplified requirements and restrictions, and the equivalences, both
+    serialized with `Expr.to_json`. Each distinct string is parsed once and
+    memoized, a string that does not parse (or was not fetched) gives None.
+    """
+    deps = equivs = None
+    try:
+        if req and restr:
+            key = json.dumps([req, conn, restr], ensure_ascii=False)
+            deps = memoized_text(cfg, DEPS_MEMO, key, _compile_deps)
+    except Exception as err:
+        log.warning("no se pudieron leer los requisitos: %s", err)
+    try:
+        if equiv:
+            equivs = memoized_text(cfg, EQUIV_MEMO, equiv, _compile_equiv)
+    except Exception as err:
+        log.warning("no se pudieron leer las equivalencias: %s", err)
+    return deps, equivs
+
+
+def _requirements_url(initials):
+    return (
+        "http://catalogo.uc.cl/index.php?tmpl=component&view=requisitos"
+        f"&sigla={initials}"
+    )
+
+
 def get_requirements(cfg, initials):
     parser = _RequirementsParser()
-    query = f"http://catalogo.uc.cl/index.php?tmpl=component&view=requisitos&sigla={initials}"
-    text = get_text(cfg, query)
+    text = get_text(cfg, _requirements_url(initials))
+    return parser.process(text)
+
+
+async def get_requirements_async(cfg, initials):
+    parser = _RequirementsParser()
+    text = await get_text_async(cfg, _requirements_url(initials))
     return parser.process(text)
@@ -1,12 +1,38 @@
+import re
+from html import unescape
 from html.parser import HTMLParser
-from time import sleep
 
-from .request import get_text
+from .request import get_page, get_page_async
+from .memo import memo_kind, memoized_parse
+from .strings import intern_fields
 import logging
-from typing import List, Dict, Tuple, Union, Optional
+from typing import List, Dict, NamedTuple, Tuple, Union, Optional
 
 log = logging.getLogger("scraper")
 
+# Maximo de filas que muestra buscacursos en una busqueda. Una busqueda que
+# llega a esa cantidad puede haber quedado cortada, igual que en
+# ramos-uc/apps/bc_scraper/actions/search.py
+BC_ROW_LIMIT = 50
+
+# Version del parser de busquedas en `.parsememo`, se sube al cambiar lo que
+# devuelve para no seguir usando resultados del parser anterior
+SEARCH_MEMO = memo_kind("search", 1)
+
+
+class SearchResult(NamedTuple):
+    courses: list
+    # True si el servidor corto los resultados, hay que dividir la busqueda
+    truncated: bool
+
+
+def search_truncated(rows: int, limit: int) -> bool:
+    """Whether a search page with `rows` results hit the server's row cap.
+    A search with exactly `limit` results counts as truncated too, the page
+    does not tell them apart.
+    """
+    return rows >= limit
+
 
 from typing import Dict, List
 
@@ -91,67 +117,257 @@ class _BCParser(HTMLParser):
             data[index] = data[index].replace("<td>", "").replace("</td>", "")
             data[index] = data[index].replace("<br>", "").replace("</br>", "")
 
-        course = {
-            "nrc": data[0],
-            "initials": data[1][data[1].index("</img>") + 6 : data[1].index("</div>")],
-            "is_removable": False if data[2] == "NO" else True,
-            "is_english": False if data[3] == "NO" else True,
-            "section": int(data[4]),
-            "is_special": False if data[5] == "NO" else True,
-            "area": data[6],
-            "format": data[7][:16],
-            "category": data[8],
-            "name": data[9],
-            "teachers": data[10].replace("<a>", "").replace("</a>", ""),
-            "campus": data[11],
-            "credits": int(data[12]),
-            "total_quota": int(data[13]),
-            "available_quota": int(data[14]),
-            "schedule": "<>".join(data[16:]).replace("<tr>", "\nROW: "),
-            "school": self.current_school,
-        }
-        # Quick horario processing
-        course["schedule"] = course["schedule"].replace("<a>", "").replace("</a>", "")
-        course["schedule"] = (
-            course["schedule"].replace("<table>", "").replace("</table>", "")
-        )
-        course["schedule"] = (
-            course["schedule"].replace("<img>", "").replace("</img>", "")
+        self.courses.append(_make_course(data, self.current_school))
+
+
+def _make_course(data: List[str], school: str) -> Dict[str, Union[str, bool, int]]:
+    """Builds a course out of the cells of a results row."""
+    course = {
+        "nrc": data[0],
+        "initials": data[1][data[1].index("</img>") + 6 : data[1].index("</div>")],
+        "is_removable": False if data[2] == "NO" else True,
+        "is_english": False if data[3] == "NO" else True,
+        "section": int(data[4]),
+        "is_special": False if data[5] == "NO" else True,
+        "area": data[6],
+        "format": data[7][:16],
+        "category": data[8],
+        "name": data[9],
+        "teachers": data[10].replace("<a>", "").replace("</a>", ""),
+        "campus": data[11],
+        "credits": int(data[12]),
+        "total_quota": int(data[13]),
+        "available_quota": int(data[14]),
+        "schedule": "<>".join(data[16:]).replace("<tr>", "\nROW: "),
+        "school": school,
+    }
+    # Quick horario processing
+    course["schedule"] = course["schedule"].replace("<a>", "").replace("</a>", "")
+    course["schedule"] = (
+        course["schedule"].replace("<table>", "").replace("</table>", "")
+    )
+    course["schedule"] = (
+        course["schedule"].replace("<img>", "").replace("</img>", "")
+    )
+
+    course["schedule"] = process_schedule(course["schedule"])
+
+    # Turn profesor Apellido Nombre to Nombre Apellido
+    if course["teachers"] not in [
+        "Dirección Docente",
+        "(Sin Profesores)",
+        "Por Fijar",
+    ]:
+        course["teachers"] = ",".join(
+            [
+                prof.split(" ")[-1] + " " + " ".join(prof.split(" ")[:-1])
+                for prof in course["teachers"].split(",")
+            ]
         )
+    return course
+
+
+# Tokens de las paginas de buscacursos, reconocidos con las mismas reglas que
+# usa HTMLParser para que ambos parsers vean los mismos tags y textos
+_TOKEN = re.compile(
+    r"([^<]+)"
+    r"|<([a-zA-Z][^\t\n\r\f />\x00]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>"
+    r"|</([a-zA-Z][^\t\n\r\f />\x00]*)[^>]*>"
+    r"|<!--.*?--!?>"
+    r"|<![^-][^>]*>"
+    r"|<[/?][^>]*>",
+    re.S,
+)
+_ATTR = re.compile(
+    r"([^\s/>][^\s/=>]*)(?:\s*=+\s*('[^']*'|\"[^\"]*\"|(?![\'\"])[^>\s]*))?"
+)
+# Fuera de una fila solo importan las filas, los nombres de escuela y lo que
+# puede esconderlas (comentarios, scripts)
+_RELEVANT = re.compile(r"<(?:(?:t[dr]|script|style)(?![^\t\n\r\f />\x00])|!--)", re.I)
+# `/` final que es parte de un valor sin comillas, no un tag que se cierra solo
+_BARE_SLASH = re.compile(r"=+\s*(?![\'\"])[^>\s]*/\s*$")
+_RAW_END = {
+    "script": re.compile(r"</\s*script\s*>", re.I),
+    "style": re.compile(r"</\s*style\s*>", re.I),
+}
+_ROW_CLASSES = ("resultadosRowPar", "resultadosRowImpar")
+
+
+def _attrs(text: str) -> List[Tuple[str, Optional[str]]]:
+    attrs = []
+    for name, value in _ATTR.findall(text):
+        if value[:1] in ("'", '"'):
+            value = value[1:-1]
+        attrs.append((name.lower(), unescape(value)))
+    return attrs
+
+
+class _BCStreamParser:
+    """Single pass parser for the `resultadosRowPar`/`resultadosRowImpar`
+    rows of a search page, giving the same courses as `_BCParser` in linear
+    time. Text can be fed in chunks as it arrives; call `close` at the end.
+    """
+
+    courses: List[Dict[str, Union[str, bool, int]]]
+
+    def __init__(self):
+        self.courses = []
+        self._buffer = ""
+        # Partes del texto de la fila actual, None fuera de una fila
+        self._row: Optional[List[str]] = None
+        self._nested = 0
+        self._school = ""
+        # Tag (script o style) cuyo contenido es texto hasta que se cierre
+        self._raw: Optional[str] = None
+
+    def feed(self, text: str):
+        self._buffer += text
+        self._parse(final=False)
 
-        course["schedule"] = process_schedule(course["schedule"])
+    def close(self) -> List[Dict[str, Union[str, bool, int]]]:
+        self._parse(final=True)
+        return self.courses
 
-        # Turn profesor Apellido Nombre to Nombre Apellido
-        if course["teachers"] not in [
-            "Dirección Docente",
-            "(Sin Profesores)",
-            "Por Fijar",
-        ]:
-            course["teachers"] = ",".join(
-                [
-                    prof.split(" ")[-1] + " " + " ".join(prof.split(" ")[:-1])
-                    for prof in course["teachers"].split(",")
-                ]
-            )
+    def _parse(self, final: bool):
+        buf = self._buffer
+        n = len(buf)
+        pos = 0
+        while pos < n:
+            if self._row is None and self._raw is None and self._school != "*":
+                match = _RELEVANT.search(buf, pos)
+                if match is None:
+                    # Puede haber un tag cortado al final
+                    pos = max(pos, buf.rfind("<")) if not final else n
+                    break
+                pos = match.start()
 
-        self.courses.append(course)
+            if self._raw is not None:
+                match = _RAW_END[self._raw].search(buf, pos)
+                if match is None:
+                    if not final:
+                        break
+                    self._data(buf[pos:])
+                    pos = n
+                    break
+                if match.start() > pos:
+                    self._data(buf[pos : match.start()])
+                self._end(self._raw)
+                self._raw = None
+                pos = match.end()
+                continue
+
+            match = _TOKEN.match(buf, pos)
+            if match is None:
+                # Un `<` que no abre un tag es texto, salvo que el tag este
+                # cortado y siga en el proximo pedazo
+                if not final and (
+                    buf.find(">", pos) < 0 or buf.startswith("<!--", pos)
+                ):
+                    break
+                self._data("<")
+                pos += 1
+                continue
+            end = match.end()
+            kind = match.lastindex
+            if kind == 1:
+                # El texto puede seguir en el proximo pedazo
+                if end == n and not final:
+                    break
+                self._data(unescape(match[1]))
+            elif kind == 3:
+                tag = match[2].lower()
+                attrs = match[3]
+                if attrs and tag in ("tr", "td"):
+                    self._start(tag, _attrs(attrs))
+                else:
+                    self._start(tag, [])
+                if attrs.endswith("/") and not _BARE_SLASH.search(attrs):
+                    self._end(tag)
+                elif tag in _RAW_END:
+                    self._raw = tag
+            elif kind == 4:
+                self._end(match[4].lower())
+            pos = end
+        self._buffer = buf[pos:]
+
+    def _start(self, tag: str, attrs: List[Tuple[str, Optional[str]]]):
+        row = self._row
+        if tag == "tr" and any(
+            name == "class" and value in _ROW_CLASSES for name, value in attrs
+        ):
+            if row is None:
+                self._row = []
+        elif row is not None:
+            if tag == "tr":
+                self._nested += 1
+            row.append(f"<{tag}>")
+
+        if tag == "td" and ("colspan", "18") in attrs:
+            self._school = "*"
+
+    def _end(self, tag: str):
+        row = self._row
+        if row is None:
+            return
+        if tag == "tr":
+            if self._nested:
+                self._nested -= 1
+            else:
+                self._row = None
+                self._process(row)
+        else:
+            row.append(f"</{tag}>\n" if tag == "td" else f"</{tag}>")
+
+    def _data(self, data: str):
+        if self._row is not None:
+            data = data.strip()
+            self._row.append(data)
+
+        if self._school == "*":
+            self._school = data
+
+    def _process(self, row: List[str]):
+        # Los reemplazos no cruzan saltos de linea, da lo mismo hacerlos
+        # sobre la fila entera que celda por celda
+        text = "".join(row).strip()
+        text = text.replace("<td>", "").replace("</td>", "")
+        text = text.replace("<br>", "").replace("</br>", "")
+        self.courses.append(_make_course(text.split("\n"), self._school))
+
+
+def _search_url(query: str, period: str, nrc: bool) -> str:
+    if nrc:
+        return f"https://buscacursos.uc.cl/?cxml_semestre={period}&cxml_nrc={query}"
+    return f"https://buscacursos.uc.cl/?cxml_semestre={period}&cxml_sigla={query}"
+
+
+def _parse_search(text: str):
+    parser = _BCStreamParser()
+    parser.feed(text)
+    return parser.close()
 
 
 # Search
+def _search_result(cfg, page) -> SearchResult:
+    courses = intern_fields(memoized_parse(cfg, SEARCH_MEMO, page, _parse_search))
+    return SearchResult(courses, search_truncated(len(courses), BC_ROW_LIMIT))
+
+
+def bc_search_result(cfg, query: str, period: str, nrc: bool = False) -> SearchResult:
+    url = _search_url(query, period, nrc)
+    return _search_result(cfg, get_page(cfg, url, stream=_BCStreamParser))
+
+
+async def bc_search_result_async(
+    cfg, query: str, period: str, nrc: bool = False
+) -> SearchResult:
+    url = _search_url(query, period, nrc)
+    return _search_result(cfg, await get_page_async(cfg, url, stream=_BCStreamParser))
+
+
 def bc_search(cfg, query: str, period: str, nrc: bool = False):
-    parser = _BCParser()
-    url = None
-    if nrc:
-        url = f"https://buscacursos.uc.cl/?cxml_semestre={period}&cxml_nrc={query}"
-    else:
-        url = f"https://buscacursos.uc.cl/?cxml_semestre={period}&cxml_sigla={query}"
-    resp = get_text(cfg, url)
-
-    # Check valid response
-    if len(resp) < 1000:
-        log.warn("Too many request prevention")
-        sleep(5)
-        resp = get_text(cfg, url)
-
-    parser.feed(resp)
-    return parser.courses
+    return bc_search_result(cfg, query, period, nrc).courses
+
+
+async def bc_search_async(cfg, query: str, period: str, nrc: bool = False):
+    return (await bc_search_result_async(cfg, query, period, nrc)).courses
@@ -1,11 +1,14 @@
 from html.parser import HTMLParser
-from time import sleep
 from .request import post_text
+from .search import SearchResult, search_truncated
 import logging
 from typing import List, Dict, Tuple, Union, Optional
 
 log = logging.getLogger("scraper")
 
+# Maximo de cursos que muestra el catalogo en una busqueda
+CATALOGO_ROW_LIMIT = 1000
+
 
 class _CatalogoParser(HTMLParser):
     first: bool
@@ -60,10 +63,11 @@ class _CatalogoParser(HTMLParser):
 
 
 # Search
-def catalogo_search(cfg, query: str):
-    parser = _CatalogoParser()
-    url = f"https://catalogo.uc.cl/index.php?Itemid=378"
-    params = {
+CATALOGO_URL = "https://catalogo.uc.cl/index.php?Itemid=378"
+
+
+def _catalogo_params(query: str) -> Dict[str, str]:
+    return {
         "cod_unidad_academ": "",
         "sigla": query,
         "nom_curso": "",
@@ -74,13 +78,18 @@ def catalogo_search(cfg, query: str):
         "view": "cursoslist",
         "Itemid": "378",
     }
-    resp = post_text(cfg, url, params)
 
-    # Check valid response
-    if len(resp) < 1000:
-        log.warn("Too many request prevention")
-        sleep(5)
-        resp = post_text(cfg, url, params)
+
+def catalogo_search_result(cfg, query: str) -> SearchResult:
+    parser = _CatalogoParser()
+    url = CATALOGO_URL
+    params = _catalogo_params(query)
+    resp = post_text(cfg, url, params)
 
     parser.feed(resp)
-    return parser.courses
+    truncated = search_truncated(len(parser.courses), CATALOGO_ROW_LIMIT)
+    return SearchResult(parser.courses, truncated)
+
+
+def catalogo_search(cfg, query: str):
+    return catalogo_search_result(cfg, query).courses
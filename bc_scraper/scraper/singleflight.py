@@ -0,0 +1,66 @@
+import time
+import multiprocessing
+
+
+class FlightTable:
+    """Cache keys being fetched right now by any process, so a process about
+    to fetch a page another one is already fetching waits for that result
+    instead (single-flight). Pass it to the workers through the pool
+    initializer.
+
+    It is a hash table in shared memory: each key hashes to a bucket of
+    `slots` entries. If a bucket is full the key is simply not coalesced.
+    """
+
+    def __init__(self, buckets: int = 1024, slots: int = 4):
+        self.buckets = buckets
+        self.slots = slots
+        self._lock = multiprocessing.Lock()
+        self._table = multiprocessing.Array("q", buckets * slots, lock=False)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # Las llaves son hex de blake2b, 60 bits alcanzan y nunca da 0 (vacio)
+        return int(key[:15], 16) + 1
+
+    def _bucket(self, h: int) -> range:
+        start = (h % self.buckets) * self.slots
+        return range(start, start + self.slots)
+
+    def claim(self, key: str) -> bool:
+        """Registers `key` as being fetched by the caller. Returns False if
+        another process is already fetching it.
+        """
+        h = self._hash(key)
+        with self._lock:
+            free = None
+            for i in self._bucket(h):
+                if self._table[i] == h:
+                    return False
+                if self._table[i] == 0 and free is None:
+                    free = i
+            if free is not None:
+                self._table[free] = h
+            return True
+
+    def release(self, key: str):
+        h = self._hash(key)
+        with self._lock:
+            for i in self._bucket(h):
+                if self._table[i] == h:
+                    self._table[i] = 0
+                    return
+
+    def fetching(self, key: str) -> bool:
+        h = self._hash(key)
+        with self._lock:
+            return any(self._table[i] == h for i in self._bucket(h))
+
+    def wait(self, key: str, timeout: float) -> bool:
+        """Waits until nobody is fetching `key`. Returns False on timeout."""
+        deadline = time.time() + timeout
+        while self.fetching(key):
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
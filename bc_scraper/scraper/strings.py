@@ -0,0 +1,116 @@
+import sys
+import json
+from typing import Any, Callable, Dict, IO, Iterable, List
+
+# Campos de texto que se repiten en miles de secciones, cursos y periodos.
+# Ademas de estos, el tipo de actividad y la sala de cada modulo del horario
+# (`schedule`) y los nombres de los programas en los cupos (`quota`).
+INTERNED_FIELDS = frozenset(("school", "area", "category", "format", "campus"))
+
+# Marca de un JSON con los textos repetidos codificados como ids, ver `encode_strings`
+ENCODING = "strings-v1"
+
+
+class StringTable:
+    """Assigns consecutive ids to strings, the first one seen gets 0."""
+
+    def __init__(self, strings: Iterable[str] = ()):
+        self.strings: List[str] = []
+        self._ids: Dict[str, int] = {}
+        for s in strings:
+            self.intern(s)
+
+    def intern(self, s: str) -> int:
+        string_id = self._ids.get(s)
+        if string_id is None:
+            string_id = self._ids[s] = len(self.strings)
+            self.strings.append(s)
+        return string_id
+
+    def __getitem__(self, string_id: int) -> str:
+        return self.strings[string_id]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+def _map_fields(obj: Any, string: Callable, quota: Callable, kind: type = str) -> Any:
+    # Copia de `obj` aplicando `string` a cada texto repetido (o id, si `kind`
+    # es int) y `quota` a cada tabla de cupos, donde sea que aparezcan
+    # (resultados de busqueda, cursos, periodos, archivos universales)
+    if isinstance(obj, list):
+        return [_map_fields(value, string, quota, kind) for value in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for key, value in obj.items():
+        if key in INTERNED_FIELDS and type(value) is kind:
+            out[key] = string(value)
+        elif key == "schedule" and isinstance(value, dict):
+            out[key] = {
+                module: [string(s) if type(s) is kind else s for s in activity]
+                for module, activity in value.items()
+            }
+        elif key == "quota" and isinstance(value, (dict, list)):
+            out[key] = quota(value)
+        else:
+            out[key] = _map_fields(value, string, quota, kind)
+    return out
+
+
+def intern_fields(data: Any) -> Any:
+    """Copy of parsed or loaded data where every repeated string is interned,
+    so equal values share one object.
+    """
+    intern = sys.intern
+    return _map_fields(
+        data,
+        intern,
+        lambda quota: {intern(name): count for name, count in quota.items()},
+    )
+
+
+def encode_strings(data: Any) -> dict:
+    """Dictionary-encoded form of `data`: repeated strings are replaced by
+    ids into a `strings` table and quotas become `[id, count]` pairs.
+    """
+    table = StringTable()
+    encoded = _map_fields(
+        data,
+        table.intern,
+        lambda quota: [[table.intern(name), count] for name, count in quota.items()],
+    )
+    return {"encoding": ENCODING, "strings": table.strings, "data": encoded}
+
+
+def is_encoded(doc: Any) -> bool:
+    return isinstance(doc, dict) and doc.get("encoding") == ENCODING
+
+
+def decode_strings(doc: Any) -> Any:
+    """Inverse of `encode_strings`, with every string interned. Data that
+    is not encoded is returned as is.
+    """
+    if not is_encoded(doc):
+        return doc
+    strings = [sys.intern(s) for s in doc["strings"]]
+    return _map_fields(
+        doc["data"],
+        strings.__getitem__,
+        lambda quota: {strings[name]: count for name, count in quota},
+        int,
+    )
+
+
+def load_json(file: IO[str]) -> Any:
+    """Loads scraped data, dictionary-encoded or not, with its repeated
+    strings interned.
+    """
+    doc = json.load(file)
+    if is_encoded(doc):
+        return decode_strings(doc)
+    return intern_fields(doc)
+
+
+def dump_json(data: Any, file: IO[str], encode: bool = False, **kwargs):
+    json.dump(encode_strings(data) if encode else data, file, **kwargs)
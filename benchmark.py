@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of the scraper against a local replay server
+
+import os
+import sys
+import json
+import time
+import logging
+import pickle
+import random
+import shutil
+import string
+import resource
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from collections import Counter, defaultdict
+from datetime import datetime
+from itertools import product
+from urllib.parse import parse_qs, urlsplit
+
+from bc_scraper.actions.collect import (
+    STAGE_CHUNK,
+    STAGE_WORKERS,
+    CollectCourses,
+    _claim,
+    _search_task,
+)
+from bc_scraper.actions.collect_catalogo import CollectCatalogo
+from bc_scraper.scraper.banner import _parse_quota
+from bc_scraper.scraper.cache import RequestCache, iter_entries, url_class
+from bc_scraper.scraper.programs import _ProgramParser
+from bc_scraper.scraper.replay import (
+    Faults,
+    ReplayServer,
+    cache_source,
+    parse_latency,
+    synthetic_source,
+)
+from bc_scraper.scraper.request import DEFAULT_MAX_INFLIGHT, close_cache, load_cache
+from bc_scraper.scraper.requirements import _RequirementsParser
+from bc_scraper.scraper.search import (
+    BC_ROW_LIMIT,
+    _BCParser,
+    _parse_search,
+    _search_url,
+)
+from bc_scraper.scraper.strings import load_json
+from bc_scraper.scraper.search_catalogo import _CatalogoParser
+
+log = logging.getLogger("benchmark")
+
+
+def _parse_catalogo(text):
+    parser = _CatalogoParser()
+    parser.feed(text)
+    return parser.courses
+
+
+PARSERS = {
+    "search": _parse_search,
+    "quota": _parse_quota,
+    "program": lambda text: _ProgramParser().process(text),
+    "requirements": lambda text: _RequirementsParser().process(text),
+    "catalogo": _parse_catalogo,
+}
+
+
+def request_level(url, params):
+    # Largo del prefijo buscado, o None si la request no es una busqueda
+    if params is not None:
+        return len(params.get("sigla", ""))
+    query = parse_qs(urlsplit(url).query)
+    if "cxml_sigla" in query:
+        return len(query["cxml_sigla"][0])
+    return None
+
+
+def make_source(opts):
+    if opts["dataset"] == "cache":
+        store = RequestCache(opts["cache-file"])
+        store.sync()
+        return cache_source(store)
+    with open(opts["data"], "r", encoding="utf-8") as f:
+        courses = json.load(f)
+    row_limit = int(opts["row-limit"]) if opts.get("row-limit") else None
+    return synthetic_source(courses, opts["period"], row_limit)
+
+
+def serve(opts, conn):
+    """Replay server process. Sends its address through `conn`, and its stats
+    once it receives anything back.
+    """
+    source = make_source(opts)
+    served = []
+    by_level = defaultdict(Counter)
+    level = {"current": 0}
+
+    def recording_source(method, url, params, cookies):
+        text = source(method, url, params, cookies)
+        if text is not None:
+            served.append((method, url, params))
+            # Los niveles se recorren en orden, toda request pertenece al
+            # nivel de la ultima busqueda
+            search_level = request_level(url, params)
+            if search_level is not None:
+                level["current"] = search_level
+            by_level[level["current"]][url_class(url)] += 1
+        return text
+
+    faults = Faults(
+        latency=parse_latency(opts["latency"]) if opts.get("latency") else None,
+        error_rate=float(opts.get("error-rate", 0)),
+        throttle_rate=float(opts.get("throttle-rate", 0)),
+        max_rps=float(opts["max-rps"]) if opts.get("max-rps") else None,
+        bandwidth=float(opts["bandwidth"]) * 1024 if opts.get("bandwidth") else None,
+    )
+    server = ReplayServer(("127.0.0.1", 0), recording_source, faults)
+    server.start()
+    conn.send(server.base_url)
+    conn.recv()
+    server.shutdown()
+
+    # CPU que toma parsear cada pagina servida, medido aparte del crawl
+    parse_cpu = Counter()
+    for method, url, params in served:
+        kind = url_class(url)
+        if kind not in PARSERS:
+            continue
+        text = source(method, url, params, "")
+        start = time.process_time()
+        PARSERS[kind](text)
+        parse_cpu[kind] += time.process_time() - start
+
+    conn.send(
+        {
+            "server": server.counts,
+            "by_level": {str(k): dict(v) for k, v in sorted(by_level.items())},
+            "parse_cpu": dict(parse_cpu),
+        }
+    )
+
+
+def crawl(opts, pipeline, base_url, queue):
+    """Runs one pipeline in its own process, so every run starts from a clean
+    request layer and rusage only covers it.
+    """
+    workdir = tempfile.mkdtemp(prefix="bc-benchmark-")
+    os.chdir(workdir)
+    cfg = {
+        "cookies": "",
+        "testmode": False,
+        "fetch-program": True,
+        "fetch-quota": True,
+        "fetch-requirements": True,
+        "disable-cache": "with-cache" not in opts,
+        "max-inflight": int(opts.get("max-inflight", DEFAULT_MAX_INFLIGHT)),
+        "base-url": base_url,
+        "plan": opts["plan"].split(",") if opts.get("plan") else None,
+        "stage-workers": {
+            stage: int(opts[f"workers-{stage}"])
+            for stage in STAGE_WORKERS
+            if f"workers-{stage}" in opts
+        },
+    }
+    if not cfg["disable-cache"]:
+        load_cache()
+
+    result = {}
+    start = time.time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if pipeline == "courses":
+            courses = CollectCourses()
+            courses.collect(opts["period"], cfg)
+            result["merge_time"] = courses.merge_time
+            result["stages"] = {
+                name: stage.stats() for name, stage in courses.stages.items()
+            }
+            with open(f"{opts['period']}.json", "r", encoding="utf-8") as f:
+                data = load_json(f)
+            result["courses"] = len(data)
+            result["sections"] = sum(len(c["sections"]) for c in data.values())
+        else:
+            courses = CollectCatalogo()
+            courses.collect(cfg)
+            result["courses"] = len(courses.courses)
+    result["wall_time"] = time.time() - start
+    close_cache()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result["cpu_time"] = (
+        own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    )
+    # ru_maxrss esta en KB en Linux
+    result["peak_rss_mb"] = max(own.ru_maxrss, children.ru_maxrss) / 1024
+    os.chdir("/")
+    shutil.rmtree(workdir, ignore_errors=True)
+    queue.put(result)
+
+
+def run(opts, pipeline):
+    log.info(f"benchmarking {pipeline}")
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(opts, child_conn))
+    server.start()
+    base_url = conn.recv()
+
+    queue = multiprocessing.Queue()
+    worker = multiprocessing.Process(
+        target=crawl, args=(opts, pipeline, base_url, queue)
+    )
+    worker.start()
+    result = queue.get()
+    worker.join()
+
+    conn.send("stop")
+    stats = conn.recv()
+    server.join()
+
+    by_kind = Counter()
+    for counts in stats["by_level"].values():
+        by_kind.update(counts)
+    result["requests"] = stats["server"]["requests"]
+    result["requests_by_kind"] = dict(by_kind)
+    result["requests_by_level"] = stats["by_level"]
+    result["server"] = stats["server"]
+    result["pages_per_second"] = stats["server"]["served"] / result["wall_time"]
+    result["parse_cpu"] = stats["parse_cpu"]
+    result["parse_cpu_total"] = sum(stats["parse_cpu"].values())
+    return result
+
+
+def _is_search(entry, resp) -> bool:
+    url = (entry.get("req") or {}).get("url")
+    if url:
+        return url_class(url) == "search"
+    # Las entradas de antes de guardar la request solo tienen la llave, que
+    # es un hash: se reconocen por las filas de resultados. Tambien entran
+    # paginas de cupos, que tienen las mismas clases, y se comparan igual
+    return any(row in resp for row in ("resultadosRowPar", "resultadosRowImpar"))
+
+
+def search_pages(opts):
+    """Search pages to check the parser with: every search recorded in the
+    cache, or one synthetic page per two-letter prefix of --data.
+    """
+    if opts["dataset"] == "cache":
+        store = RequestCache(opts["cache-file"])
+        for entry, resp in iter_entries(store):
+            if _is_search(entry, resp):
+                yield resp
+        return
+    source = make_source(opts)
+    with open(opts["data"], "r", encoding="utf-8") as f:
+        prefixes = sorted({initials[:2] for initials in json.load(f)})
+    for prefix in prefixes:
+        yield source("get", _search_url(prefix, opts["period"], False), None, "")
+
+
+def _parse_reference(text):
+    parser = _BCParser()
+    parser.feed(text)
+    return parser.courses
+
+
+def _outcome(parse, text):
+    # Un parser que falla tiene que fallar igual en el otro
+    try:
+        return parse(text)
+    except Exception as e:
+        return type(e).__name__
+
+
+def check_parser(opts) -> bool:
+    """Differential check of `_parse_search` against `_BCParser` over every
+    page from `search_pages`, then times both.
+    """
+    pages = list(search_pages(opts))
+    if not pages:
+        log.error("no hay paginas de busqueda que comparar")
+        return False
+    mismatches = 0
+    for i, page in enumerate(pages):
+        if _outcome(_parse_search, page) != _outcome(_parse_reference, page):
+            mismatches += 1
+            log.error(f"pagina {i}: los parsers no coinciden")
+    log.info(f"{len(pages)} paginas, {mismatches} distintas")
+
+    size = sum(len(page) for page in pages) / 2**20
+    times = {}
+    for name, parse in (("reference", _parse_reference), ("search", _parse_search)):
+        best = None
+        for _ in range(int(opts.get("repeat", 3))):
+            start = time.perf_counter()
+            for page in pages:
+                _outcome(parse, page)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+        log.info(f"{name}: {best:.3f}s, {size / best if best else 0:.1f} MB/s")
+    if times["search"]:
+        log.info(f"speedup: {times['reference'] / times['search']:.2f}x")
+    return mismatches == 0
+
+
+def _time_proxies(nrcs, initials, pages, queue):
+    # Como lo hacian los workers antes del pipeline: una consulta al proceso
+    # del manager por cada fila encontrada
+    start = time.perf_counter()
+    for page in pages:
+        for row in page:
+            if row["nrc"] in nrcs:
+                continue
+            nrcs[row["nrc"]] = True
+            if row["initials"] not in initials:
+                initials[row["initials"]] = True
+    queue.put(time.perf_counter() - start)
+
+
+def _time_claims(seen, pages):
+    # Lo que hace ahora el padre con cada busqueda que termina
+    shared = {
+        "processed_nrcs": {nrc for nrc, _ in seen},
+        "processed_initials": {initials for _, initials in seen},
+        "open": {},
+        "course_rows": {},
+        "section_rows": {},
+    }
+    start = time.perf_counter()
+    for i, page in enumerate(pages):
+        _claim(shared, str(i), page, False, False)
+    return time.perf_counter() - start
+
+
+def bench_seen(opts):
+    """Cost of the "already processed" checks of the courses crawl: Manager
+    dict proxies queried from a worker (one IPC round-trip per found row),
+    against `_claim` on the parent's plain sets, which is what the pipeline
+    does now. Also the bytes pickled to submit the first level both ways.
+    """
+    with open(opts["data"], "r", encoding="utf-8") as f:
+        courses = load_json(f)
+    keys = [
+        (section["nrc"], initials)
+        for initials, course in courses.items()
+        for section in course.get("sections", {}).values()
+    ]
+    # Filas encontradas por cada busqueda, la mitad ya procesadas antes
+    n_rows = int(opts.get("rows", 100_000))
+    rows = [
+        {"nrc": nrc, "initials": initials}
+        for nrc, initials in (keys[i % len(keys)] for i in range(n_rows))
+    ]
+    pages = [rows[i : i + BC_ROW_LIMIT] for i in range(0, n_rows, BC_ROW_LIMIT)]
+    seen = random.Random(0).sample(keys, len(keys) // 2)
+
+    mgr = multiprocessing.Manager()
+    proxy_nrcs, proxy_initials = mgr.dict(), mgr.dict()
+    for nrc, initials in seen:
+        proxy_nrcs[nrc] = True
+        proxy_initials[initials] = True
+
+    # Lo que se envia a los workers en el primer nivel del crawl
+    prefixes = ["".join(p) for p in product(string.ascii_uppercase, repeat=2)]
+    cfg = {"cookies": "", "fetch-program": True, "fetch-quota": True}
+    chunk = STAGE_CHUNK["search"]
+    tasks = {
+        "manager": [
+            (pref, opts["period"], cfg, proxy_nrcs, proxy_initials)
+            for pref in prefixes
+        ],
+        "pipeline": [
+            (_search_task, prefixes[i : i + chunk], opts["period"], cfg)
+            for i in range(0, len(prefixes), chunk)
+        ],
+    }
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_time_proxies, args=(proxy_nrcs, proxy_initials, pages, queue)
+    )
+    process.start()
+    times = {"manager": queue.get(), "pipeline": _time_claims(seen, pages)}
+    process.join()
+    mgr.shutdown()
+
+    for name, elapsed in times.items():
+        log.info(
+            f"{name}: {elapsed:.3f}s para {n_rows} filas en {len(pages)} busquedas, "
+            f"{elapsed / n_rows * 1e6:.2f}us por fila"
+        )
+    if times["pipeline"]:
+        log.info(f"speedup: {times['manager'] / times['pipeline']:.1f}x")
+    for name, sent in tasks.items():
+        size = sum(len(pickle.dumps(task)) for task in sent)
+        log.info(f"{name}: {len(sent)} tareas, {size / 1024:.1f} KB enviados")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+COMPARED = [
+    "wall_time",
+    "requests",
+    "pages_per_second",
+    "parse_cpu_total",
+    "merge_time",
+    "cpu_time",
+    "peak_rss_mb",
+]
+
+
+def compare(results, baseline):
+    for pipeline, result in results["runs"].items():
+        old = baseline.get("runs", {}).get(pipeline)
+        if old is None:
+            continue
+        print(f"{pipeline} vs baseline {baseline.get('commit')}:")
+        for name in COMPARED:
+            if name not in result or name not in old:
+                continue
+            ratio = f"{result[name] / old[name]:.2f}x" if old[name] else "-"
+            print(f"  {name:<18}{old[name]:>12.2f}{result[name]:>12.2f}{ratio:>9}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    opts = {}
+    for arg in args:
+        if not arg.startswith("--"):
+            continue
+        name, eq, value = arg[2:].partition("=")
+        opts[name] = value if eq else True
+
+    if "help" in opts:
+        print("usage: python3 benchmark.py [options]")
+        print("  options:")
+        print("    --dataset=synthetic|cache  Replay pages generated from --data (default)")
+        print("                               or recorded in --cache-file.")
+        print("    --data=FILE.json           Scraped period to generate pages from")
+        print("                               (default 2024-3.json).")
+        print("    --cache-file=FILE          Recorded cache (default .requestcache).")
+        print("    --period=PERIOD            Period to scrape (default: --data name).")
+        print("    --row-limit=N              Rows per synthetic search page.")
+        print("    --catalogo                 Also benchmark the catalogo pipeline.")
+        print("    --with-cache               Use a fresh request cache while crawling.")
+        print("    --max-inflight=N           Same as in main.py.")
+        print("    --plan=FILES               Same as in main.py, to compare against the")
+        print("                               blind prefix expansion.")
+        print("    --workers-<stage>=N        Same as in main.py.")
+        print("    --latency=DIST --error-rate=P --throttle-rate=P --max-rps=N")
+        print("    --bandwidth=KB/s")
+        print("                               Faults injected by the replay server.")
+        print("    --output=FILE              Results file (default benchmark.json).")
+        print("    --baseline=FILE            Previous results to compare against.")
+        print("    --parser                   Instead, check the search parser against")
+        print("                               _BCParser on every search page of the")
+        print("                               dataset and time both (--repeat=N).")
+        print("    --seen                     Instead, time the checks for already")
+        print("                               processed sections with Manager proxies")
+        print("                               and in the parent (--rows=N).")
+        sys.exit()
+
+    logging.basicConfig(level=logging.INFO if "verbose" in opts else logging.WARNING)
+    log.setLevel(logging.INFO)
+    opts.setdefault("dataset", "synthetic")
+    opts.setdefault("data", "2024-3.json")
+    opts.setdefault("cache-file", ".requestcache")
+    opts["data"] = os.path.abspath(opts["data"])
+    opts["cache-file"] = os.path.abspath(opts["cache-file"])
+    if opts.get("plan"):
+        opts["plan"] = ",".join(os.path.abspath(p) for p in opts["plan"].split(","))
+    opts.setdefault("period", os.path.splitext(os.path.basename(opts["data"]))[0])
+
+    if "parser" in opts:
+        sys.exit(0 if check_parser(opts) else 1)
+
+    if "seen" in opts:
+        bench_seen(opts)
+        sys.exit()
+
+    results = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "options": opts,
+        "runs": {},
+    }
+    pipelines = ["courses"] + (["catalogo"] if "catalogo" in opts else [])
+    for pipeline in pipelines:
+        result = run(opts, pipeline)
+        results["runs"][pipeline] = result
+        log.info(
+            f"{pipeline}: {result['wall_time']:.2f}s, {result['requests']} requests, "
+            f"{result['pages_per_second']:.1f} pages/s"
+        )
+
+    output = opts.get("output", "benchmark.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    log.info(f"results written to {output}")
+
+    if "baseline" in opts:
+        with open(opts["baseline"], "r") as f:
+            compare(results, json.load(f))
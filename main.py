@@ -3,10 +3,30 @@
 
 import os
 import traceback
-from bc_scraper.actions.collect import CollectCourses
+from bc_scraper.actions.collect import STAGE_WORKERS, CollectCourses
 from bc_scraper.actions.collect_catalogo import CollectCatalogo
-from bc_scraper.scraper.request import load_cache
-import json
+from bc_scraper.actions.rekey import candidate_requests
+from bc_scraper.scraper.cache import (
+    RequestCache,
+    compact_cache,
+    compress_cache,
+    rekey_cache,
+)
+from bc_scraper.scraper.replay import (
+    Faults,
+    ReplayServer,
+    cache_source,
+    parse_latency,
+)
+from bc_scraper.scraper.request import (
+    CACHE_TTL,
+    DEFAULT_MAX_INFLIGHT,
+    close_cache,
+    load_cache,
+    rekey_function,
+)
+from bc_scraper.scraper.strings import dump_json
+import re
 import logging
 import sys
 
@@ -28,11 +48,94 @@ if os.path.exists(".cred"):
 args = sys.argv.copy()
 args.pop(0)
 opts = set()
+optvals = {}
 for i in reversed(range(len(args))):
     if args[i].startswith("--"):
-        opts.add(args[i][2:])
+        name, eq, value = args[i][2:].partition("=")
+        opts.add(name)
+        if eq:
+            optvals[name] = value
         args.pop(i)
 
+if len(args) >= 1 and args[0] == "cache":
+    # Cache maintenance
+    command = args[1] if len(args) >= 2 else ""
+    if command == "compress":
+        old_size, new_size = compress_cache(".requestcache")
+        log.info(f"cache rewritten: {old_size} -> {new_size} bytes")
+    elif command == "compact":
+        old_size, new_size = compact_cache(".requestcache")
+        log.info(f"cache compacted: {old_size} -> {new_size} bytes")
+    elif command == "rekey":
+        # Los archivos de scrapeos anteriores sirven para reconocer las
+        # entradas antiguas, que no guardan la URL de la que vienen
+        files = args[2:] or sorted(
+            f
+            for f in os.listdir(".")
+            if re.fullmatch(r"\d{4}-\d\.json|catalogo\.json", f)
+        )
+        old_cookies = [cookies, ""]
+        if "old-cred" in optvals:
+            with open(optvals["old-cred"], "r") as file:
+                old_cookies.append(file.read())
+        rekey = rekey_function(old_cookies, candidate_requests(files))
+        rekeyed, kept = rekey_cache(".requestcache", rekey)
+        log.info(f"cache rekeyed: {rekeyed} entries rekeyed, {kept} left as is")
+    elif command == "stats":
+        store = RequestCache(".requestcache")
+        store.sync()
+        stats = store.stats()
+        live = sum(row["bytes"] or 0 for row in stats.values())
+        print(f"log size: {os.path.getsize(store.path)} bytes ({live} live)")
+        print(
+            f"{'kind':<14}{'entries':>10}{'bytes':>14}"
+            f"{'hits':>10}{'revalid.':>10}{'misses':>10}{'hit %':>8}"
+        )
+        for kind, row in sorted(stats.items()):
+            hits = row.get("hits", 0)
+            total = hits + row.get("revalidated", 0) + row.get("misses", 0)
+            ratio = f"{100 * hits / total:.1f}" if total else "-"
+            print(
+                f"{kind:<14}{row['entries']:>10}{row['bytes'] or 0:>14}"
+                f"{hits:>10}{row.get('revalidated', 0):>10}"
+                f"{row.get('misses', 0):>10}{ratio:>8}"
+            )
+    else:
+        print("usage: python3 main.py cache <command>")
+        print("  commands:")
+        print("    compress  Rewrite `.requestcache` compressed with a trained dictionary.")
+        print("    compact   Rewrite `.requestcache` keeping only the newest entry per key.")
+        print("    stats     Show entries, bytes and hit ratio per kind of page.")
+        print("    rekey [files...] [--old-cred=FILE]")
+        print("              Rewrite cache keys so they don't depend on `.cred`. Old entries")
+        print("              are recognized from previous results (default `{period}.json`)")
+        print("              and the cookies in `.cred` or `--old-cred`.")
+    sys.exit()
+
+if len(args) >= 1 and args[0] == "replay":
+    # Servidor local que responde lo grabado en `.requestcache`
+    store = RequestCache(".requestcache")
+    store.sync()
+    faults = Faults(
+        latency=parse_latency(optvals["latency"]) if "latency" in optvals else None,
+        error_rate=float(optvals.get("error-rate", 0)),
+        throttle_rate=float(optvals.get("throttle-rate", 0)),
+        max_rps=float(optvals["max-rps"]) if "max-rps" in optvals else None,
+        bandwidth=(
+            float(optvals["bandwidth"]) * 1024 if "bandwidth" in optvals else None
+        ),
+    )
+    server = ReplayServer(
+        ("127.0.0.1", int(optvals.get("port", 8080))), cache_source(store), faults
+    )
+    log.info(f"replaying .requestcache at {server.base_url}")
+    log.info(f"scrape it with --base-url={server.base_url} --disable-cache")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info(f"replay stats: {server.counts}")
+    sys.exit()
+
 if len(args) == 0:
     print("usage: python3 main.py [options] [periods...]")
     print("  options:")
@@ -41,8 +144,27 @@ if len(args) == 0:
     print("    --skip-quota         Do not fetch course quota information.")
     print("    --disable-cache      Do not load or store cache from `.requestcache`.")
     print("    --test               Search for up to 10 courses and then stop.")
+    print("    --resume             Continue an interrupted crawl of the period from where")
+    print("                         it stopped, retrying prefixes that failed.")
+    print("    --plan=FILES         Search only the prefixes needed to cover the siglas in")
+    print("                         these comma-separated snapshots, catalogo or universal")
+    print("                         files, plus a few to discover new ones.")
+    print("    --max-inflight=N     Maximum concurrent requests per process (default 64).")
+    print("    --workers-<stage>=N  Worker processes for the search, courses (program and")
+    print("                         requirements) or quota stage (default 10, 3 and 2).")
+    print("    --cache-max-bytes=N  Drop least recently used pages from the cache index")
+    print("                         beyond N bytes (`cache compact` frees the disk).")
+    print("    --ttl-<kind>=SECS    Cache lifetime for search, quota, program,")
+    print("                         requirements, catalogo or other pages.")
+    print("    --base-url=URL       Send every request to a replay server at URL.")
+    print("    --encode-strings     Write repeated strings of `{period}.json` as ids into")
+    print("                         a string table (see README).")
     print("  example: python3 main.py 2022-2 2022-1 > stdout.txt 2> stderr.txt")
     print("  if period is 'catalogo' then catalogo UC is scraped")
+    print("  use `python3 main.py cache` to see cache maintenance commands")
+    print("  use `python3 main.py replay [--port=N] [--latency=DIST] [--error-rate=P]")
+    print("      [--throttle-rate=P] [--max-rps=N] [--bandwidth=KB/s]` to serve")
+    print("      `.requestcache` locally")
     sys.exit()
 periods = args
 
@@ -54,10 +176,26 @@ settings = {
     "fetch-quota": "skip-quota" not in opts,
     "fetch-requirements": "skip-requirements" not in opts,
     "disable-cache": "disable-cache" in opts,
+    "max-inflight": int(optvals.get("max-inflight", DEFAULT_MAX_INFLIGHT)),
+    "base-url": optvals.get("base-url"),
+    "encode-strings": "encode-strings" in opts,
+    "resume": "resume" in opts,
+    "plan": optvals["plan"].split(",") if optvals.get("plan") else None,
+    "stage-workers": {
+        stage: int(optvals[f"workers-{stage}"])
+        for stage in STAGE_WORKERS
+        if f"workers-{stage}" in optvals
+    },
+    "cache-ttl": {
+        kind: float(optvals[f"ttl-{kind}"])
+        for kind in CACHE_TTL
+        if f"ttl-{kind}" in optvals
+    },
 }
 
 if not settings.get("disable-cache"):
-    load_cache()
+    max_bytes = optvals.get("cache-max-bytes")
+    load_cache(max_bytes=int(max_bytes) if max_bytes else None)
 
 if len(args) == 1 and args[0] == "catalogo":
     # Scrape catalogo UC
@@ -65,7 +203,7 @@ if len(args) == 1 and args[0] == "catalogo":
     courses = CollectCatalogo()
     courses.collect(settings)
     data = dict(sorted(courses.courses.items()))
-    json.dump(data, sys.stdout)
+    dump_json(data, sys.stdout, encode=settings["encode-strings"])
 else:
     # Scrape buscacursos
     log.info(f"scraping {len(periods)} buscacurso periods")
@@ -81,3 +219,5 @@ else:
     #     data[period] = dict(sorted(courses.courses.items()))
     # data = dict(sorted(data.items(), reverse=True))
     # json.dump(data, sys.stdout)
+
+close_cache()
@@ -5,6 +5,10 @@ import sys
 import lzma
 from collections import defaultdict
 
+from bc_scraper.scraper.programs import program_sections
+from bc_scraper.scraper.requirements import compile_requirements
+from bc_scraper.scraper.strings import encode_strings, load_json
+
 
 def log(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -23,6 +27,7 @@ if not args:
     log("usage: python3 make-universal.py [options] <JSON data files...>")
     log("  --strip-program    Remove course program descriptions.")
     log("  --compress         Compress the resulting JSON using LZMA.")
+    log("  --encode-strings   Write repeated strings as ids into a string table.")
     log("  There must be exactly 1 catalogo file and 1+ buscacurso files.")
     log("  The file type is automatically recognized.")
     log("  The order in which files are specfied only matters if there is duplicated buscacursos data.")
@@ -36,7 +41,7 @@ buscacursos = {}
 
 for path in args:
     with open(path, 'r') as file:
-        data = json.load(file)
+        data = load_json(file)
         assert isinstance(data, dict)
         is_catalogo = False
         for key in data.keys():
@@ -63,9 +68,23 @@ if not buscacursos:
 if 'strip-program' in opts:
     for course in catalogo.values():
         course['program'] = ""
+        course['program_sections'] = {}
     for courses in buscacursos.values():
         for course in courses.values():
             course['program'] = ""
+            course['program_sections'] = {}
+else:
+    # Scrapeos antiguos no traen el programa por secciones, los programas ya
+    # vistos salen de `.parsememo`
+    for course in catalogo.values():
+        if 'program_sections' not in course:
+            course['program_sections'] = program_sections({}, course.get('program', ""))
+
+# Lo mismo con los requisitos ya compilados
+for course in catalogo.values():
+    if 'deps' not in course or 'equivs' not in course:
+        course['deps'], course['equivs'] = compile_requirements(
+            {}, course['req'], course['conn'], course['restr'], course['equiv'])
 
 for course in catalogo.values():
     course['instances'] = {}
@@ -142,6 +161,8 @@ for period, data in sorted(buscacursos.items()):
             'sections': src['sections'],
         }
 
+if 'encode-strings' in opts:
+    catalogo = encode_strings(catalogo)
 out = json.dumps(catalogo).encode("utf-8")
 if 'compress' in opts:
     out = lzma.compress(out)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import sys
-import json
 
-args = sys.argv[1:]
+from bc_scraper.scraper.strings import dump_json, load_json
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+opts = {arg[2:] for arg in sys.argv[1:] if arg.startswith("--")}
 
 def merge(dst, src):
     if isinstance(dst, dict) and isinstance(src, dict):
@@ -21,8 +23,8 @@ def merge(dst, src):
 out = None
 for path in args:
     with open(path, 'r') as file:
-        src = json.load(file)
+        src = load_json(file)
         out = merge(out, src)
 if isinstance(out, dict):
     out = dict(sorted(out.items(), reverse=True))
-json.dump(out, sys.stdout)
+dump_json(out, sys.stdout, encode="encode-strings" in opts)
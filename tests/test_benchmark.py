@@ -0,0 +1,57 @@
+import json
+
+from benchmark import check_parser
+from bc_scraper.scraper.replay import synthetic_source
+from bc_scraper.scraper.search import _search_url
+
+PERIOD = "2024-3"
+COURSE = {
+    "sigle": "ARQ1000",
+    "name": "Curso",
+    "credits": 10,
+    "school": "Arquitectura",
+    "area": "",
+    "category": "",
+    "sections": {
+        "1": {
+            "nrc": "10001",
+            "section": 1,
+            "schedule": {"l1": ["CLAS", "A1"]},
+            "format": "Presencial",
+            "campus": "San Joaquin",
+            "is_english": False,
+            "is_removable": True,
+            "is_special": False,
+            "total_quota": 8,
+        }
+    },
+}
+
+
+def write_cache(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def test_parser_check_reads_legacy_entries(tmp_path, caplog):
+    page = synthetic_source({"ARQ1000": COURSE}, PERIOD)(
+        "get", _search_url("A", PERIOD, False), None, ""
+    )
+    path = str(tmp_path / ".requestcache")
+    # Sin request guardada y con la request en null, como los caches antiguos
+    write_cache(
+        path,
+        [{"key": "a" * 64, "resp": page}, {"key": "b" * 64, "req": None, "resp": page}],
+    )
+
+    caplog.set_level("INFO")
+    assert check_parser({"dataset": "cache", "cache-file": path, "repeat": "1"})
+    assert "2 paginas, 0 distintas" in caplog.text
+
+
+def test_parser_check_fails_without_pages(tmp_path):
+    path = str(tmp_path / ".requestcache")
+    write_cache(path, [{"key": "a" * 64, "resp": "<html></html>"}])
+
+    assert not check_parser({"dataset": "cache", "cache-file": path, "repeat": "1"})
@@ -0,0 +1,97 @@
+from bc_scraper.scraper.cache import (
+    RequestCache,
+    compact_cache,
+    compress_cache,
+    rekey_cache,
+)
+
+SEARCH = {"m": "get", "url": "https://buscacursos.uc.cl/?cxml_sigla=ICS"}
+PROGRAM = {"m": "get", "url": "http://catalogo.uc.cl/?view=programa&sigla=ICS"}
+
+
+def page(n):
+    return f"<html><body>{'boilerplate ' * 50}<p>page {n}</p></body></html>"
+
+
+def make_cache(path):
+    """Four keys, one of them superseded and one evicted, plus usage stats."""
+    cache = RequestCache(path)
+    cache.put_many(
+        [
+            ("a", page("old a"), SEARCH, 10.0, None),
+            ("b", page("b"), SEARCH, 1.0, None),
+            ("c", page("c"), PROGRAM, 20.0, {"etag": "x"}),
+        ]
+    )
+    cache.put_many([("a", page("a"), SEARCH, 30.0, None)])
+    cache.put_many([("d", page("d"), PROGRAM, 40.0, None)])
+    # "b" es la de acceso mas antiguo
+    assert cache.evict(cache.live_bytes() - 1) == 1
+    cache.count({("search", "hits"): 3, ("program", "misses"): 2})
+    return cache
+
+
+def contents(path):
+    cache = RequestCache(path)
+    rows = cache._db.execute(
+        "SELECT key, cls, fetched, atime FROM entries ORDER BY key"
+    ).fetchall()
+    stats = cache._db.execute(
+        "SELECT cls, hits, revalidated, misses FROM stats ORDER BY cls"
+    ).fetchall()
+    return {key: cache.get(key) for key, *_ in rows}, rows, stats
+
+
+def test_compact_keeps_only_live_entries(tmp_path):
+    path = str(tmp_path / ".requestcache")
+    make_cache(path)
+    before = contents(path)
+
+    old_size, new_size = compact_cache(path)
+
+    assert new_size < old_size
+    assert contents(path) == before
+    assert before[0] == {"a": page("a"), "c": page("c"), "d": page("d")}
+
+
+def test_compress_keeps_only_live_entries(tmp_path):
+    path = str(tmp_path / ".requestcache")
+    make_cache(path)
+    before = contents(path)
+
+    compress_cache(path, "zlib")
+
+    assert contents(path) == before
+    cache = RequestCache(path)
+    offset, length = cache._db.execute(
+        "SELECT offset, length FROM entries WHERE key = 'a'"
+    ).fetchone()
+    assert cache._read_line(offset, length)["z"] == "zlib"
+    assert cache.get_entry("c").validators == {"etag": "x"}
+    # Una entrada desalojada no vuelve al reconstruir el indice desde el log
+    cache._db.execute("DELETE FROM meta WHERE name = 'indexed_end'")
+    cache._db.execute("DELETE FROM entries")
+    cache._db.commit()
+    cache.sync()
+    assert cache.get("b") is None
+    assert cache.get("a") == page("a")
+
+
+def test_rekey_renames_live_entries(tmp_path):
+    path = str(tmp_path / ".requestcache")
+    make_cache(path)
+    _, _, stats = contents(path)
+
+    def rekey(key, req):
+        return (key.upper(), req) if key != "d" else None
+
+    assert rekey_cache(path, rekey) == (2, 1)
+
+    responses, rows, new_stats = contents(path)
+    assert responses == {"A": page("a"), "C": page("c"), "d": page("d")}
+    assert [row[1:] for row in rows] == [
+        ("search", 30.0, 30.0),
+        ("program", 20.0, 20.0),
+        ("program", 40.0, 40.0),
+    ]
+    assert new_stats == stats
@@ -0,0 +1,218 @@
+import io
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+
+import pytest
+
+from bc_scraper.actions.collect import CollectCourses, _merge_results
+from bc_scraper.scraper.replay import THROTTLE_PAGE, ReplayServer, synthetic_source
+from bc_scraper.scraper.search import BC_ROW_LIMIT
+
+PERIOD = "2024-3"
+
+
+def make_course(initials, name="Curso", program="Programa", nrc="10001", sections=1):
+    return {
+        "sigle": initials,
+        "name": name,
+        "credits": 10,
+        "req": "No tiene",
+        "conn": "No tiene",
+        "restr": "No tiene",
+        "equiv": "No tiene",
+        "program": program,
+        "school": "Arquitectura",
+        "area": "",
+        "category": "",
+        "sections": {
+            str(i): {
+                "nrc": f"{nrc}{i}" if sections > 1 else nrc,
+                "section": i,
+                "schedule": {},
+                "format": "Presencial",
+                "campus": "San Joaquin",
+                "is_english": False,
+                "is_removable": True,
+                "is_special": False,
+                "total_quota": 8,
+                "quota": {"Vacantes libres": 8},
+            }
+            for i in range(1, sections + 1)
+        },
+    }
+
+
+def without_requirements(source, initials):
+    # Sin la pagina de requisitos de `initials`, el servidor responde 404
+    def serve(method, url, params, cookies):
+        if "requisitos" in url and f"sigla={initials}" in url:
+            return None
+        return source(method, url, params, cookies)
+
+    return serve
+
+
+@pytest.fixture
+def replay():
+    servers = []
+
+    def start(courses, wrap=None, row_limit=None):
+        source = synthetic_source(courses, PERIOD, row_limit)
+        if wrap is not None:
+            source = wrap(source)
+        server = ReplayServer(("127.0.0.1", 0), source)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def crawl(base_url, resume=False):
+    cfg = {
+        "resume": resume,
+        "cookies": "",
+        "fetch-program": True,
+        "fetch-quota": True,
+        "fetch-requirements": True,
+        "disable-cache": True,
+        "base-url": base_url,
+        "stage-workers": {"search": 2, "courses": 1, "quota": 1},
+    }
+    collector = CollectCourses()
+    collector.collect(PERIOD, cfg)
+    with open(f"{PERIOD}.json", "r", encoding="utf-8") as f:
+        return collector, json.load(f)
+
+
+def test_last_prefix_of_a_level_is_enriched(replay, tmp_path, monkeypatch):
+    # Solo "ZZ", el ultimo prefijo del nivel, encuentra algo
+    monkeypatch.chdir(tmp_path)
+    collector, courses = crawl(replay({"ZZZ1000": make_course("ZZZ1000")}))
+
+    assert list(courses) == ["ZZZ1000"]
+    assert courses["ZZZ1000"]["program"] == "Programa"
+    assert courses["ZZZ1000"]["sections"]["1"]["quota"] == {"Vacantes libres": 8}
+    assert collector.failed == 0
+    assert not os.path.exists(f"{PERIOD}.json.journal")
+
+
+def test_stale_snapshot_fields_are_refreshed(replay, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stale = make_course("ZZZ1000", name="Nombre viejo", program="OLD PROGRAM")
+    stale["credits"] = 5
+    stale["req"] = "ARQ1000"
+    with open(f"{PERIOD}.json", "w", encoding="utf-8") as f:
+        json.dump({"ZZZ1000": stale}, f)
+
+    _, courses = crawl(replay({"ZZZ1000": make_course("ZZZ1000", name="Nombre nuevo")}))
+
+    course = courses["ZZZ1000"]
+    assert course["name"] == "Nombre nuevo"
+    assert course["program"] == "Programa"
+    assert course["credits"] == 10
+    assert course["req"] == "No tiene"
+    assert list(course["sections"]) == ["1"]
+
+
+def test_merged_results_are_interned():
+    # Como si llegaran de un worker: los textos no son los internados aca
+    local = pickle.loads(pickle.dumps({"ZZZ1000": make_course("ZZZ1000")}))
+    local["ZZZ1000"]["sections"]["1"]["campus"] = "".join(["San ", "Joaquin"])
+    journal = io.StringIO()
+    shared = {"courses": {}, "journal": journal, "journal_synced": time.time()}
+
+    _merge_results(shared, local)
+
+    section = shared["courses"]["ZZZ1000"]["sections"]["1"]
+    assert section["campus"] is sys.intern("San Joaquin")
+    assert json.loads(journal.getvalue())["initials"] == "ZZZ1000"
+
+
+def test_truncated_prefix_is_split_even_if_its_course_failed(
+    replay, tmp_path, monkeypatch
+):
+    # "ZZ" llega al limite de filas y el curso de su primera fila falla
+    monkeypatch.chdir(tmp_path)
+    courses = {
+        "ZZA1000": make_course("ZZA1000", nrc="1"),
+        "ZZA2000": make_course("ZZA2000", nrc="2", sections=BC_ROW_LIMIT - 1),
+        "ZZB1000": make_course("ZZB1000", nrc="3"),
+    }
+    base_url = replay(
+        courses,
+        lambda source: without_requirements(source, "ZZA1000"),
+        row_limit=BC_ROW_LIMIT,
+    )
+    collector, courses = crawl(base_url)
+
+    assert sorted(courses) == ["ZZA2000", "ZZB1000"]
+    assert len(courses["ZZA2000"]["sections"]) == BC_ROW_LIMIT - 1
+    assert collector.failed >= 1
+    assert os.path.exists(f"{PERIOD}.json.journal")
+
+
+def test_sections_without_their_course_are_not_saved():
+    stub = {"sections": make_course("ZZZ1000")["sections"]}
+    journal = io.StringIO()
+    shared = {"courses": {}, "journal": journal, "journal_synced": time.time()}
+
+    _merge_results(shared, {"ZZZ1000": stub})
+    assert shared["courses"] == {}
+    assert journal.getvalue() == ""
+
+    shared["courses"]["ZZZ1000"] = make_course("ZZZ1000")
+    _merge_results(shared, {"ZZZ1000": stub})
+    assert shared["courses"]["ZZZ1000"]["name"] == "Curso"
+
+
+def test_resumed_crawl_matches_an_uninterrupted_one(replay, tmp_path, monkeypatch):
+    courses = {
+        "ARQ1000": make_course("ARQ1000", nrc="1"),
+        "ARQ2000": make_course("ARQ2000", nrc="2", sections=BC_ROW_LIMIT - 1),
+        "ICS1000": make_course("ICS1000", nrc="3", sections=3),
+        "MAT1000": make_course("MAT1000", nrc="4"),
+        "ZZZ1000": make_course("ZZZ1000", nrc="5", sections=2),
+    }
+    broken = {"on": True}
+
+    def flaky(source):
+        # Mientras `broken` falla lo de una sigla, y los cupos de una seccion
+        # quedan en la pagina de demasiadas consultas
+        def serve(method, url, params, cookies):
+            if broken["on"] and "sigla=MAT1000" in url:
+                return None
+            if broken["on"] and "nrc=52" in url:
+                return THROTTLE_PAGE
+            return source(method, url, params, cookies)
+
+        return serve
+
+    base_url = replay(courses, flaky, row_limit=BC_ROW_LIMIT)
+
+    os.makedirs(tmp_path / "full")
+    monkeypatch.chdir(tmp_path / "full")
+    broken["on"] = False
+    _, expected = crawl(base_url)
+
+    os.makedirs(tmp_path / "resumed")
+    monkeypatch.chdir(tmp_path / "resumed")
+    broken["on"] = True
+    collector, partial = crawl(base_url, resume=True)
+    assert collector.failed > 0
+    assert "MAT1000" not in partial
+    assert len(partial["ZZZ1000"]["sections"]) < 2
+    broken["on"] = False
+    collector, resumed = crawl(base_url, resume=True)
+
+    assert collector.failed == 0
+    assert not os.path.exists(f"{PERIOD}.json.journal")
+    assert sorted(expected) == sorted(courses)
+    assert resumed == expected
@@ -0,0 +1,54 @@
+import asyncio
+import sqlite3
+import threading
+
+from bc_scraper.scraper.coursemeta import CourseStore, course_meta_async
+from bc_scraper.scraper.replay import ReplayServer, synthetic_source
+
+
+def test_store_replaces_an_older_schema(tmp_path):
+    path = str(tmp_path / ".coursemeta")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE courses (initials TEXT PRIMARY KEY, program TEXT NOT NULL, "
+        "req TEXT NOT NULL, conn TEXT NOT NULL, restr TEXT NOT NULL, "
+        "equiv TEXT NOT NULL, fetched REAL NOT NULL, hash TEXT NOT NULL)"
+    )
+    db.execute("INSERT INTO courses VALUES ('ARQ1000', 'p', '', '', '', '', 0, 'h')")
+    db.commit()
+    db.close()
+
+    store = CourseStore(path)
+    assert store.get("ARQ1000") is None
+    store.put("ARQ1000", "Programa", ("a", "b", "c", "d"))
+    meta = store.get("ARQ1000")
+    assert (meta.program, meta.req, meta.equiv) == ("Programa", "a", "d")
+
+
+def test_course_meta_async_fetches_program_and_requirements(tmp_path):
+    course = {
+        "program": "Programa",
+        "req": "ARQ1000",
+        "conn": "o",
+        "restr": "",
+        "equiv": "",
+    }
+    server = ReplayServer(
+        ("127.0.0.1", 0), synthetic_source({"ARQ2000": course}, "2024-3")
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cfg = {
+        "cookies": "",
+        "disable-cache": True,
+        "fetch-program": True,
+        "fetch-requirements": True,
+        "base-url": f"http://127.0.0.1:{server.server_address[1]}",
+    }
+    try:
+        program, reqs = asyncio.run(course_meta_async(cfg, "ARQ2000"))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert program == "Programa"
+    assert reqs == ("ARQ1000", "o", "", "")
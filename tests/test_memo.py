@@ -0,0 +1,45 @@
+import sqlite3
+
+from bc_scraper.scraper.memo import Memo, memo_kind
+
+
+def test_new_parser_version_drops_old_results(tmp_path):
+    memo = Memo(str(tmp_path / ".parsememo"))
+    memo.put("search", "h", ["legacy"])
+    memo.put(memo_kind("search", 1), "h", ["v1"])
+    memo.put(memo_kind("quota", 1), "h", {"q": 1})
+
+    fresh = Memo(memo.path)
+    assert fresh.get(memo_kind("search", 2), "h") is None
+    fresh.put(memo_kind("search", 2), "h", ["v2"])
+
+    assert fresh.get(memo_kind("search", 2), "h") == ["v2"]
+    assert fresh.get(memo_kind("search", 1), "h") is None
+    assert fresh.get("search", "h") is None
+    assert fresh.get(memo_kind("quota", 1), "h") == {"q": 1}
+
+
+def test_memo_keeps_the_newest_entries(tmp_path):
+    memo = Memo(str(tmp_path / ".parsememo"), max_entries=3)
+    for i in range(5):
+        memo.put("search@1", str(i), i)
+
+    reopened = Memo(memo.path, max_entries=3)
+    assert [reopened.get("search@1", str(i)) for i in range(5)] == [None, None, 2, 3, 4]
+
+
+def test_memo_without_creation_times_is_upgraded(tmp_path):
+    path = str(tmp_path / ".parsememo")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE memo (kind TEXT NOT NULL, hash TEXT NOT NULL, "
+        "value TEXT NOT NULL, PRIMARY KEY (kind, hash))"
+    )
+    db.execute("INSERT INTO memo VALUES ('quota@1', 'h', '1')")
+    db.commit()
+    db.close()
+
+    memo = Memo(path)
+    assert memo.get("quota@1", "h") == 1
+    memo.put("quota@1", "g", 2)
+    assert memo.get("quota@1", "g") == 2
@@ -0,0 +1,29 @@
+from bc_scraper.actions.planner import plan_prefixes, prefix_alphabet
+
+
+def test_plan_covers_a_small_trie():
+    siglas = {"ARQ1000": 3, "ARQ2000": 3, "ICS1000": 5, "ICS2000": 5, "ICS20001": 2}
+    plan = plan_prefixes(siglas, "2024-3", max_rows=6, explore=0)
+
+    # Todo lo de A cabe en una busqueda, lo de I no. ICS2000 se busca tal
+    # cual aunque con ICS20001 se pase del limite
+    assert plan == ["A", "ICS1", "ICS2000"]
+    assert all(any(sigla.startswith(p) for p in plan) for sigla in siglas)
+
+
+def test_plan_explores_prefixes_without_known_siglas():
+    siglas = {"ARQ1000": 1}
+    plan = plan_prefixes(siglas, "2024-3", max_rows=6, explore=5)
+
+    assert plan[0] == "A"
+    explored = plan[1:]
+    assert len(explored) == 5
+    assert all(len(p) == 1 and p != "A" for p in explored)
+    assert explored == sorted(explored)
+    assert plan_prefixes(siglas, "2024-3", max_rows=6, explore=5) == plan
+
+
+def test_prefix_alphabet():
+    assert prefix_alphabet("AR") == "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    assert prefix_alphabet("ARQ") == "0123456789"
+    assert prefix_alphabet("ARQ10").endswith("Z")
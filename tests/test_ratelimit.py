@@ -0,0 +1,26 @@
+import time
+
+from bc_scraper.scraper.ratelimit import RateLimiter
+
+
+def test_failed_request_halves_without_pausing():
+    limiter = RateLimiter(rate=10.0, window=16.0)
+    limiter.acquire()
+    limiter.release(0.1, failed=True)
+
+    assert limiter.rate == 5.0
+    assert limiter.window == 8.0
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start < 0.5
+
+
+def test_throttled_request_pauses_every_process():
+    limiter = RateLimiter(rate=10.0, window=16.0, backoff=0.3)
+    limiter.acquire()
+    limiter.release(0.1, throttled=True)
+
+    assert limiter.rate == 5.0
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start >= 0.25
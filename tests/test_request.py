@@ -0,0 +1,26 @@
+import threading
+
+import pytest
+
+from bc_scraper.scraper.replay import Faults, ReplayServer, synthetic_source
+from bc_scraper.scraper.request import get_page
+from bc_scraper.scraper.search import _search_url
+
+PERIOD = "2024-3"
+
+
+@pytest.fixture
+def throttled_server():
+    server = ReplayServer(
+        ("127.0.0.1", 0), synthetic_source({}, PERIOD), Faults(throttle_rate=1.0)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_throttle_page_is_not_a_result(throttled_server):
+    cfg = {"cookies": "", "disable-cache": True, "base-url": throttled_server}
+    with pytest.raises(Exception, match="throttled"):
+        get_page(cfg, _search_url("ZZ", PERIOD, False))
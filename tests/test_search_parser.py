@@ -0,0 +1,120 @@
+import random
+
+import pytest
+
+from bc_scraper.scraper.replay import synthetic_source
+from bc_scraper.scraper.search import _BCParser, _BCStreamParser, _search_url
+
+PERIOD = "2024-3"
+
+
+def make_course(initials, school, nrc, schedule):
+    return {
+        "sigle": initials,
+        "name": f"Curso & taller {initials}",
+        "credits": 10,
+        "school": school,
+        "area": "",
+        "category": "",
+        "sections": {
+            str(i): {
+                "nrc": f"{nrc}{i}",
+                "section": i,
+                "schedule": schedule,
+                "format": "Presencial",
+                "campus": "San Joaquin",
+                "is_english": i % 2 == 0,
+                "is_removable": True,
+                "is_special": False,
+                "total_quota": 30,
+                "quota": {},
+            }
+            for i in (1, 2)
+        },
+    }
+
+
+COURSES = {
+    "ARQ1000": make_course("ARQ1000", "Arquitectura", "1000", {"l1": ["CLAS", "A1"]}),
+    "ARQ2000": make_course("ARQ2000", "Arquitectura", "2000", {}),
+    "ADM1000": make_course(
+        "ADM1000", "Ingeniería", "3000", {"m2": ["LAB", "B12"], "j3": ["AYU", ""]}
+    ),
+}
+
+# Lo que puede aparecer en una pagina sin ser parte de las filas
+NOISE = {
+    "plain": [],
+    "script": [
+        (
+            "<table>",
+            "<script>var row = '<tr class=\"resultadosRowPar\"><td>1</td></tr>';"
+            " if (a < b && b > c) {}</script><table>",
+        ),
+        (
+            "</table>\n</body>",
+            "</table><SCRIPT type=text/javascript>x = '</td>'</SCRIPT></body>",
+        ),
+    ],
+    "style": [
+        ("<table>", "<style>tr.resultadosRowPar > td { color: red }</style><table>"),
+    ],
+    "comment": [
+        ("<table>", "<table><!-- <tr class=\"resultadosRowPar\"><td>no</td></tr> -->"),
+        ("(Sin Profesores)</a>", "(Sin Profesores)</a><!-- </td></tr> -->"),
+    ],
+    "unquoted": [
+        ('<img src="i.png"/>', "<img src=/img/i.png />"),
+        (
+            "<a>(Sin Profesores)</a>",
+            "<a href=/x/y/ class=prof>(Sin Profesores)</a><span title=a/b/>.</span>",
+        ),
+        (
+            "<tr class=\"resultadosRowImpar\">",
+            "<tr class=resultadosRowImpar data-x=/a/b>",
+        ),
+    ],
+}
+
+
+def page(noise):
+    source = synthetic_source(COURSES, PERIOD)
+    text = source("get", _search_url("A", PERIOD, False), None, "")
+    for old, new in noise:
+        assert old in text
+        text = text.replace(old, new)
+    return text
+
+
+def reference(text):
+    parser = _BCParser()
+    parser.feed(text)
+    return parser.courses
+
+
+def stream(text, sizes):
+    parser = _BCStreamParser()
+    pos = 0
+    while pos < len(text):
+        size = next(sizes)
+        parser.feed(text[pos : pos + size])
+        pos += size
+    return parser.close()
+
+
+@pytest.mark.parametrize("noise", sorted(NOISE))
+def test_stream_parser_matches_reference(noise):
+    text = page(NOISE[noise])
+    expected = reference(text)
+    assert len(expected) == 6
+
+    rng = random.Random(noise)
+    for _ in range(20):
+        limit = rng.choice((2, 16, 256))
+        sizes = iter(lambda: rng.randint(1, limit), None)
+        assert stream(text, sizes) == expected
+
+
+def test_stream_parser_one_character_at_a_time():
+    text = page([pair for noise in NOISE.values() for pair in noise])
+    assert stream(text, iter(lambda: 1, None)) == reference(text)